@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# This file is part of the guarantor project
+# https://github.com/xkudev/guarantor
+#
+# Copyright (c) 2022 xkudev (xkudev@pm.me) - MIT License
+# SPDX-License-Identifier: MIT
+"""Benchmark for indexing.Index with a mixed write/read workload.
+
+Usage: python scripts/bench_index.py [num_terms] [num_queries]
+"""
+import sys
+import time
+import random
+import string
+import statistics
+
+from guarantor import indexing
+
+
+def _random_word(rand: random.Random) -> str:
+    return "".join(rand.choice(string.ascii_lowercase) for _ in range(rand.randint(4, 12)))
+
+
+def main(num_terms: int = 10_000_000, num_queries: int = 10_000) -> None:
+    rand  = random.Random(0)
+    index = indexing.Index()
+
+    # Each add yields up to two terms (the value and the second word),
+    # so there are num_terms items in the end.
+    field_vals = [f"{_random_word(rand)} {_random_word(rand)}" for _ in range(num_terms // 2)]
+    heads      = [f"{i:064x}" for i in range(num_terms // 2)]
+
+    t_start = time.perf_counter()
+    for field_val, head in zip(field_vals, heads):
+        index.add(field_val, head)
+    t_add = time.perf_counter() - t_start
+    del field_vals, heads
+
+    num_items = len(list(index.find("")))
+    print(f"add      : {num_items:>10} items in {t_add:6.1f}s ({num_items / t_add:,.0f} items/s)")
+
+    for prefix_len in (2, 4, 6):
+        latencies = []
+        num_found = 0
+        for i in range(num_queries):
+            prefix = "".join(rand.choice(string.ascii_lowercase) for _ in range(prefix_len))
+            if i % 2 == 0:
+                # mixed workload: a write between queries
+                index.add(_random_word(rand), f"{num_terms + i:064x}")
+
+            t_start = time.perf_counter()
+            # prefixes of length 2 match ~15k items at 10M terms, only take the first 100
+            for num_found, _ in enumerate(index.find(prefix)):
+                if num_found >= 100:
+                    break
+            latencies.append(time.perf_counter() - t_start)
+
+        latencies.sort()
+        p50 = statistics.median(latencies) * 1000
+        p99 = latencies[int(len(latencies) * 0.99)] * 1000
+        print(f"prefix {prefix_len}: p50 {p50:7.3f}ms  p99 {p99:7.3f}ms")
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
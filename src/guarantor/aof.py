@@ -0,0 +1,457 @@
+# This file is part of the guarantor project
+# https://github.com/xkudev/guarantor
+#
+# Copyright (c) 2022 xkudev (xkudev@pm.me) - MIT License
+# SPDX-License-Identifier: MIT
+
+"""Append only log (AOF) storage for the kvstore.
+
+Layout of a log directory:
+
+    00000001.aof        sealed segment
+    00000002.aof        sealed segment
+    00000003.aof        active segment (appended to)
+    index.snapshot      snapshot of the in memory offset index
+
+Each segment starts with SEGMENT_MAGIC, followed by records:
+
+    crc32 (4 bytes) | key_len (4 bytes) | val_len (4 bytes) | key | value
+
+The crc32 covers the lengths, the key and the value. A record with a
+later position supersedes an earlier record with the same key.
+
+On startup the index is loaded from the snapshot (if present) and
+records after the snapshot watermark are replayed. A torn record at the
+end of the active segment (e.g. after a crash) is truncated by the
+writer. Segments are only appended to, so sealed segments can be
+shipped as is for replication (see `AppendOnlyLog.segment_paths`).
+
+The only exception is `AppendOnlyLog.compact`, which rewrites sealed
+segments. Readers don't trust their index blindly: every record is
+read with its header and checked (crc and key) before the value is
+returned. If the check fails (or a segment is gone), the segments were
+rewritten and the reader reloads its index.
+"""
+import os
+import zlib
+import struct
+import typing as typ
+import logging
+import pathlib as pl
+import threading
+
+import orjson
+
+logger = logging.getLogger(__name__)
+
+
+SEGMENT_MAGIC  = b"GAOF0001"
+SEGMENT_SUFFIX = ".aof"
+SNAPSHOT_NAME  = "index.snapshot"
+
+RECORD_HEADER = struct.Struct("<III")
+
+DEFAULT_MAX_SEGMENT_SIZE  = 64 * 1024 * 1024
+DEFAULT_SNAPSHOT_INTERVAL = 10_000
+
+
+class CorruptRecord(Exception):
+    pass
+
+
+class Position(typ.NamedTuple):
+    segment: int
+    offset : int
+
+
+class IndexEntry(typ.NamedTuple):
+    segment: int
+    offset : int  # offset of the value
+    length : int  # length of the value
+
+
+def _record_crc(key: bytes, value: bytes) -> int:
+    crc = zlib.crc32(struct.pack("<II", len(key), len(value)))
+    crc = zlib.crc32(key, crc)
+    return zlib.crc32(value, crc)
+
+
+def encode_record(key: bytes, value: bytes) -> bytes:
+    header = RECORD_HEADER.pack(_record_crc(key, value), len(key), len(value))
+    return header + key + value
+
+
+def _segment_name(segment: int) -> str:
+    return f"{segment:08d}{SEGMENT_SUFFIX}"
+
+
+def iter_records(data: bytes, offset: int) -> typ.Iterator[tuple[int, bytes, int, int]]:
+    """Yield (record_offset, key, value_offset, value_len) for records in data.
+
+    Raises CorruptRecord if a record is incomplete or its crc doesn't match.
+    """
+    end = len(data)
+    while offset < end:
+        if offset + RECORD_HEADER.size > end:
+            raise CorruptRecord(offset)
+
+        crc, key_len, val_len = RECORD_HEADER.unpack_from(data, offset)
+        key_offset = offset + RECORD_HEADER.size
+        val_offset = key_offset + key_len
+        rec_end    = val_offset + val_len
+        if rec_end > end:
+            raise CorruptRecord(offset)
+
+        key   = data[key_offset:val_offset]
+        value = data[val_offset:rec_end]
+        if _record_crc(key, value) != crc:
+            raise CorruptRecord(offset)
+
+        yield (offset, key, val_offset, val_len)
+        offset = rec_end
+
+
+class AppendOnlyLog:
+    """Key value storage backed by append only segment files.
+
+    A log opened with flag='c' is the (single) writer, a log opened
+    with flag='r' is a reader, which catches up with the writer
+    whenever a key is not found.
+    """
+
+    def __init__(
+        self,
+        log_dir          : str | pl.Path,
+        flag             : typ.Literal['r', 'c'] = 'r',
+        max_segment_size : int  = DEFAULT_MAX_SEGMENT_SIZE,
+        snapshot_interval: int  = DEFAULT_SNAPSHOT_INTERVAL,
+        fsync            : bool = True,
+    ) -> None:
+        self.log_dir           = pl.Path(log_dir)
+        self.flag              = flag
+        self.max_segment_size  = max_segment_size
+        self.snapshot_interval = snapshot_interval
+        self.fsync             = fsync
+
+        self._lock  = threading.Lock()
+        self._index: dict[bytes, IndexEntry] = {}
+        self._fds  : dict[int, int] = {}
+
+        # position up to which records are in self._index
+        self._end = Position(1, len(SEGMENT_MAGIC))
+        self._active_file: typ.BinaryIO | None = None
+
+        self._unsnapshotted = 0
+
+        if flag == 'c':
+            self.log_dir.mkdir(parents=True, exist_ok=True)
+        elif not self.log_dir.exists():
+            raise FileNotFoundError(f"AOF directory doesn't exist: {self.log_dir}")
+
+        with self._lock:
+            self._load_snapshot()
+            self._replay()
+            if flag == 'c':
+                self._open_active()
+
+    def __enter__(self) -> 'AppendOnlyLog':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def _segment_path(self, segment: int) -> pl.Path:
+        return self.log_dir / _segment_name(segment)
+
+    def _segment_numbers(self) -> list[int]:
+        return sorted(int(path.name[: -len(SEGMENT_SUFFIX)]) for path in self.log_dir.glob("*" + SEGMENT_SUFFIX))
+
+    def segment_paths(self) -> list[pl.Path]:
+        """Paths of sealed segments, which will not be written to anymore."""
+        with self._lock:
+            return [self._segment_path(segment) for segment in self._segment_numbers() if segment < self._end.segment]
+
+    def _fd(self, segment: int) -> int:
+        fd = self._fds.get(segment)
+        if fd is None:
+            fd = self._fds[segment] = os.open(self._segment_path(segment), os.O_RDONLY)
+        return fd
+
+    def _close_fds(self) -> None:
+        for fd in self._fds.values():
+            os.close(fd)
+        self._fds.clear()
+
+    def _load_snapshot(self) -> None:
+        snapshot_path = self.log_dir / SNAPSHOT_NAME
+        try:
+            snapshot = orjson.loads(snapshot_path.read_bytes())
+        except FileNotFoundError:
+            return
+        except orjson.JSONDecodeError:
+            logger.warning(f"Ignoring invalid snapshot {snapshot_path}")
+            return
+
+        self._end   = Position(*snapshot['end'])
+        self._index = {key.encode("utf-8"): IndexEntry(*entry) for key, entry in snapshot['index'].items()}
+
+    def _write_snapshot(self) -> None:
+        snapshot = {
+            'end'  : list(self._end),
+            'index': {key.decode("utf-8"): list(entry) for key, entry in self._index.items()},
+        }
+        snapshot_path = self.log_dir / SNAPSHOT_NAME
+        tmp_path      = snapshot_path.with_suffix(".tmp")
+        with tmp_path.open(mode="wb") as fobj:
+            fobj.write(orjson.dumps(snapshot))
+            fobj.flush()
+            if self.fsync:
+                os.fsync(fobj.fileno())
+        os.replace(tmp_path, snapshot_path)
+        self._unsnapshotted = 0
+
+    def _replay(self) -> None:
+        """Add records after self._end to the index."""
+        segments = [segment for segment in self._segment_numbers() if segment >= self._end.segment]
+        for segment in segments:
+            is_last = segment == segments[-1]
+            path    = self._segment_path(segment)
+            offset  = self._end.offset if segment == self._end.segment else len(SEGMENT_MAGIC)
+
+            with path.open(mode="rb") as fobj:
+                header = fobj.read(len(SEGMENT_MAGIC))
+                fobj.seek(offset)
+                data = fobj.read()
+
+            if header != SEGMENT_MAGIC:
+                if is_last and SEGMENT_MAGIC.startswith(header):
+                    # segment creation was interrupted (or is in progress)
+                    data   = b""
+                    offset = len(SEGMENT_MAGIC)
+                else:
+                    raise CorruptRecord(f"Invalid segment header {path}")
+
+            valid_len = len(data)
+            try:
+                for _, key, val_offset, val_len in iter_records(data, 0):
+                    self._index[key] = IndexEntry(segment, offset + val_offset, val_len)
+                    self._unsnapshotted += 1
+            except CorruptRecord as err:
+                valid_len = err.args[0]
+                if not is_last:
+                    raise CorruptRecord(f"Corrupt record in sealed segment {path} at {offset + valid_len}")
+
+            if self.flag == 'c' and (header != SEGMENT_MAGIC or valid_len < len(data)):
+                logger.warning(f"Truncating torn tail of {path} at offset {offset + valid_len}")
+                with path.open(mode="r+b") as fobj:
+                    fobj.write(SEGMENT_MAGIC)
+                    fobj.truncate(offset + valid_len)
+
+            self._end = Position(segment, offset + valid_len)
+
+    def _open_active(self) -> None:
+        path  = self._segment_path(self._end.segment)
+        fobj  = path.open(mode="ab")
+        if fobj.tell() == 0:
+            fobj.write(SEGMENT_MAGIC)
+            fobj.flush()
+        self._active_file = typ.cast(typ.BinaryIO, fobj)
+        self._end         = Position(self._end.segment, fobj.tell())
+
+    def _roll_segment(self) -> None:
+        assert self._active_file is not None
+        self._active_file.close()
+        self._end = Position(self._end.segment + 1, 0)
+        self._open_active()
+
+    def _reload(self) -> None:
+        """Rebuild the index of a reader after segments were rewritten."""
+        self._close_fds()
+        self._index = {}
+        self._end   = Position(1, len(SEGMENT_MAGIC))
+        self._load_snapshot()
+        self._replay()
+
+    def _catch_up(self) -> None:
+        """Add records which a writer appended to the index of a reader."""
+        try:
+            self._replay()
+        except CorruptRecord:
+            # sealed segments were rewritten by compact
+            self._reload()
+
+    def _read_value(self, key: bytes, entry: IndexEntry) -> bytes | None:
+        """Value of the record at entry, None if the record isn't the expected one."""
+        if self.flag == 'c':
+            # the writer is the only one that rewrites segments
+            return os.pread(self._fd(entry.segment), entry.length, entry.offset)
+
+        rec_offset = entry.offset - len(key) - RECORD_HEADER.size
+        rec_len    = RECORD_HEADER.size + len(key) + entry.length
+        if rec_offset < len(SEGMENT_MAGIC):
+            return None
+
+        try:
+            data = os.pread(self._fd(entry.segment), rec_len, rec_offset)
+        except FileNotFoundError:
+            return None
+
+        if len(data) < rec_len:
+            return None
+
+        crc, key_len, val_len = RECORD_HEADER.unpack_from(data, 0)
+        rec_key = data[RECORD_HEADER.size : RECORD_HEADER.size + key_len]
+        value   = data[RECORD_HEADER.size + key_len :]
+        if key_len == len(key) and val_len == entry.length and rec_key == key and _record_crc(key, value) == crc:
+            return value
+        else:
+            return None
+
+    def _read_values(self, keys: list[bytes]) -> dict[bytes, bytes] | None:
+        entries = [(entry, key) for key in keys if (entry := self._index.get(key)) is not None]
+        entries.sort()
+
+        values: dict[bytes, bytes] = {}
+        for entry, key in entries:
+            value = self._read_value(key, entry)
+            if value is None:
+                return None
+            values[key] = value
+        return values
+
+    def get_many(self, keys: typ.Iterable[str]) -> dict[str, bytes]:
+        """Values of all keys that are present, read in file order."""
+        key_bytes = [key.encode("utf-8") for key in keys]
+        with self._lock:
+            if self.flag == 'r' and any(key not in self._index for key in key_bytes):
+                self._catch_up()
+
+            values = self._read_values(key_bytes)
+            if values is None:
+                # sealed segments were rewritten by compact
+                self._reload()
+                values = self._read_values(key_bytes)
+                if values is None:
+                    raise CorruptRecord(f"Invalid records in {self.log_dir}")
+
+        return {key.decode("utf-8"): value for key, value in values.items()}
+
+    def get(self, key: str) -> bytes | None:
+        return self.get_many([key]).get(key)
+
+    def __contains__(self, key: str) -> bool:
+        return self.get(key) is not None
+
+    def keys(self) -> list[str]:
+        with self._lock:
+            if self.flag == 'r':
+                self._catch_up()
+            return [key.decode("utf-8") for key in self._index]
+
+    def put_many(self, items: dict[str, bytes]) -> None:
+        """Append items with a single write (and fsync) per segment."""
+        if self.flag == 'r':
+            raise Exception(f"AOF {self.log_dir} not writable with flag='r'")
+
+        with self._lock:
+            assert self._active_file is not None
+
+            buf    : list[bytes] = []
+            entries: dict[bytes, IndexEntry] = {}
+            offset = self._end.offset
+            for key, value in items.items():
+                key_bytes = key.encode("utf-8")
+                record    = encode_record(key_bytes, value)
+                if buf and offset + len(record) > self.max_segment_size:
+                    self._append(buf, entries, offset)
+                    self._roll_segment()
+                    buf.clear()
+                    entries.clear()
+                    offset = self._end.offset
+
+                val_offset = offset + RECORD_HEADER.size + len(key_bytes)
+                entries[key_bytes] = IndexEntry(self._end.segment, val_offset, len(value))
+                buf.append(record)
+                offset += len(record)
+
+            if buf:
+                self._append(buf, entries, offset)
+            if self._end.offset >= self.max_segment_size:
+                self._roll_segment()
+
+            if self._unsnapshotted >= self.snapshot_interval:
+                self._write_snapshot()
+
+    def _append(self, buf: list[bytes], entries: dict[bytes, IndexEntry], end_offset: int) -> None:
+        assert self._active_file is not None
+        self._active_file.write(b"".join(buf))
+        self._active_file.flush()
+        if self.fsync:
+            os.fsync(self._active_file.fileno())
+
+        self._index.update(entries)
+        self._end = Position(self._end.segment, end_offset)
+        self._unsnapshotted += len(entries)
+
+    def compact(self) -> None:
+        """Rewrite sealed segments, dropping superseded records."""
+        if self.flag == 'r':
+            raise Exception(f"AOF {self.log_dir} not writable with flag='r'")
+
+        with self._lock:
+            # The snapshot is invalid as soon as any segment is rewritten. If
+            # we crash during compaction, the index is rebuilt by full replay.
+            (self.log_dir / SNAPSHOT_NAME).unlink(missing_ok=True)
+            self._close_fds()
+
+            for segment in self._segment_numbers():
+                if segment >= self._end.segment:
+                    continue
+
+                self._compact_segment(segment)
+
+            self._write_snapshot()
+
+    def _compact_segment(self, segment: int) -> None:
+        path = self._segment_path(segment)
+        data = path.read_bytes()
+
+        live_records: list[bytes] = []
+        new_entries : dict[bytes, IndexEntry] = {}
+        offset = len(SEGMENT_MAGIC)
+        for _, key, val_offset, val_len in iter_records(data, len(SEGMENT_MAGIC)):
+            if self._index.get(key) != IndexEntry(segment, val_offset, val_len):
+                continue  # superseded
+
+            value  = data[val_offset : val_offset + val_len]
+            record = encode_record(key, value)
+            new_entries[key] = IndexEntry(segment, offset + RECORD_HEADER.size + len(key), val_len)
+            live_records.append(record)
+            offset += len(record)
+
+        if not live_records:
+            path.unlink()
+            return
+
+        if offset == len(data):
+            return  # nothing to drop
+
+        tmp_path = path.with_suffix(".tmp")
+        with tmp_path.open(mode="wb") as fobj:
+            fobj.write(SEGMENT_MAGIC)
+            fobj.write(b"".join(live_records))
+            fobj.flush()
+            if self.fsync:
+                os.fsync(fobj.fileno())
+        os.replace(tmp_path, path)
+        self._index.update(new_entries)
+
+    def close(self) -> None:
+        with self._lock:
+            if self._active_file is not None:
+                self._active_file.close()
+                self._active_file = None
+                if self._unsnapshotted:
+                    self._write_snapshot()
+
+            self._close_fds()
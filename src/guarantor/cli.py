@@ -4,10 +4,16 @@
 #
 # Copyright (c) 2022 xkudev (xkudev@pm.me) - MIT License
 # SPDX-License-Identifier: MIT
+import typing as typ
 import logging
 
 import click
 
+from guarantor import env
+from guarantor import kvstore
+from guarantor import reindex
+from guarantor import cli_util
+
 try:
     import pretty_traceback
 
@@ -19,7 +25,45 @@ except ImportError:
 logger = logging.getLogger("guarantor.cli")
 
 
+ENV_DEFAULTS_OPTIONS: dict[str, typ.Any] = {}
+
+
+def opt(name: str, helptxt: str, default: typ.Any, **kwargs) -> typ.Any:
+    option, env_name, _default = cli_util.init_option(name, helptxt, default)
+    if env_name in ENV_DEFAULTS_OPTIONS:
+        assert ENV_DEFAULTS_OPTIONS[env_name] == _default
+    else:
+        ENV_DEFAULTS_OPTIONS[env_name] = _default
+    return option
+
+
 @click.group(context_settings={'help_option_names': ["-h", "--help"]})
 @click.version_option(version="2022.1001-alpha")
 def cli() -> None:
     """CLI for guarantor."""
+
+
+@cli.command(name="reindex")
+@opt("db_dir"    , "Database Directory"                      , default=env.DEFAULT_DB_DIR)
+@opt("backend"   , "Storage backend of the kvstore (dbm/aof)", default=kvstore.BACKEND_DBM)
+@opt("num_shards", "Number of shards of the kvstore"         , default=kvstore.DEFAULT_NUM_SHARDS)
+@opt("workers"   , "Number of worker processes"              , default=reindex.DEFAULT_WORKERS)
+@opt("trusted"   , "Don't verify the changes in the kvstore" , default=False)
+@opt("restart"   , "Ignore checkpoint of a previous rebuild" , default=False)
+def reindex_cmd(db_dir: str, backend: str, num_shards: int, workers: int, trusted: bool, restart: bool) -> None:
+    """Rebuild the indexes from the changes in the kvstore."""
+    if backend not in (kvstore.BACKEND_DBM, kvstore.BACKEND_AOF):
+        raise click.BadParameter(f"Invalid backend: {backend}")
+
+    def _progress(progress: reindex.Progress) -> None:
+        click.echo(f"Indexed {progress.num_done:>9} / {progress.num_heads} documents")
+
+    reindex.rebuild_indexes(
+        db_dir,
+        backend=backend,
+        num_shards=num_shards,
+        trusted=trusted,
+        workers=workers,
+        resume=not restart,
+        progress=_progress,
+    )
@@ -1,10 +1,19 @@
 import os
+import json
 import typing as typ
 import hashlib
+import binascii
+import functools
+import concurrent.futures
 
 import jcs
+from pycoin.ecdsa.Point import NoSuchPointError
 from pycoin.symbols.btc import network as BTC
 from pycoin.encoding.hexbytes import h2b
+from pycoin.encoding.exceptions import EncodingError
+from pycoin.contrib.msg_signing import MessageSigner
+
+from guarantor import pools
 
 
 class KeyPair(typ.NamedTuple):
@@ -25,39 +34,245 @@ def generate_wif(master_secret_hex: str | None = None) -> str:
     return wif
 
 
+# Parsing keys and addresses (base58 decoding, checksums, key
+# derivation) is expensive, so parsed objects are cached.
+KEY_CACHE_SIZE     = 1024
+ADDRESS_CACHE_SIZE = 2 ** 14
+
+
+@functools.lru_cache(maxsize=ADDRESS_CACHE_SIZE)
+def _parse_address(address: str) -> typ.Any:
+    return BTC.parse.p2pkh(address)
+
+
 def validate_address(address: str) -> None:
     """Raises ValueError if given address not valid."""
-    if not BTC.parse.p2pkh(address):
+    if not _parse_address(address):
         raise ValueError(f"Invalid BTC address: {address}")
 
 
+@functools.lru_cache(maxsize=KEY_CACHE_SIZE)
+def _parse_wif(wif: str) -> typ.Any:
+    return BTC.parse.wif(wif)
+
+
 def validate_wif(wif: str) -> None:
     """Raises ValueError if given input cannot be used for signing."""
-    if not BTC.parse.wif(wif):
+    if not _parse_wif(wif):
         raise ValueError(f"Invalid WIF: {wif}")
 
 
+def parse_wif(wif: str) -> typ.Any:
+    """Returns the key for a wif, raises ValueError if it cannot be used for signing."""
+    validate_wif(wif)
+    return _parse_wif(wif)
+
+
+@functools.lru_cache(maxsize=KEY_CACHE_SIZE)
 def get_wif_address(wif: str) -> str:
     """Returns the bitcoin address of the given input wif."""
-    validate_wif(wif)
-    return str(BTC.parse.wif(wif).address())
+    return str(parse_wif(wif).address())
+
+
+def sign_with_key(message: str, key: typ.Any) -> str:
+    """Returns signature of input message with a key from parse_wif."""
+    return str(BTC.msg.sign(key, message, verbose=0))
 
 
 def sign(message: str, wif: str) -> str:
     """Returns signature of input message with provided wif."""
-    validate_wif(wif)
-    key = BTC.parse.wif(wif)
-    return str(BTC.msg.sign(key, message, verbose=0))
+    return sign_with_key(message, parse_wif(wif))
+
+
+class Signer:
+    """Signs messages with a single (parsed) wif."""
+
+    def __init__(self, wif: str) -> None:
+        self._key    = parse_wif(wif)
+        self.address = get_wif_address(wif)
+
+    def sign(self, message: str) -> str:
+        return sign_with_key(message, self._key)
+
+
+PublicPair = tuple[int, int]
+
+# Public keys recovered from valid signatures, by address. Public key
+# recovery is the expensive part of verifying a signature, once the
+# key of an address is known, its signatures are verified directly.
+PUBKEY_CACHE_SIZE = 2 ** 14
+
+_pubkeys: dict[str, tuple[PublicPair, bool]] = {}
+
+_msg_signer = MessageSigner(BTC, BTC.generator)
+
+
+def _decode_signature(signature: str) -> tuple[bool, int, int, int]:
+    """Returns (is_compressed, recid, r, s) of a base64 encoded message signature."""
+    # Same decoding as MessageSigner._decode_signature
+    sig_data = binascii.a2b_base64(signature)
+    if len(sig_data) != 65 or not 27 <= sig_data[0] < 35:
+        raise EncodingError(f"Invalid signature: {signature}")
+
+    is_compressed = sig_data[0] >= 31
+    recid         = (sig_data[0] - 27) & 3
+    r             = int.from_bytes(sig_data[1:33], "big")
+    s             = int.from_bytes(sig_data[33:] , "big")
+    return (is_compressed, recid, r, s)
+
+
+def _verify_with_pubkey(pair: PublicPair, msg_hash: int, recid: int, r: int, s: int) -> bool:
+    """Same result as recovering the public key (pair_for_message_hash) and comparing it to pair."""
+    generator = BTC.generator
+    order     = generator.order()
+    if msg_hash == 0 or not (1 <= r < order and 1 <= s < order):
+        return False
+
+    # Recovery only yields a valid key for the point R with R.x == r and
+    # the parity of R.y given by the recid, other recids are rejected.
+    if recid > 1:
+        return False
+
+    s_inverse = generator.inverse(s)
+    point     = (msg_hash * s_inverse) * generator + (r * s_inverse) * generator.Point(*pair)
+    return bool(point[0] == r and point[1] & 1 == recid & 1)
+
+
+def _remember_pubkey(address: str, pair: PublicPair, is_compressed: bool) -> None:
+    if len(_pubkeys) >= PUBKEY_CACHE_SIZE:
+        _pubkeys.pop(next(iter(_pubkeys)), None)
+    _pubkeys[address] = (pair, is_compressed)
 
 
 def verify(address: str, signature: str, message: str) -> bool:
     """Verify signature if for given input message and address."""
     validate_address(address)
-    return bool(BTC.msg.verify(address, signature, message))
+
+    msg_hash = _msg_signer.hash_for_signing(message)
+    cached   = _pubkeys.get(address)
+    if cached is None:
+        try:
+            pair, is_compressed = _msg_signer.pair_for_message_hash(signature, msg_hash)
+        except (EncodingError, NoSuchPointError, binascii.Error):
+            # NoSuchPointError: recid > 1 yields no valid public key
+            return False
+
+        if not _msg_signer.pair_matches_key(pair, _parse_address(address), is_compressed):
+            return False
+
+        _remember_pubkey(address, pair, is_compressed)
+        return True
+
+    try:
+        sig_is_compressed, recid, r, s = _decode_signature(signature)
+    except (EncodingError, binascii.Error):
+        return False
+
+    pair, is_compressed = cached
+    if sig_is_compressed != is_compressed:
+        return False
+
+    return _verify_with_pubkey(pair, msg_hash, recid, r, s)
+
+
+VerifyArgs = tuple[str, str, str]
+
+# Batches smaller than this are verified in the calling process.
+VERIFY_PARALLEL_MIN_BATCH = 16
+
+DEFAULT_VERIFY_WORKERS = 1
+
+_verify_executors = pools.new_executors()
+
+
+def _verify_executor(workers: int) -> concurrent.futures.ProcessPoolExecutor:
+    return pools.get_executor(_verify_executors, workers)
+
+
+def shutdown_verify_executors() -> None:
+    """Shut down the process pools of verify_many (new pools are created on demand)."""
+    pools.shutdown_executors(_verify_executors)
+
+
+def _verify_batch(batch: list[VerifyArgs]) -> list[bool]:
+    results = []
+    for address, signature, message in batch:
+        try:
+            results.append(verify(address, signature, message))
+        except ValueError:
+            results.append(False)
+    return results
+
+
+def verify_many(items: typ.Sequence[VerifyArgs], workers: int = DEFAULT_VERIFY_WORKERS) -> list[bool]:
+    """Verify (address, signature, message) triples, returns one result per item.
+
+    With workers > 1, batches are verified in a process pool. Items
+    are grouped by address, so that each worker recovers the public
+    key of an address at most once.
+    """
+    if workers <= 1 or len(items) < VERIFY_PARALLEL_MIN_BATCH:
+        return _verify_batch(list(items))
+
+    by_address: dict[str, list[int]] = {}
+    for idx, (address, _, _) in enumerate(items):
+        by_address.setdefault(address, []).append(idx)
+
+    # Balance batches by size, but keep the items of an address
+    # together.
+    batch_size = max(1, len(items) // (workers * 4))
+    batches   : list[list[int]] = [[]]
+    for indexes in by_address.values():
+        if len(batches[-1]) >= batch_size:
+            batches.append([])
+        batches[-1].extend(indexes)
+
+    arg_batches = [[items[idx] for idx in batch] for batch in batches]
+    results     = [False] * len(items)
+    executor    = _verify_executor(workers)
+    for batch, batch_results in zip(batches, executor.map(_verify_batch, arg_batches)):
+        for idx, result in zip(batch, batch_results):
+            results[idx] = result
+    return results
+
+
+# Integers in this range have the same representation in JSON as in
+# RFC 8785 (which represents all numbers as IEEE 754 doubles).
+_MAX_SAFE_INT = 2 ** 53
+
+
+def _is_simple_json(obj: typ.Any) -> bool:
+    """True if obj is serialized the same by json.dumps as by jcs."""
+    if obj is None or isinstance(obj, (str, bool)):
+        return True
+    elif isinstance(obj, int):
+        return -_MAX_SAFE_INT <= obj <= _MAX_SAFE_INT
+    elif isinstance(obj, (list, tuple)):
+        return all(_is_simple_json(item) for item in obj)
+    elif isinstance(obj, dict):
+        # RFC 8785 sorts keys by their UTF-16 code units, which is only
+        # the same as the sort order of python for ascii keys.
+        return all(isinstance(key, str) and key.isascii() and _is_simple_json(val) for key, val in obj.items())
+    else:
+        # floats and anything else
+        return False
+
+
+def canonical_json(obj: typ.Any) -> bytes:
+    """Returns obj serialized according to RFC 8785.
+
+    For the shapes that changes typically have (strings, small ints,
+    ascii keys), json.dumps produces the same output and is much faster
+    than jcs, which is used for anything else (e.g. floats).
+    """
+    if _is_simple_json(obj):
+        return json.dumps(obj, sort_keys=True, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+    else:
+        return typ.cast(bytes, jcs.canonicalize(obj))
 
 
 def deterministic_json_hash(obj: typ.Any) -> str:
     """Returns sha256 hex digest of object serialized according to RFC 8785"""
     sha256 = hashlib.sha256()
-    sha256.update(jcs.canonicalize(obj))
+    sha256.update(canonical_json(obj))
     return sha256.hexdigest()
@@ -5,8 +5,13 @@
 # SPDX-License-Identifier: MIT
 from __future__ import annotations
 
+import random
 import typing as typ
+import asyncio
 import pathlib as pl
+import threading
+import collections
+import concurrent.futures
 
 from guarantor import env
 from guarantor import docdiff
@@ -14,6 +19,138 @@ from guarantor import kvstore
 from guarantor import schemas
 from guarantor import indexing
 
+DEFAULT_RESET_INTERVAL    = 16
+DEFAULT_SNAPSHOT_INTERVAL = DEFAULT_RESET_INTERVAL // 2
+
+VerifyMode = typ.Literal['always', 'on-save', 'sampled', 'off']
+
+# When to verify that the document of a DocumentWrapper matches its changes
+VERIFY_ALWAYS : VerifyMode = "always"   # whenever a wrapper is created
+VERIFY_ON_SAVE: VerifyMode = "on-save"  # only when saving
+VERIFY_SAMPLED: VerifyMode = "sampled"  # only when saving, for a fraction of saves
+VERIFY_OFF    : VerifyMode = "off"
+
+DEFAULT_VERIFY_SAMPLE_RATE = 0.1
+
+# Number of documents of a ResultSet which are loaded ahead of iteration.
+DEFAULT_PREFETCH = 8
+
+# Number of threads of an AsyncDataAccessLayer which load and save documents.
+DEFAULT_ASYNC_WORKERS = 4
+
+DEFAULT_CACHE_SIZE      = 1024
+DEFAULT_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+# Rough per change overhead (ids, signature, rev) on top of its opdata.
+_CHANGE_SIZE_OVERHEAD = 512
+
+
+# document, changes after the base and the base snapshot (if any)
+_LoadedDocument = tuple[schemas.BaseDocument, list[schemas.Change], schemas.Snapshot | None]
+
+
+class LoadError(Exception):
+    """A document could not be loaded (see DataAccessLayer.get_many)."""
+
+
+class CacheStats(typ.NamedTuple):
+    hits       : int
+    misses     : int
+    evictions  : int
+    num_entries: int
+    num_bytes  : int
+
+
+class _CacheEntry(typ.NamedTuple):
+    doc    : schemas.BaseDocument
+    changes: list[schemas.Change]
+    base   : schemas.Snapshot | None
+    size   : int
+
+
+def _entry_size(doc: schemas.BaseDocument, changes: list[schemas.Change]) -> int:
+    # This is only an estimate, it's good enough to keep the memory
+    # usage of the cache in the right ballpark.
+    size = len(doc.json())
+    for change in changes:
+        size += len(str(change.opdata)) + _CHANGE_SIZE_OVERHEAD
+    return size
+
+
+class DocumentCache:
+    """LRU cache of built documents, keyed by their head.
+
+    A document at a given head never changes (the head is the digest
+    of the change), so entries never need to be invalidated. Entries
+    are evicted if there are more than max_entries or if their
+    (estimated) size exceeds max_bytes.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = DEFAULT_CACHE_SIZE,
+        max_bytes  : int = DEFAULT_CACHE_MAX_BYTES,
+    ) -> None:
+        self.max_entries = max_entries
+        self.max_bytes   = max_bytes
+
+        self._lock    = threading.Lock()
+        self._entries: collections.OrderedDict[schemas.ChangeId, _CacheEntry] = collections.OrderedDict()
+
+        self._num_bytes = 0
+        self._hits      = 0
+        self._misses    = 0
+        self._evictions = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def stats(self) -> CacheStats:
+        with self._lock:
+            return CacheStats(self._hits, self._misses, self._evictions, len(self._entries), self._num_bytes)
+
+    def get(self, head: schemas.ChangeId) -> _CacheEntry | None:
+        with self._lock:
+            entry = self._entries.get(head)
+            if entry is None:
+                self._misses += 1
+            else:
+                self._hits += 1
+                self._entries.move_to_end(head)
+            return entry
+
+    def put(
+        self,
+        head   : schemas.ChangeId,
+        doc    : schemas.BaseDocument,
+        changes: list[schemas.Change],
+        base   : schemas.Snapshot | None,
+    ) -> None:
+        if self.max_entries <= 0:
+            return
+
+        size = _entry_size(doc, changes)
+        if size > self.max_bytes:
+            return
+
+        with self._lock:
+            old_entry = self._entries.pop(head, None)
+            if old_entry is not None:
+                self._num_bytes -= old_entry.size
+
+            self._entries[head] = _CacheEntry(doc, changes, base, size)
+            self._num_bytes += size
+
+            while len(self._entries) > self.max_entries or self._num_bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._num_bytes -= evicted.size
+                self._evictions += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._num_bytes = 0
+
 
 class DataAccessLayer:
     """Middleman between user code and DHT/KVStore.
@@ -26,66 +163,586 @@ class DataAccessLayer:
 
     def __init__(
         self,
-        wif       : str | None,
-        db_dir    : str | pl.Path = env.DEFAULT_DB_DIR,
-        difficulty: int = schemas.DEFAULT_DIFFICULTY_BITS,
+        wif               : str | None,
+        db_dir            : str | pl.Path   = env.DEFAULT_DB_DIR,
+        difficulty        : int             = schemas.DEFAULT_DIFFICULTY_BITS,
+        backend           : kvstore.Backend = kvstore.BACKEND_DBM,
+        num_shards        : int             = kvstore.DEFAULT_NUM_SHARDS,
+        trusted           : bool            = False,
+        snapshot_interval : int             = DEFAULT_SNAPSHOT_INTERVAL,
+        reset_interval    : int             = DEFAULT_RESET_INTERVAL,
+        max_op_size       : int             = docdiff.DEFAULT_MAX_OP_SIZE,
+        verify_mode       : VerifyMode      = VERIFY_ALWAYS,
+        verify_sample_rate: float           = DEFAULT_VERIFY_SAMPLE_RATE,
+        pow_workers       : int             = schemas.DEFAULT_POW_WORKERS,
+        prefetch          : int             = DEFAULT_PREFETCH,
+        cache_size        : int             = DEFAULT_CACHE_SIZE,
+        cache_max_bytes   : int             = DEFAULT_CACHE_MAX_BYTES,
+        flag              : typ.Literal['r', 'c'] = 'c',
     ):
+        if verify_mode not in (VERIFY_ALWAYS, VERIFY_ON_SAVE, VERIFY_SAMPLED, VERIFY_OFF):
+            raise ValueError(f"Invalid verify_mode: {verify_mode}")
+
         self.wif        = wif
-        self.kvstore    = kvstore.Client(db_dir, flag='c')
+        self.kvstore    = kvstore.Client(
+            db_dir,
+            flag=flag,
+            backend=backend,
+            num_shards=num_shards,
+            trusted=trusted,
+        )
         self.difficulty = difficulty
 
+        # The indexes are persisted alongside the kvstore, so that
+        # find works after a restart without re-indexing documents.
+        self.indexes = indexing.IndexStore(pl.Path(db_dir) / "indexes")
+
+        # number of processes used to calculate the proof of work of a change
+        self.pow_workers = pow_workers
+
+        # A snapshot is written on save if the revision number of the
+        # head is divisible by snapshot_interval (0 disables snapshots),
+        # except for revisions which are an OP_RESET (see reset_interval),
+        # as these contain the whole document anyway. Only snapshots of
+        # such changes are looked up when loading. Snapshots are not
+        # pruned, so the default only writes one every reset_interval
+        # changes (halfway between two resets).
+        self.snapshot_interval = snapshot_interval
+
+        # Every change with a revision number divisible by reset_interval
+        # is an OP_RESET, so that loading a document never needs to
+        # replay more than reset_interval changes (0 disables resets).
+        self.reset_interval = reset_interval
+        self.max_op_size    = max_op_size
+
+        self.verify_mode        = verify_mode
+        self.verify_sample_rate = verify_sample_rate
+
+        # number of threads which load the documents of a ResultSet ahead of iteration
+        self.prefetch = prefetch
+
+        self._executor_lock = threading.Lock()
+        self._executor: concurrent.futures.ThreadPoolExecutor | None = None
+
+        # built documents by head (cache_size=0 disables the cache)
+        self.cache = DocumentCache(max_entries=cache_size, max_bytes=cache_max_bytes)
+
+    def __enter__(self) -> DataAccessLayer:
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def close(self) -> None:
+        with self._executor_lock:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+
+        self.kvstore.close()
+        self.indexes.close()
+
+    def _get_executor(self) -> concurrent.futures.ThreadPoolExecutor:
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, self.prefetch))
+            return self._executor
+
     def new(self, clazz: schemas.DocTypeClass, **kwargs) -> DocumentWrapper:
-        wif = self.wif
-        if wif is None:
+        if self.wif is None:
             raise Exception("A 'wif' needed to create a new document.")
 
         doc     = clazz(**kwargs)
         doc_kw  = doc.dict()
-        op      = docdiff.Operation(docdiff.OP_RESET, doc_kw)
+        ops     = docdiff.make_diffs({}, doc_kw, force_reset=True, max_op_size=self.max_op_size)
         doctype = schemas.get_doctype(clazz)
-        change  = docdiff.make_change(
-            doctype=doctype,
-            op=op,
-            parent=None,
-            wif=wif,
-            difficulty=self.difficulty,
-        )
-        return DocumentWrapper(dal=self, doc=doc, changes=[], tmp_changes=[change])
+        changes = self._make_changes(doctype, ops, parent=None)
+        return DocumentWrapper(dal=self, doc=doc, changes=[], tmp_changes=changes)
+
+    def new_many(
+        self,
+        clazz      : schemas.DocTypeClass,
+        docs_kwargs: typ.Iterable[dict[str, typ.Any]],
+    ) -> list[DocumentWrapper]:
+        """Bulk version of new (e.g. for imports).
+
+        The changes of all documents are created with schemas.make_changes,
+        so the proof of work is calculated by a pool of pow_workers.
+        """
+        wif = self.wif
+        if wif is None:
+            raise Exception("A 'wif' needed to create a new document.")
+
+        doctype = schemas.get_doctype(clazz)
+
+        docs : list[schemas.BaseDocument] = []
+        specs: list[schemas.ChangeSpec]   = []
+        for kwargs in docs_kwargs:
+            doc = clazz(**kwargs)
+            ops = docdiff.make_diffs({}, doc.dict(), force_reset=True, max_op_size=self.max_op_size)
+            if len(ops) > 1:
+                # the changes of chunked documents depend on each other
+                raise ValueError("Document too large for new_many, use new instead")
+
+            docs.append(doc)
+            specs.append(schemas.ChangeSpec(doctype, ops[0].opcode, ops[0].opdata))
+
+        changes = schemas.make_changes(wif, specs, difficulty=self.difficulty, pow_workers=self.pow_workers)
+        return [
+            DocumentWrapper(dal=self, doc=doc, changes=[], tmp_changes=[change])
+            for doc, change in zip(docs, changes)
+        ]
+
+    def _make_changes(
+        self,
+        doctype: schemas.DocType,
+        ops    : list[docdiff.Operation],
+        parent : schemas.Change | schemas.Snapshot | None,
+    ) -> list[schemas.Change]:
+        wif = self.wif
+        if wif is None:
+            raise Exception("A 'wif' needed to create changes.")
+
+        changes: list[schemas.Change] = []
+        for op in ops:
+            change = docdiff.make_change(
+                doctype=doctype,
+                op=op,
+                parent=parent,
+                wif=wif,
+                difficulty=self.difficulty,
+                pow_workers=self.pow_workers,
+            )
+            changes.append(change)
+            parent = change
+        return changes
+
+    def _is_reset_due(self, parent: schemas.Change | schemas.Snapshot) -> bool:
+        if self.reset_interval <= 0:
+            return False
+        else:
+            rev_num = schemas.revision_number(parent.rev) + 1
+            return rev_num % self.reset_interval == 0
+
+    def _is_snapshot_rev(self, rev: schemas.Revision) -> bool:
+        if self.snapshot_interval <= 0:
+            return False
+
+        rev_num = schemas.revision_number(rev)
+        if self.reset_interval > 0 and rev_num % self.reset_interval == 0:
+            return False
+        else:
+            return rev_num % self.snapshot_interval == 0
 
     def get(self, head: schemas.ChangeId) -> DocumentWrapper:
-        # TODO (mb 2022-08-07): async, to encourage batching?
-        changes = list(self.kvstore.iter_changes(head))
-        changes.sort()
-        assert changes[-1].change_id == head, f"Mismatched head {changes[-1].change_id} != {head}"
+        return self._wrap(*self._get_loaded(head))
+
+    def _get_loaded(self, head: schemas.ChangeId) -> _LoadedDocument:
+        entry = self.cache.get(head)
+        if entry is None:
+            doc, changes, base = self._load(head)
+            self.cache.put(head, doc, changes, base)
+            return doc, changes, base
+        else:
+            return entry.doc, entry.changes, entry.base
+
+    def get_many(self, heads: typ.Iterable[schemas.ChangeId]) -> list[DocumentWrapper | LoadError]:
+        """Documents at heads (in the same order).
+
+        Changes which are shared by multiple heads are only read and
+        verified once. If a document can't be loaded, its result is a
+        LoadError rather than an exception being raised.
+        """
+        heads  = list(heads)
+        loaded = self._get_loaded_many(heads)
+        return [
+            result if isinstance(result, LoadError) else self._wrap(*result)
+            for result in (loaded[head] for head in heads)
+        ]
+
+    def _get_loaded_many(
+        self, heads: typ.Iterable[schemas.ChangeId]
+    ) -> dict[schemas.ChangeId, _LoadedDocument | LoadError]:
+        results: dict[schemas.ChangeId, _LoadedDocument | LoadError] = {}
+
+        uncached: list[schemas.ChangeId] = []
+        for head in dict.fromkeys(heads):
+            entry = self.cache.get(head)
+            if entry is None:
+                uncached.append(head)
+            else:
+                results[head] = (entry.doc, entry.changes, entry.base)
+
+        if uncached:
+            for head, result in self._load_many(uncached).items():
+                if not isinstance(result, LoadError):
+                    self.cache.put(head, *result)
+                results[head] = result
+
+        return results
+
+    def _load_many(
+        self, heads: list[schemas.ChangeId]
+    ) -> dict[schemas.ChangeId, _LoadedDocument | LoadError]:
+        # The chains of all heads are walked in rounds. Each round reads
+        # the changes (and snapshots) that any chain is waiting for,
+        # with one pass per storage file. Changes are verified in a
+        # single batch after all chains were walked.
+        changes  : dict[schemas.ChangeId, schemas.Change] = {}
+        snapshots: dict[schemas.ChangeId, schemas.Snapshot] = {}
+        bad_ids  : dict[schemas.ChangeId, str] = {}
+
+        cursors: dict[schemas.ChangeId, schemas.ChangeId]       = {head: head for head in heads}
+        walked : dict[schemas.ChangeId, list[schemas.Change]]   = {head: [] for head in heads}
+        bases  : dict[schemas.ChangeId, schemas.Snapshot | None] = {head: None for head in heads}
+        errors : dict[schemas.ChangeId, LoadError] = {}
+
+        while cursors:
+            read_ids = {
+                change_id
+                for change_id in cursors.values()
+                if change_id not in changes and change_id not in bad_ids
+            }
+            self._read_changes(read_ids, changes, bad_ids)
+            self._read_snapshots(read_ids, changes, snapshots)
+
+            for head, change_id in list(cursors.items()):
+                change_id, base = _walk_chain(change_id, changes, snapshots, walked[head])
+                if base is not None:
+                    bases[head] = base
+
+                if change_id in bad_ids:
+                    errors[head] = LoadError(bad_ids[change_id])
+                    del cursors[head]
+                elif change_id in changes:
+                    del cursors[head]
+                else:
+                    cursors[head] = change_id
+
+        if not self.kvstore.trusted:
+            self._verify_walked(heads, walked, errors)
+
+        return {
+            head: errors[head] if head in errors else _build_loaded(head, walked[head], bases[head])
+            for head in heads
+        }
+
+    def _read_changes(
+        self,
+        read_ids: set[schemas.ChangeId],
+        changes : dict[schemas.ChangeId, schemas.Change],
+        bad_ids : dict[schemas.ChangeId, str],
+    ) -> None:
+        """Add the decoded changes of read_ids to changes (or their error to bad_ids)."""
+        changes_data = self.kvstore.read_many(read_ids)
+        for change_id in read_ids:
+            change_data = changes_data.get(change_id)
+            if change_data is None:
+                bad_ids[change_id] = f"Missing change {change_id}"
+                continue
+
+            try:
+                change = schemas.loads_change(change_data, verify=False)
+            except Exception as err:
+                bad_ids[change_id] = f"Invalid change {change_id}: {err}"
+                continue
+
+            if change.change_id == change_id:
+                changes[change_id] = change
+            else:
+                bad_ids[change_id] = f"Mismatched change_id {change.change_id} != {change_id}"
+
+    def _read_snapshots(
+        self,
+        read_ids : set[schemas.ChangeId],
+        changes  : dict[schemas.ChangeId, schemas.Change],
+        snapshots: dict[schemas.ChangeId, schemas.Snapshot],
+    ) -> None:
+        """Add the snapshots of the (snapshot revision) changes of read_ids to snapshots."""
+        snapshot_ids = [
+            change_id
+            for change_id in read_ids
+            if change_id in changes and self._is_snapshot_rev(changes[change_id].rev)
+        ]
+        snapshots.update(self.kvstore.get_snapshots(snapshot_ids))
+
+    def _verify_walked(
+        self,
+        heads : list[schemas.ChangeId],
+        walked: dict[schemas.ChangeId, list[schemas.Change]],
+        errors: dict[schemas.ChangeId, LoadError],
+    ) -> None:
+        """Verify the walked changes of all heads in one batch, add an error for heads with invalid changes."""
+        walked_changes = {change.change_id: change for head in heads for change in walked[head]}
+
+        unverified = list(walked_changes.values())
+        verified   = schemas.verify_changes(unverified, workers=self.kvstore.verify_workers)
+        invalid    = {change.change_id for change, is_valid in zip(unverified, verified) if not is_valid}
+        for head in heads:
+            for change in walked[head]:
+                if change.change_id in invalid and head not in errors:
+                    errors[head] = LoadError(f"Invalid change {change.change_id}")
+
+    def _wrap(
+        self,
+        doc    : schemas.BaseDocument,
+        changes: list[schemas.Change],
+        base   : schemas.Snapshot | None,
+    ) -> DocumentWrapper:
+        # The cached document is only referenced by the cache and by the
+        # (private) verified state, user code only ever gets a copy. The
+        # lists of changes are never modified, so they are shared.
+        verified = _VerifiedState(doc, len(changes))
+        return DocumentWrapper(
+            dal=self,
+            doc=doc.copy(deep=True),
+            changes=changes,
+            tmp_changes=[],
+            base=base,
+            verified=verified,
+        )
+
+    def _load(self, head: schemas.ChangeId) -> _LoadedDocument:
+        changes: list[schemas.Change]  = []
+        base   : schemas.Snapshot | None = None
+
+        # Changes before the most recent OP_RESET don't contribute to the
+        # document, use get_history to load them (e.g. for an audit).
+        for change in self.kvstore.iter_changes(head, early_exit=True):
+            if self._is_snapshot_rev(change.rev):
+                snapshot = self.kvstore.get_snapshot(change.change_id)
+            else:
+                snapshot = None
 
-        doc = docdiff.build_document(changes)
-        return DocumentWrapper(dal=self, doc=doc, changes=changes, tmp_changes=[])
+            if _is_valid_snapshot(snapshot, change):
+                base = snapshot
+                break
+            else:
+                changes.append(change)
 
-    def _find_matches(self, doctype: str, search_kwargs: dict) -> typ.Iterator[indexing.MatchItem]:
-        # pylint: disable=no-self-use; this will change as we flesh out the indexing module
-        if not search_kwargs:
-            raise TypeError("Missing keyword arguments: **search_kwargs")
+        changes.sort()
+        head_id = changes[-1].change_id if changes else base and base.change_id
+        assert head_id == head, f"Mismatched head {head_id} != {head}"
 
-        for field, search_term in search_kwargs.items():
-            yield from indexing.query_index(doctype, search_term, fields=[field])
+        # the document is built from the changes, no need to verify it again
+        doc = docdiff.build_document(changes, base=base)
+        return doc, changes, base
 
-    def find(self, doctype: str, **search_kwargs) -> typ.Iterator[DocumentWrapper]:
-        for match in self._find_matches(doctype, search_kwargs):
-            yield self.get(match.head)
+    def get_history(self, head: schemas.ChangeId) -> list[schemas.Change]:
+        """All changes of the document up to head (oldest first)."""
+        changes = list(self.kvstore.iter_changes(head))
+        changes.sort()
+        return changes
 
-    def find_one(self, doctype: str, **search_kwargs) -> DocumentWrapper | None:
+    def find(
+        self,
+        doctype     : str,
+        query       : dict[str, str] | None = None,
+        *,
+        limit       : int | None = None,
+        offset      : int        = 0,
+        newest_first: bool       = False,
+        **search_kwargs,
+    ) -> ResultSet:
+        """Documents which match all fields of query and search_kwargs (field=search_term).
+
+        The names query, limit, offset and newest_first are reserved,
+        fields with these names can only be searched using query.
+
+        Only the index is queried, documents are loaded when the
+        ResultSet is iterated. Matches are ordered by their head (or
+        by revision with newest_first=True), limit and offset apply
+        to the matches.
+        """
+        criteria = {**(query or {}), **search_kwargs}
+        if not criteria:
+            raise TypeError("Missing query or keyword arguments: **search_kwargs")
+
+        items = self.indexes.query_heads(
+            doctype, criteria, limit=limit, offset=offset, newest_first=newest_first
+        )
+        return ResultSet(self, items)
+
+    def find_one(
+        self,
+        doctype: str,
+        query  : dict[str, str] | None = None,
+        **search_kwargs,
+    ) -> DocumentWrapper | None:
+        """The match with the most recent revision (see find)."""
+        result_set = self.find(doctype, query, newest_first=True, **search_kwargs)
+
+        # Usually only the first match is loaded. Matches without a
+        # revision in the index must be loaded to compare their
+        # revision.
         result: DocumentWrapper | None = None
-        for match in self._find_matches(doctype, search_kwargs):
-            maybe_result = self.get(match.head)
+        for item in result_set.matches():
+            if result is not None and item.head_rev is not None:
+                continue
+
+            maybe_result = self.get(item.head)
             if result is None or maybe_result.head_rev > result.head_rev:
                 result = maybe_result
 
         return result
 
 
-def _verify_doc_changes(doc: schemas.BaseDocument, changes: list[schemas.Change]):
-    doc_from_scratch = docdiff.build_document(changes)
-    assert doc == doc_from_scratch, doc == doc_from_scratch
+class ResultSet:
+    """Lazily loaded documents of the matches of DataAccessLayer.find.
+
+    While iterating, the documents of the next dal.prefetch matches
+    are loaded concurrently.
+    """
+
+    def __init__(self, dal: DataAccessLayer, items: list[indexing.HeadItem]) -> None:
+        self._dal   = dal
+        self._items = items
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def matches(self) -> typ.Iterator[indexing.HeadItem]:
+        return iter(self._items)
+
+    def first(self) -> DocumentWrapper | None:
+        if self._items:
+            return self._dal.get(self._items[0].head)
+        else:
+            return None
+
+    def __iter__(self) -> typ.Iterator[DocumentWrapper]:
+        prefetch = self._dal.prefetch
+        if prefetch <= 0:
+            for item in self._items:
+                yield self._dal.get(item.head)
+            return
+
+        executor = self._dal._get_executor()
+        items    = iter(self._items)
+        pending: collections.deque[concurrent.futures.Future[DocumentWrapper]] = collections.deque()
+        try:
+            while True:
+                while len(pending) < prefetch + 1:
+                    next_item: indexing.HeadItem | None = next(items, None)
+                    if next_item is None:
+                        break
+                    pending.append(executor.submit(self._dal.get, next_item.head))
+
+                if not pending:
+                    return
+
+                yield pending.popleft().result()
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+def _is_valid_snapshot(snapshot: schemas.Snapshot | None, change: schemas.Change) -> bool:
+    # A snapshot is only used if it matches the (verified) change of the
+    # chain, and if its content wasn't modified since it was written.
+    return (
+        snapshot is not None
+        and snapshot.change_id == change.change_id
+        and snapshot.rev       == change.rev
+        and snapshot.doctype   == change.doctype
+        and snapshot.doc_hash  == schemas.snapshot_doc_hash(snapshot.doc)
+    )
+
+
+def _walk_chain(
+    change_id: schemas.ChangeId,
+    changes  : dict[schemas.ChangeId, schemas.Change],
+    snapshots: dict[schemas.ChangeId, schemas.Snapshot],
+    walked   : list[schemas.Change],
+) -> tuple[schemas.ChangeId, schemas.Snapshot | None]:
+    """Walk the chain from change_id as far as changes were read.
+
+    Returns the change_id where the walk stopped: the first change
+    which was not read (yet), or the last change of the document (with
+    its snapshot, if any).
+    """
+    while change_id in changes:
+        change = changes[change_id]
+        walked.append(change)
+
+        snapshot = snapshots.get(change_id)
+        if _is_valid_snapshot(snapshot, change):
+            return change_id, snapshot
+        elif change.opcode == docdiff.OP_RESET or change.parent_id is None:
+            break
+        else:
+            change_id = change.parent_id
+
+    return change_id, None
+
+
+def _build_loaded(
+    head  : schemas.ChangeId,
+    walked: list[schemas.Change],
+    base  : schemas.Snapshot | None,
+) -> _LoadedDocument | LoadError:
+    # the change of the base snapshot is only walked for verification
+    head_changes = sorted(walked[:-1] if base else walked)
+    try:
+        doc = docdiff.build_document(head_changes, base=base)
+    except Exception as err:
+        return LoadError(f"Invalid document {head}: {err}")
+    else:
+        return (doc, head_changes, base)
+
+
+class _VerifiedState(typ.NamedTuple):
+    # document after applying the first num_changes changes (after the base)
+    doc        : schemas.BaseDocument
+    num_changes: int
+
+
+def _replay_doc_changes(
+    changes : list[schemas.Change],
+    base    : schemas.Snapshot | None = None,
+    verified: _VerifiedState | None = None,
+) -> _VerifiedState:
+    """The document which is the result of applying changes to base.
+
+    Only the changes after those that were already applied are applied.
+    """
+    if verified is None:
+        old_doc_kw  = {} if base is None else base.doc
+        new_changes = changes
+    else:
+        old_doc_kw  = verified.doc.dict()
+        new_changes = changes[verified.num_changes :]
+
+    if new_changes or verified is None:
+        if changes:
+            doctype = changes[-1].doctype
+        else:
+            assert base is not None
+            doctype = base.doctype
+
+        ops        = [docdiff.Operation(change.opcode, change.opdata) for change in new_changes]
+        new_doc_kw = docdiff.apply_diffs(old_doc_kw, ops)
+        doc_from_changes = schemas.load_doctype_class(doctype)(**new_doc_kw)
+    else:
+        doc_from_changes = verified.doc
+
+    return _VerifiedState(doc_from_changes, len(changes))
+
+
+def _verify_doc_changes(
+    doc     : schemas.BaseDocument,
+    changes : list[schemas.Change],
+    base    : schemas.Snapshot | None = None,
+    verified: _VerifiedState | None = None,
+) -> _VerifiedState:
+    """Verify that doc is the result of applying changes to base.
+
+    The returned state holds the document built from the changes, not
+    doc, so that later modifications of doc don't affect it.
+    """
+    replayed = _replay_doc_changes(changes, base, verified)
+    assert doc == replayed.doc, doc == replayed.doc
+    return replayed
 
 
 class DocumentWrapper:
@@ -96,6 +753,7 @@ class DocumentWrapper:
     head_rev   : schemas.Revision
     changes    : list[schemas.Change]
     tmp_changes: list[schemas.Change]
+    base       : schemas.Snapshot | None
 
     def __init__(
         self,
@@ -103,23 +761,49 @@ class DocumentWrapper:
         doc        : schemas.BaseDocument,
         changes    : list[schemas.Change],
         tmp_changes: list[schemas.Change],
+        base       : schemas.Snapshot | None = None,
+        verified   : _VerifiedState | None = None,
     ) -> None:
+        """Wrapper for a document at its head.
+
+        If base is given, changes are only those after the base snapshot.
+        Depending on dal.verify_mode, the document is verified against
+        the changes which were not verified before.
+        """
         self._dal = dal
         self.doc  = doc
 
         all_changes = sorted(changes + tmp_changes)
 
-        self.head     = all_changes[-1].change_id
-        self.head_rev = all_changes[-1].rev
+        parent = all_changes[-1] if all_changes else base
+        assert parent is not None, "Either changes or base are required"
+
+        self.head     = parent.change_id
+        self.head_rev = parent.rev
 
         self.changes     = changes
         self.tmp_changes = tmp_changes
+        self.base        = base
+
+        self._all_changes = all_changes
+        self._verified    = verified
+        if dal.verify_mode == VERIFY_ALWAYS:
+            self._verify()
 
-        _verify_doc_changes(self.doc, all_changes)
+    def _verify(self) -> None:
+        self._verified = _verify_doc_changes(self.doc, self._all_changes, self.base, self._verified)
+
+    @property
+    def _parent(self) -> schemas.Change | schemas.Snapshot:
+        all_changes = self.changes + self.tmp_changes
+        if all_changes:
+            return all_changes[-1]
+        else:
+            assert self.base is not None
+            return self.base
 
     def update(self, **updated_doc_kwargs) -> DocumentWrapper:
-        wif = self._dal.wif
-        if wif is None:
+        if self._dal.wif is None:
             raise Exception("A 'wif' needed to update a document.")
 
         doctype = schemas.get_doctype(self.doc)
@@ -129,40 +813,181 @@ class DocumentWrapper:
         for key, val in updated_doc_kwargs.items():
             new_doc_kw[key] = val
 
-        op     = docdiff.make_diff(old_doc_kw, new_doc_kw)
-        parent = (self.changes + self.tmp_changes)[-1]
-
-        change = docdiff.make_change(
-            doctype=doctype,
-            op=op,
-            parent=parent,
-            wif=wif,
-            difficulty=self._dal.difficulty,
+        parent = self._parent
+        ops    = docdiff.make_diffs(
+            old_doc_kw,
+            new_doc_kw,
+            force_reset=self._dal._is_reset_due(parent),
+            max_op_size=self._dal.max_op_size,
         )
+        changes = self._dal._make_changes(doctype, ops, parent=parent)
 
-        new_doc = docdiff.doc_patch(self.doc, op=op)
+        new_doc = docdiff.doc_patch(self.doc, *ops)
         return DocumentWrapper(
             dal=self._dal,
             doc=new_doc,
             changes=self.changes,
-            tmp_changes=self.tmp_changes + [change],
+            tmp_changes=self.tmp_changes + changes,
+            base=self.base,
+            verified=self._verified,
         )
 
     def save(self) -> DocumentWrapper:
-        # TODO (mb 2022-08-19): also post to DHT
-        for change in self.tmp_changes:
-            self._dal.kvstore.post(change)
+        verify_mode = self._dal.verify_mode
+        if verify_mode in (VERIFY_ALWAYS, VERIFY_ON_SAVE):
+            # with VERIFY_ALWAYS, the doc may have been modified since the wrapper was created
+            self._verify()
+        elif verify_mode == VERIFY_SAMPLED and random.random() < self._dal.verify_sample_rate:
+            self._verify()
 
-        indexing.update_indexes(self.head, self.doc)
+        # TODO (mb 2022-08-19): also post to DHT
+        self._dal.kvstore.post_many(self.tmp_changes)
+
+        verified = self._verified
+        if self.tmp_changes and self._dal._is_snapshot_rev(self.head_rev):
+            # The snapshot is built from the changes rather than from
+            # self.doc, which user code may have modified directly.
+            verified = _replay_doc_changes(self._all_changes, self.base, verified)
+            snapshot = schemas.make_snapshot(
+                change_id=self.head,
+                rev=self.head_rev,
+                doctype=schemas.get_doctype(verified.doc),
+                doc=verified.doc.dict(),
+            )
+            self._dal.kvstore.post_snapshot(snapshot)
+
+        if self.tmp_changes:
+            # the head which this save supersedes, for a new document its
+            # first change identifies it (as for reindex.rebuild_indexes)
+            replaces = self.tmp_changes[0].parent_id
+            doc_id   = self.tmp_changes[0].change_id if replaces is None else None
+            self._dal.indexes.update(
+                self.head, self.doc, replaces=replaces, head_rev=self.head_rev, doc_id=doc_id
+            )
 
         return DocumentWrapper(
             dal=self._dal,
             doc=self.doc,
             changes=self.changes + self.tmp_changes,
             tmp_changes=[],
+            base=self.base,
+            verified=verified,
         )
 
     def __eq__(self, other: object) -> bool:
         return isinstance(other, DocumentWrapper) and self.head == other.head
 
     # TODO (mb 2022-08-19): getattr and setattr
+
+
+_LoadResult = _LoadedDocument | Exception
+
+
+class AsyncDataAccessLayer:
+    """asyncio API for a DataAccessLayer.
+
+    Requests for the same head are coalesced and heads which are
+    requested while the event loop runs the same iteration are loaded
+    in a single batch. Loading (reading, verifying and building
+    documents) and saving happen in an executor, so that the event
+    loop is not blocked.
+    """
+
+    def __init__(self, dal: DataAccessLayer, workers: int = DEFAULT_ASYNC_WORKERS) -> None:
+        self.dal = dal
+
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers))
+        self._pending : dict[schemas.ChangeId, asyncio.Future[_LoadedDocument]] = {}
+        self._batch   : list[schemas.ChangeId] = []
+
+    async def __aenter__(self) -> AsyncDataAccessLayer:
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.aclose()
+
+    def close(self) -> None:
+        """Shut down the executor (the dal is not closed)."""
+        self._executor.shutdown()
+
+    async def aclose(self) -> None:
+        """Shut down the executor without blocking the event loop."""
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self._executor.shutdown)
+
+    def _load_batch(self, heads: list[schemas.ChangeId]) -> list[_LoadResult]:
+        loaded = self.dal._get_loaded_many(heads)
+        return [loaded[head] for head in heads]
+
+    def _flush(self) -> None:
+        heads = self._batch
+        self._batch = []
+        if heads:
+            loop = asyncio.get_running_loop()
+            task = loop.run_in_executor(self._executor, self._load_batch, heads)
+            task.add_done_callback(lambda task: self._resolve(heads, task))
+
+    def _resolve(self, heads: list[schemas.ChangeId], task: asyncio.Future[list[_LoadResult]]) -> None:
+        results: list[_LoadResult | BaseException]
+        if task.cancelled():
+            results = [asyncio.CancelledError()] * len(heads)
+        elif (exc := task.exception()) is not None:
+            results = [exc] * len(heads)
+        else:
+            results = list(task.result())
+
+        for head, result in zip(heads, results):
+            future = self._pending.pop(head)
+            if future.done():
+                continue
+            elif isinstance(result, BaseException):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    def _request(self, head: schemas.ChangeId) -> asyncio.Future[_LoadedDocument]:
+        future = self._pending.get(head)
+        if future is None:
+            loop   = asyncio.get_running_loop()
+            future = loop.create_future()
+            self._pending[head] = future
+            if not self._batch:
+                loop.call_soon(self._flush)
+            self._batch.append(head)
+        return future
+
+    async def get(self, head: schemas.ChangeId) -> DocumentWrapper:
+        # The future is shielded, so that a cancelled request doesn't
+        # cancel coalesced requests.
+        loaded = await asyncio.shield(self._request(head))
+        return self.dal._wrap(*loaded)
+
+    async def get_many(self, heads: typ.Iterable[schemas.ChangeId]) -> list[DocumentWrapper]:
+        # all heads are requested before awaiting, so they're in the same batch
+        futures = [asyncio.shield(self._request(head)) for head in heads]
+        return [self.dal._wrap(*loaded) for loaded in await asyncio.gather(*futures)]
+
+    async def find(
+        self,
+        doctype     : str,
+        query       : dict[str, str] | None = None,
+        *,
+        limit       : int | None = None,
+        offset      : int        = 0,
+        newest_first: bool       = False,
+        **search_kwargs,
+    ) -> list[DocumentWrapper]:
+        """Documents which match all search_kwargs (see DataAccessLayer.find)."""
+        loop = asyncio.get_running_loop()
+
+        def _query() -> ResultSet:
+            return self.dal.find(
+                doctype, query, limit=limit, offset=offset, newest_first=newest_first, **search_kwargs
+            )
+
+        result_set = await loop.run_in_executor(self._executor, _query)
+        return await self.get_many(item.head for item in result_set.matches())
+
+    async def save(self, doc_wrp: DocumentWrapper) -> DocumentWrapper:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, doc_wrp.save)
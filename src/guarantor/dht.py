@@ -1,10 +1,14 @@
+import time
 import random
+import asyncio
+import typing as typ
 import logging
 import binascii
 
 from kademlia.utils import digest
 from kademlia.storage import ForgetfulStorage
 
+from guarantor import crypto
 from guarantor import schemas
 
 logger = logging.getLogger("guarantor.dht")
@@ -26,36 +30,113 @@ def get_distance(digest_a, digest_b) -> int:
     return bin_to_int(digest_a) ^ bin_to_int(digest_b)
 
 
+# Changes stored by the DHT protocol (i.e. in an event loop) are
+# buffered for up to INGEST_DELAY seconds, or until INGEST_BATCH_SIZE
+# changes are pending, so that they are verified as a batch (see
+# ChangeStorage.set_many).
+INGEST_DELAY      = 0.05
+INGEST_BATCH_SIZE = 1000
+
+
 class ChangeStorage(ForgetfulStorage):
-    def __init__(self, ttl=604800, max_entries=1000000, node_id=None):
+    def __init__(
+        self, ttl=604800, max_entries=1000000, node_id=None, verify_workers=crypto.DEFAULT_VERIFY_WORKERS
+    ):
         super().__init__(ttl=ttl)
 
-        self.max_entries = max_entries
-        self.node_id     = node_id  # needed for value metric
+        self.max_entries    = max_entries
+        self.node_id        = node_id  # needed for value metric
+        self.verify_workers = verify_workers
         assert self.node_id is not None, "Missing required node_id!"
 
-    def __setitem__(self, key, value):
-
-        # drop invalid changes
-        try:
-            change = schemas.loads_change(value)
+        self.ingest_delay      = INGEST_DELAY
+        self.ingest_batch_size = INGEST_BATCH_SIZE
 
-            if digest(change.change_id) != key:
-                logger.warning(f"Change key missmatch: {digest(change.change_id)} != {key}")
-                return
+        self._pending     : list[tuple[bytes, bytes]]  = []
+        self._flush_handle: asyncio.TimerHandle | None = None
 
-        except schemas.VerificationError:
-            logger.warning(f"Invalid change: {value}")
+    def __setitem__(self, key, value):
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # not called by the DHT protocol, store right away
+            self.set_many([(key, value)])
             return
 
-        super().__setitem__(key, value)
-
-    def cull(self):
+        self._pending.append((key, value))
+        if len(self._pending) >= self.ingest_batch_size:
+            self.flush()
+        elif self._flush_handle is None:
+            self._flush_handle = loop.call_later(self.ingest_delay, self.flush)
+
+    def flush(self) -> int:
+        """Store the pending changes, returns the number of changes stored."""
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+
+        pending, self._pending = self._pending, []
+        return self.set_many(pending) if pending else 0
+
+    def get(self, key, default=None):
+        self.flush()
+        return super().get(key, default)
+
+    def __getitem__(self, key):
+        self.flush()
+        return super().__getitem__(key)
+
+    def __iter__(self):
+        self.flush()
+        return super().__iter__()
+
+    def set_many(self, items: typ.Iterable[tuple[bytes, bytes]]) -> int:
+        """Store a batch of changes, returns the number of changes stored.
+
+        Invalid changes are dropped (each on its own, the rest of the
+        batch is stored). The signatures of the batch are verified
+        together (see schemas.verify_changes), using a pool of
+        `verify_workers` processes.
+        """
+        entries: list[tuple[bytes, bytes, schemas.Change]] = []
+        for key, value in items:
+            try:
+                change = schemas.loads_change(value, verify=False)
+            except (ValueError, TypeError) as err:
+                logger.warning(f"Invalid change data for key {key.hex()}: {err}")
+                continue
+
+            change_digest = digest(change.change_id)
+            if change_digest == key:
+                entries.append((key, value, change))
+            else:
+                logger.warning(f"Change key missmatch: {change_digest.hex()} != {key.hex()}")
+
+        changes = [change for _, _, change in entries]
+        results = schemas.verify_changes(changes, workers=self.verify_workers)
+
+        num_stored = 0
+        for (key, value, _), is_valid in zip(entries, results):
+            # drop invalid changes
+            if not is_valid:
+                logger.warning(f"Invalid change: {value!r}")
+                continue
+
+            if key in self.data:
+                del self.data[key]
+            self.data[key] = (time.monotonic(), value)
+            num_stored += 1
+
+        self.cull()
+        return num_stored
+
+    def cull(self) -> None:
         entries = []
         for key, pair in self.data.items():
             _, value = pair
 
-            change                = schemas.loads_change(value)
+            # Entries are verified when they are set.
+            change                = schemas.loads_change(value, verify=False)
             difficulty            = schemas.get_pow_difficulty(change.change_id, change.proof_of_work)
             change_address_digest = digest(change.address)
             dist_key              = get_distance(key                  , self.node_id)
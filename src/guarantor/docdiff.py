@@ -3,7 +3,7 @@
 #
 # Copyright (c) 2022 xkudev (xkudev@pm.me) - MIT License
 # SPDX-License-Identifier: MIT
-import copy
+import json
 import typing as typ
 import logging
 
@@ -16,14 +16,24 @@ logger = logging.getLogger(__name__)
 WIF = typ.Any
 
 
-Path = str
+Path = list[str | int]
 
 
+# opdata of the different operations
+#   OP_RESET    : the full document
+#   OP_DICT_DIFF: {'diff': [[action, path, changes], ...]} (see dictdiffer)
+#   OP_SET      : {'path': path, 'value': value}
+#   OP_DEL      : {'path': path}
+
 OP_RESET     = "reset"
 OP_DICT_DIFF = "dictdiff"
 OP_SET       = "set"
 OP_DEL       = "del"
 
+# Operations (serialized as json) larger than this are split into
+# multiple operations by make_diffs.
+DEFAULT_MAX_OP_SIZE = 64 * 1024
+
 
 class Operation(typ.NamedTuple):
     opcode: str
@@ -31,11 +41,12 @@ class Operation(typ.NamedTuple):
 
 
 def make_change(
-    doctype   : schemas.DocType,
-    op        : Operation,
-    parent    : schemas.Change | None,
-    wif       : str,
-    difficulty: int = schemas.DEFAULT_DIFFICULTY_BITS,
+    doctype    : schemas.DocType,
+    op         : Operation,
+    parent     : schemas.Change | schemas.Snapshot | None,
+    wif        : str,
+    difficulty : int = schemas.DEFAULT_DIFFICULTY_BITS,
+    pow_workers: int = schemas.DEFAULT_POW_WORKERS,
 ) -> schemas.Change:
     return schemas.make_change(
         wif=wif,
@@ -45,52 +56,262 @@ def make_change(
         parent_id=None if parent  is None else parent.change_id,
         parent_rev=None if parent is None else parent.rev,
         difficulty=difficulty,
+        pow_workers=pow_workers,
     )
 
 
-def apply_diffs(old_doc_kw: dict, diff: list[Operation]) -> dict:
-    new_doc_kw = copy.deepcopy(old_doc_kw)
-    for op in diff:
+def _lookup(doc_kw: dict, path: Path) -> typ.Any:
+    obj: typ.Any = doc_kw
+    for key in path:
+        obj = obj[key]
+    return obj
+
+
+def _node_path(node: str | list) -> Path:
+    # dictdiffer uses dotted strings for paths, unless a key contains a "."
+    if isinstance(node, list):
+        return node
+    elif node == "":
+        return []
+    else:
+        return typ.cast(Path, node.split("."))
+
+
+class _Replay:
+    """Apply operations to a working document without copying it.
+
+    Containers are copied (shallow) only on the first write to them, all
+    other containers are shared with the input document and the opdata of
+    the operations, neither of which are ever mutated.
+    """
+
+    def __init__(self, doc_kw: dict) -> None:
+        self.doc_kw = doc_kw
+        # Containers which were copied by the replay and which can thus be
+        # mutated. They are referenced here, so their ids stay unique.
+        self._owned: dict[int, dict | list] = {}
+
+    def _own(self, obj: typ.Any) -> typ.Any:
+        if id(obj) in self._owned:
+            return obj
+
+        obj_copy = obj.copy()
+        self._owned[id(obj_copy)] = obj_copy
+        return obj_copy
+
+    def _container(self, path: Path) -> typ.Any:
+        """Container at path, which may be mutated."""
+        self.doc_kw = self._own(self.doc_kw)
+
+        obj = self.doc_kw
+        for key in path:
+            child    = self._own(obj[key])
+            obj[key] = child
+            obj      = child
+        return obj
+
+    def _apply_dictdiff_entry(self, action: str, path: Path, changes: list) -> None:
+        if action == 'change':
+            *parent_path, key = path
+            self._container(parent_path)[key] = changes[1]
+        elif action == 'add':
+            container = self._container(path)
+            for key, val in changes:
+                if isinstance(container, list):
+                    container.insert(key, val)
+                else:
+                    container[key] = val
+        elif action == 'remove':
+            container = self._container(path)
+            for key, _ in changes:
+                del container[key]
+        else:
+            raise NotImplementedError(f"dictdiff action={action}")
+
+    def apply(self, op: Operation) -> None:
         if op.opcode == OP_RESET:
-            new_doc_kw = op.opdata
+            self.doc_kw = op.opdata
+            self._owned.clear()
         elif op.opcode == OP_DICT_DIFF:
-            new_doc_kw = dictdiffer.patch(op.opdata, new_doc_kw)
+            for action, node, changes in op.opdata['diff']:
+                self._apply_dictdiff_entry(action, _node_path(node), changes)
+        elif op.opcode == OP_SET:
+            *parent_path, key = op.opdata['path']
+            self._container(parent_path)[key] = op.opdata['value']
+        elif op.opcode == OP_DEL:
+            *parent_path, key = op.opdata['path']
+            del self._container(parent_path)[key]
         else:
             errmsg = f"doc_patch not implemended for opcode={op.opcode}"
             raise NotImplementedError(errmsg)
 
-    return new_doc_kw
+
+def apply_diffs(old_doc_kw: dict, diff: list[Operation]) -> dict:
+    """Apply operations to old_doc_kw.
+
+    Neither old_doc_kw nor the operations are mutated. The returned dict
+    may share unmodified containers with them, so it must not be mutated
+    either (pydantic models constructed from it are fine).
+    """
+    replay = _Replay(old_doc_kw)
+    for op in diff:
+        replay.apply(op)
+    return replay.doc_kw
 
 
-def doc_patch(old_doc: schemas.BaseDocument, op: Operation) -> schemas.BaseDocument:
-    new_doc_kw = apply_diffs(old_doc.dict(), [op])
+def doc_patch(old_doc: schemas.BaseDocument, *ops: Operation) -> schemas.BaseDocument:
+    new_doc_kw = apply_diffs(old_doc.dict(), list(ops))
     doc_class  = old_doc.__class__
     return doc_class(**new_doc_kw)
 
 
-def make_diff(old_doc_kw: dict, new_doc_kw: dict) -> Operation:
-    # TODO (mb 2022-08-19): More efficient diff operations (and possibly also do chunking
-    #   here so lower layers don't need to deal with huge changes).
-    #
-    # pylint: disable=unused-argument ; <- remove when TODO is done
+def _op_size(op: Operation) -> int:
+    return len(json.dumps(op.opdata))
+
+
+def _compact_diff(dd_diff: list) -> list:
+    # Old values are only needed to revert a diff, not to apply it.
+    compact_diff = []
+    for action, node, changes in dd_diff:
+        path = _node_path(node)
+        if action == 'change':
+            changes = [None, changes[1]]
+        elif action == 'remove':
+            changes = [[key, None] for key, _ in changes]
+        compact_diff.append([action, path, changes])
+    return compact_diff
+
 
-    diff_op = Operation(opcode=OP_RESET, opdata=new_doc_kw)
+def _simple_op(old_doc_kw: dict, diff: list) -> Operation | None:
+    if len(diff) != 1:
+        return None
 
-    #
-    # import json
-    # try:
-    #     dd_diff = list(dictdiffer.diff(old_doc_kw, new_doc_kw))
-    #     dd_diff = json.loads(json.dumps(dd_diff))
-    #     maybe_op = Operation(opcode=OP_DICT_DIFF, data=dd_diff)
-    #     is_valid_op = apply_diffs(old_doc_kw, [maybe_op]) == new_doc_kw
-    #     if is_valid_op:
-    #         diff_op = maybe_op
-    #     else:
-    #         logger.warning("dictdiffer failed")
-    # except ValueError:
-    #     raise
+    action, path, changes = diff[0]
+    if action == 'change':
+        parent_path = path[:-1]
+    elif len(changes) == 1:
+        parent_path = path
+        path        = path + [changes[0][0]]
+    else:
+        return None
 
-    return diff_op
+    if not isinstance(_lookup(old_doc_kw, parent_path), dict):
+        return None  # list insert/delete semantics differ from OP_SET/OP_DEL
+
+    if action == 'change':
+        return Operation(OP_SET, {'path': path, 'value': changes[1]})
+    elif action == 'add':
+        return Operation(OP_SET, {'path': path, 'value': changes[0][1]})
+    else:
+        return Operation(OP_DEL, {'path': path})
+
+
+def make_diff(old_doc_kw: dict, new_doc_kw: dict, force_reset: bool = False) -> Operation:
+    """Create the most compact operation to go from old_doc_kw to new_doc_kw.
+
+    Falls back to OP_RESET if a diff isn't smaller than the new
+    document or if it doesn't reproduce new_doc_kw exactly.
+    """
+    reset_op = Operation(opcode=OP_RESET, opdata=new_doc_kw)
+    if force_reset:
+        return reset_op
+
+    try:
+        dd_diff = json.loads(json.dumps(list(dictdiffer.diff(old_doc_kw, new_doc_kw))))
+    except (TypeError, ValueError):
+        logger.warning("dictdiffer failed", exc_info=True)
+        return reset_op
+
+    diff    = _compact_diff(dd_diff)
+    diff_op = _simple_op(old_doc_kw, diff) or Operation(OP_DICT_DIFF, {'diff': diff})
+
+    if _op_size(diff_op) >= _op_size(reset_op):
+        return reset_op
+
+    is_valid_op = apply_diffs(old_doc_kw, [diff_op]) == new_doc_kw
+    if is_valid_op:
+        return diff_op
+    else:
+        logger.warning("dictdiffer failed")
+        return reset_op
+
+
+def _chunk_set(path: Path, val: typ.Any, max_op_size: int) -> list[Operation]:
+    op = Operation(OP_SET, {'path': path, 'value': val})
+    if isinstance(val, dict) and val and _op_size(op) > max_op_size:
+        ops = [Operation(OP_SET, {'path': path, 'value': {}})]
+        for key, sub_val in val.items():
+            ops.extend(_chunk_set(path + [key], sub_val, max_op_size))
+        return ops
+    else:
+        return [op]
+
+
+def _chunk_reset(op: Operation, max_op_size: int) -> list[Operation]:
+    reset_kw  : dict = {}
+    reset_size = 2
+    set_ops   : list[Operation] = []
+    for key, val in op.opdata.items():
+        item_size = len(json.dumps({key: val}))
+        if reset_size + item_size <= max_op_size:
+            reset_kw[key] = val
+            reset_size += item_size
+        else:
+            set_ops.extend(_chunk_set([key], val, max_op_size))
+    return [Operation(OP_RESET, reset_kw)] + set_ops
+
+
+def _chunk_dict_diff(op: Operation, max_op_size: int) -> list[Operation]:
+    # split add/remove entries into one entry per item
+    entries = []
+    for action, path, changes in op.opdata['diff']:
+        if action == 'change':
+            entries.append([action, path, changes])
+        else:
+            entries.extend([action, path, [change]] for change in changes)
+
+    ops: list[Operation] = []
+    chunk: list  = []
+    chunk_size   = 0
+    for entry in entries:
+        entry_size = len(json.dumps(entry))
+        if chunk and chunk_size + entry_size > max_op_size:
+            ops.append(Operation(OP_DICT_DIFF, {'diff': chunk}))
+            chunk      = []
+            chunk_size = 0
+        chunk.append(entry)
+        chunk_size += entry_size
+
+    if chunk:
+        ops.append(Operation(OP_DICT_DIFF, {'diff': chunk}))
+    return ops
+
+
+def make_diffs(
+    old_doc_kw : dict,
+    new_doc_kw : dict,
+    force_reset: bool = False,
+    max_op_size: int  = DEFAULT_MAX_OP_SIZE,
+) -> list[Operation]:
+    """Like make_diff, but large operations are split into chunks.
+
+    The chunks are applied in order (one change per chunk), so that
+    lower layers don't need to deal with huge changes. A single item
+    that is larger than max_op_size is not split further.
+    """
+    op = make_diff(old_doc_kw, new_doc_kw, force_reset=force_reset)
+    if _op_size(op) <= max_op_size:
+        return [op]
+
+    if op.opcode == OP_RESET:
+        ops = _chunk_reset(op, max_op_size)
+    elif op.opcode == OP_DICT_DIFF:
+        ops = _chunk_dict_diff(op, max_op_size)
+    else:
+        ops = [op]
+
+    assert apply_diffs(old_doc_kw, ops) == new_doc_kw
+    return ops
 
 
 def doc_diff(old: schemas.BaseDocument, new: schemas.BaseDocument) -> Operation:
@@ -99,12 +320,21 @@ def doc_diff(old: schemas.BaseDocument, new: schemas.BaseDocument) -> Operation:
     return make_diff(old_doc_kw, new_doc_kw)
 
 
-def build_document(changes: list[schemas.Change]) -> schemas.BaseDocument:
+def build_document(
+    changes: list[schemas.Change],
+    base   : schemas.Snapshot | None = None,
+) -> schemas.BaseDocument:
+    """Build document from changes (which are applied to the base snapshot)."""
     changes.sort()
 
     full_diff: list[Operation] = [Operation(change.opcode, change.opdata) for change in changes]
-    full_doc = apply_diffs(old_doc_kw={}, diff=full_diff)
+    full_doc = apply_diffs(old_doc_kw={} if base is None else base.doc, diff=full_diff)
+
+    if changes:
+        doctype_str = changes[-1].doctype
+    else:
+        assert base is not None
+        doctype_str = base.doctype
 
-    doctype_str   = changes[-1].doctype
     doctype_class = schemas.load_doctype_class(doctype_str)
     return doctype_class(**full_doc)
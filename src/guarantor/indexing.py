@@ -3,11 +3,17 @@
 #
 # Copyright (c) 2022 xkudev (xkudev@pm.me) - MIT License
 # SPDX-License-Identifier: MIT
+import os
+import fcntl
+import heapq
 import bisect
 import typing as typ
-import collections
+import pathlib as pl
+import itertools
+import threading
+import contextlib
 
-import sortedcontainers
+import orjson
 
 from guarantor import schemas
 
@@ -72,6 +78,11 @@ class IndexItem(typ.NamedTuple):
     head: schemas.ChangeId
 
 
+class HeadItem(typ.NamedTuple):
+    head    : schemas.ChangeId
+    head_rev: schemas.Revision | None  # None if it is not in the index
+
+
 class MatchItem(typ.NamedTuple):
     stem   : str
     head   : schemas.ChangeId
@@ -79,34 +90,539 @@ class MatchItem(typ.NamedTuple):
     field  : str
 
 
+# Number of journal entries after which the term file of an index is rewritten.
+DEFAULT_COMPACT_THRESHOLD = 10_000
+
+# Maximum number of items in the memtable of an index.
+DEFAULT_MEMTABLE_SIZE = 4096
+
+TERMS_SUFFIX   = ".terms"
+JOURNAL_SUFFIX = ".journal"
+
+JOURNAL_OP_ADD    = "+"
+JOURNAL_OP_REMOVE = "-"
+
+
+def _journal_entry(op: str, item: IndexItem) -> bytes:
+    return orjson.dumps([op, item.stem, item.head], option=orjson.OPT_APPEND_NEWLINE)
+
+
+@contextlib.contextmanager
+def _flock(fobj: typ.BinaryIO, operation: int) -> typ.Iterator[None]:
+    fcntl.flock(fobj.fileno(), operation)
+    try:
+        yield
+    finally:
+        fcntl.flock(fobj.fileno(), fcntl.LOCK_UN)
+
+
 class Index:
-    def __init__(self):
-        self._items         = sortedcontainers.SortedList()
-        self._pending_items = []
+    """Sorted (term, head) items of one field of a doctype.
+
+    In memory, items are kept in sorted lists (LSM style): new items are
+    added to a small memtable, which becomes a new run when it has more
+    than memtable_size items. Runs of similar size are merged, so there
+    are O(log n) runs. Removed items are recorded as tombstones until
+    all runs are merged. Queries are prefix scans over all runs.
+
+    With a path, the index is persisted in two files: a term file with
+    all items (in sorted order, as a JSON array), and a journal with the
+    items added or removed since the term file was written (as JSON
+    lines). The journal is merged into the term file when it has more
+    than compact_threshold entries, or when an index which added or
+    removed items is closed.
+
+    Multiple processes may use the same files. Entries are appended to
+    the journal with a shared lock (flock), compaction holds an exclusive
+    lock and merges the files as they are on disk (rather than the items
+    in memory), so that entries of other processes are not lost.
+
+    The terms of each head are tracked, so that the items of a head
+    which was superseded by a newer head can be removed.
+    """
+
+    def __init__(
+        self,
+        path             : pl.Path | None = None,
+        compact_threshold: int            = DEFAULT_COMPACT_THRESHOLD,
+        memtable_size    : int            = DEFAULT_MEMTABLE_SIZE,
+    ) -> None:
+        self.path              = path
+        self.compact_threshold = compact_threshold
+        self.memtable_size     = memtable_size
+
+        self._lock       = threading.Lock()
+        self._runs      : list[list[IndexItem]] = []
+        self._num_items  = 0  # items in all runs (including removed items)
+        self._memtable  : list[IndexItem] = []
+        self._tombstones: set[IndexItem] = set()
+        self._head_terms: dict[schemas.ChangeId, set[str]] = {}
+
+        self._journal: typ.BinaryIO | None = None
+        self._journal_entries = 0  # entries in the journal file
+        self._num_appended    = 0  # entries appended by this index since the last compaction
+
+        if path is not None:
+            self._load(path)
+
+    def _load(self, path: pl.Path) -> None:
+        journal_path = path.with_name(path.name + JOURNAL_SUFFIX)
+
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._journal = journal_path.open(mode="ab")
+        with _flock(self._journal, fcntl.LOCK_EX):
+            valid_size = self._read_files(path)
+            # Nobody appends while the exclusive lock is held, so an
+            # incomplete last entry is from a writer that crashed.
+            if journal_path.stat().st_size > valid_size:
+                self._journal.truncate(valid_size)
+
+    def _read_files(self, path: pl.Path) -> int:
+        """Add the items of the term file and the journal, returns the valid size of the journal."""
+        terms_path   = path.with_name(path.name + TERMS_SUFFIX)
+        journal_path = path.with_name(path.name + JOURNAL_SUFFIX)
+
+        if terms_path.exists():
+            # the term file is sorted, so it can be used as a run as is
+            run = [IndexItem(*item) for item in orjson.loads(terms_path.read_bytes())]
+            if run:
+                self._runs.append(run)
+                self._num_items = len(run)
+
+            for item in run:
+                self._head_terms.setdefault(item.head, set()).add(item.stem)
+
+        valid_size = 0
+        if journal_path.exists():
+            with journal_path.open(mode="rb") as fobj:
+                for line in fobj:
+                    if not line.endswith(b"\n"):
+                        break  # torn write
+                    try:
+                        op, term, head = orjson.loads(line)
+                    except (orjson.JSONDecodeError, ValueError, TypeError):
+                        break
+
+                    # Replaying the journal on top of a term file which
+                    # already contains its entries (see _compact) leads
+                    # to the same items.
+                    if op == JOURNAL_OP_REMOVE:
+                        self._remove_items([IndexItem(term, head)])
+                    else:
+                        self._add_items([IndexItem(term, head)])
+                    self._journal_entries += 1
+                    valid_size += len(line)
+
+        return valid_size
+
+    def _flush_memtable(self) -> None:
+        # NOTE: must be called with self._lock held
+        if not self._memtable:
+            return
+
+        self._runs.append(self._memtable)
+        self._num_items += len(self._memtable)
+        self._memtable = []
+
+        while len(self._runs) > 1 and len(self._runs[-1]) * 2 >= len(self._runs[-2]):
+            newer = self._runs.pop()
+            older = self._runs.pop()
+            # timsort merges two sorted runs in linear time.
+            self._runs.append(sorted(older + newer))
+
+    def _merge_all(self) -> None:
+        # NOTE: must be called with self._lock held
+        self._flush_memtable()
+
+        items: list[IndexItem] = []
+        prev : IndexItem | None = None
+        for item in heapq.merge(*self._runs):
+            if item != prev and item not in self._tombstones:
+                items.append(item)
+            prev = item
+
+        self._runs       = [items] if items else []
+        self._num_items  = len(items)
+        self._tombstones = set()
+
+    def _add_items(self, items: list[IndexItem]) -> None:
+        # NOTE: must be called with self._lock held
+        for item in items:
+            if item in self._tombstones:
+                # the item may still be in a run, in which case it is
+                # added again (the duplicate is ignored by queries)
+                self._tombstones.discard(item)
+
+            # The memtable is small enough for insort (which is
+            # implemented in C) to be faster than any tree structure.
+            idx = bisect.bisect_left(self._memtable, item)
+            if idx == len(self._memtable) or self._memtable[idx] != item:
+                self._memtable.insert(idx, item)
+            self._head_terms.setdefault(item.head, set()).add(item.stem)
+
+        if len(self._memtable) > self.memtable_size:
+            self._flush_memtable()
+
+    def _remove_items(self, items: list[IndexItem]) -> None:
+        # NOTE: must be called with self._lock held
+        for item in items:
+            idx = bisect.bisect_left(self._memtable, item)
+            if idx < len(self._memtable) and self._memtable[idx] == item:
+                del self._memtable[idx]
+            self._tombstones.add(item)
+
+            terms = self._head_terms.get(item.head)
+            if terms is not None:
+                terms.discard(item.stem)
+                if not terms:
+                    del self._head_terms[item.head]
+
+        if len(self._tombstones) * 8 > self._num_items + self.memtable_size:
+            self._merge_all()
+
+    def _compact(self) -> None:
+        # NOTE: must be called with self._lock held
+        assert self.path is not None
+        assert self._journal is not None
+
+        with _flock(self._journal, fcntl.LOCK_EX):
+            # The files contain all entries of this index (they're written
+            # before they're applied), as well as those of other processes.
+            merged = Index(memtable_size=self.memtable_size)
+            merged._read_files(self.path)
+            merged._merge_all()
+            items = merged._runs[0] if merged._runs else []
+
+            terms_path = self.path.with_name(self.path.name + TERMS_SUFFIX)
+            tmp_path   = self.path.with_name(self.path.name + TERMS_SUFFIX + ".tmp")
+            with tmp_path.open(mode="wb") as fobj:
+                fobj.write(orjson.dumps([list(item) for item in items]))
+                fobj.flush()
+                os.fsync(fobj.fileno())
+            os.replace(tmp_path, terms_path)
+
+            # If we crash before the journal is truncated, it is
+            # replayed again, which is harmless.
+            self._journal.truncate(0)
+
+        self._runs       = merged._runs
+        self._num_items  = merged._num_items
+        self._memtable   = []
+        self._tombstones = set()
+        self._head_terms = merged._head_terms
+
+        self._journal_entries = 0
+        self._num_appended    = 0
+
+    def _write_journal(self, op: str, items: list[IndexItem]) -> None:
+        # NOTE: must be called with self._lock held
+        if self._journal is not None and items:
+            with _flock(self._journal, fcntl.LOCK_SH):
+                self._journal.write(b"".join(_journal_entry(op, item) for item in items))
+                self._journal.flush()
+            self._journal_entries += len(items)
+            self._num_appended    += len(items)
+            if self._journal_entries > self.compact_threshold:
+                self._compact()
 
     def add(self, field_val: str, head: schemas.ChangeId) -> None:
-        for term in set(_iter_terms(field_val)):
-            item = IndexItem(term, head)
-            self._pending_items.append(item)
+        self.add_terms(set(_iter_terms(field_val)), head)
+
+    def add_terms(self, terms: typ.Iterable[str], head: schemas.ChangeId) -> None:
+        items = [IndexItem(term, head) for term in terms]
+        with self._lock:
+            self._add_items(items)
+            self._write_journal(JOURNAL_OP_ADD, items)
+
+    def terms(self, head: schemas.ChangeId) -> set[str]:
+        """All terms of head."""
+        with self._lock:
+            return set(self._head_terms.get(head, ()))
+
+    def remove(self, head: schemas.ChangeId) -> None:
+        """Remove all items of head."""
+        with self._lock:
+            terms = self._head_terms.get(head)
+            if terms is None:
+                return
+
+            items = [IndexItem(term, head) for term in terms]
+            self._remove_items(items)
+            self._write_journal(JOURNAL_OP_REMOVE, items)
 
     def find(self, search_term: str) -> typ.Iterator[IndexItem]:
-        if self._pending_items:
-            self._items.update(self._pending_items)
-            self._pending_items.clear()
-
-        idx = bisect.bisect_left(self._items, IndexItem(search_term, ""))
-        while idx < len(self._items):
-            item = self._items[idx]
-            if item.stem.startswith(search_term):
-                yield item
-                idx = idx + 1
+        start = IndexItem(search_term, "")
+        # Only terms which start with search_term followed by U+10FFFF
+        # can be after the end of the prefix range, these are picked up
+        # by _scan_run.
+        end = IndexItem(search_term + "\U0010ffff", "")
+
+        with self._lock:
+            matches = [
+                self._scan_run(run, search_term, start, end) for run in [self._memtable, *self._runs]
+            ]
+            matches = [run_matches for run_matches in matches if run_matches]
+
+            if len(matches) == 1:
+                items = matches[0]
             else:
-                break
+                items = sorted(itertools.chain(*matches))
+                # runs may contain the same item (if it was removed and added again)
+                items = [item for item, prev in zip(items, [None, *items]) if item != prev]
+
+            if self._tombstones:
+                items = [item for item in items if item not in self._tombstones]
+
+        return iter(items)
+
+    @staticmethod
+    def _scan_run(run: list[IndexItem], search_term: str, start: IndexItem, end: IndexItem) -> list[IndexItem]:
+        lo = bisect.bisect_left(run, start)
+        hi = bisect.bisect_left(run, end, lo)
+        while hi < len(run) and run[hi].stem.startswith(search_term):
+            hi += 1
+        return run[lo:hi]
+
+    def close(self) -> None:
+        with self._lock:
+            if self._journal is not None:
+                # an index which only read the files leaves them as they are
+                if self._num_appended > 0:
+                    self._compact()
+                self._journal.close()
+                self._journal = None
 
 
 IndexKey = tuple[str, str]
 
-_INDEXES: dict[IndexKey, Index] = collections.defaultdict(Index)
+# The revision of each head is stored in an index with this (pseudo)
+# field name, so that results can be ordered without loading documents.
+REV_FIELD = "_rev"
+
+# The document of each head (the change_id of its first change) is
+# stored in an index with this (pseudo) field name, so that only one
+# head per document is indexed, even if the document was forked. The
+# items of replaced heads are kept (with a prefix), so that the
+# document of a fork of a replaced head is known.
+DOC_FIELD = "_doc"
+
+_REPLACED_PREFIX = "~"
+
+
+def _index_filename(doctype: str, field: str) -> str:
+    return f"{doctype}.{field}".replace(":", "_")
+
+
+class IndexStore:
+    """The indexes of all INDEX_DECLARATIONS.
+
+    With an index_dir, each index is persisted in its own files (see
+    Index) and loaded on first use. Without, indexes are only kept in
+    memory.
+    """
+
+    def __init__(
+        self,
+        index_dir        : str | pl.Path | None = None,
+        compact_threshold: int                  = DEFAULT_COMPACT_THRESHOLD,
+    ) -> None:
+        self.index_dir         = None if index_dir is None else pl.Path(index_dir)
+        self.compact_threshold = compact_threshold
+
+        self._lock    = threading.Lock()
+        self._indexes: dict[IndexKey, Index] = {}
+
+    def __enter__(self) -> 'IndexStore':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def index(self, doctype: str, field: str) -> Index:
+        index = self._indexes.get((doctype, field))
+        if index is not None:
+            return index
+
+        with self._lock:
+            index = self._indexes.get((doctype, field))
+            if index is None:
+                if self.index_dir is None:
+                    path = None
+                else:
+                    path = self.index_dir / _index_filename(doctype, field)
+                index = Index(path, compact_threshold=self.compact_threshold)
+                self._indexes[doctype, field] = index
+            return index
+
+    def query(
+        self,
+        doctype    : str,
+        search_term: str,
+        fields     : list[str] | None = None,
+    ) -> typ.Iterator[MatchItem]:
+        for index_decl in INDEX_DECLARATIONS:
+            if index_decl.doctype == doctype:
+                _fields = set(index_decl.fields)
+                if fields is not None:
+                    _fields = set(fields) & _fields
+
+                for field in _fields:
+                    index = self.index(index_decl.doctype, field)
+                    for idx_item in index.find(search_term):
+                        yield MatchItem(
+                            stem=idx_item.stem,
+                            head=idx_item.head,
+                            doctype=index_decl.doctype,
+                            field=field,
+                        )
+
+    def _posting_list(self, doctype: str, field: str, search_term: str) -> set[schemas.ChangeId]:
+        for index_decl in INDEX_DECLARATIONS:
+            if index_decl.doctype == doctype and field in index_decl.fields:
+                return {idx_item.head for idx_item in self.index(doctype, field).find(search_term)}
+        return set()
+
+    def head_rev(self, doctype: str, head: schemas.ChangeId) -> schemas.Revision | None:
+        revs = self.index(doctype, REV_FIELD).terms(head)
+        return schemas.Revision(max(revs)) if revs else None
+
+    def doc_id(self, doctype: str, head: schemas.ChangeId) -> schemas.ChangeId | None:
+        doc_ids = self.index(doctype, DOC_FIELD).terms(head)
+        return schemas.ChangeId(min(doc_ids).removeprefix(_REPLACED_PREFIX)) if doc_ids else None
+
+    def _doc_heads(self, doctype: str, doc_id: schemas.ChangeId) -> set[schemas.ChangeId]:
+        return {item.head for item in self.index(doctype, DOC_FIELD).find(doc_id) if item.stem == doc_id}
+
+    def query_heads(
+        self,
+        doctype     : str,
+        criteria    : dict[str, str],
+        limit       : int | None = None,
+        offset      : int        = 0,
+        newest_first: bool       = False,
+    ) -> list[HeadItem]:
+        """Heads of documents which match all criteria (field -> search_term).
+
+        The heads of the smallest posting list (heads per field) are
+        checked against the others in sorted order. Heads are returned
+        in sorted order (or by their revision with newest_first=True),
+        so that limit and offset can be used for pagination. Unless
+        newest_first=True, the intersection stops after offset + limit
+        matches.
+        """
+        if not criteria:
+            raise TypeError("Missing criteria")
+
+        posting_lists = [
+            self._posting_list(doctype, field, search_term) for field, search_term in criteria.items()
+        ]
+        posting_lists.sort(key=len)
+
+        smallest, others = posting_lists[0], posting_lists[1:]
+        heads = (head for head in sorted(smallest) if all(head in other for other in others))
+        stop  = None if limit is None else offset + limit
+
+        if not newest_first:
+            return [HeadItem(head, self.head_rev(doctype, head)) for head in itertools.islice(heads, offset, stop)]
+
+        def _rev_key(item: HeadItem) -> str:
+            # Heads without a revision (indexed before revisions were) are last.
+            return item.head_rev or ""
+
+        items = [HeadItem(head, self.head_rev(doctype, head)) for head in heads]
+        if stop is None:
+            items.sort(key=_rev_key, reverse=True)
+        else:
+            # same order as sorted(reverse=True), i.e. stable for equal revisions
+            items = heapq.nlargest(stop, items, key=_rev_key)
+        return items[offset:]
+
+    def update(
+        self,
+        head    : schemas.ChangeId,
+        doc     : schemas.BaseDocument,
+        replaces: schemas.ChangeId | None = None,
+        head_rev: schemas.Revision | None = None,
+        doc_id  : schemas.ChangeId | None = None,
+    ) -> None:
+        """Add the terms of doc at head (with revision head_rev).
+
+        If doc is an update of a document at the head replaces, the
+        items of that head are removed. The doc_id defaults to the one
+        head was indexed with before, or to that of replaces (or to head
+        for a new document). Of all heads with the
+        same doc_id (e.g. if a document was updated concurrently), only
+        the one with the newest revision is kept, so that only one live
+        head of a document is found.
+        """
+        doctype = schemas.get_doctype(doc)
+        fields  = [
+            field for index_decl in INDEX_DECLARATIONS if index_decl.doctype == doctype for field in index_decl.fields
+        ]
+        if not fields:
+            return
+
+        if doc_id is None:
+            doc_id = self.doc_id(doctype, head) or (replaces and self.doc_id(doctype, replaces)) or head
+
+        stale_heads = self._stale_heads(doctype, doc_id, head, head_rev, replaces)
+        for field in [*fields, REV_FIELD, DOC_FIELD]:
+            index = self.index(doctype, field)
+            for stale_head in stale_heads:
+                index.remove(stale_head)
+                if field == DOC_FIELD:
+                    index.add_terms([_REPLACED_PREFIX + doc_id], stale_head)
+
+            if head in stale_heads:
+                continue
+            elif field == REV_FIELD:
+                if head_rev is not None:
+                    index.add_terms([head_rev], head)
+            elif field == DOC_FIELD:
+                # a head has exactly one doc_id
+                index.remove(head)
+                index.add_terms([doc_id], head)
+            elif field_val := _get_field_val(doc, field):
+                index.add(field_val, head)
+
+    def _stale_heads(
+        self,
+        doctype : str,
+        doc_id  : schemas.ChangeId,
+        head    : schemas.ChangeId,
+        head_rev: schemas.Revision | None,
+        replaces: schemas.ChangeId | None,
+    ) -> set[schemas.ChangeId]:
+        def _head_key(_head: schemas.ChangeId) -> tuple[str, str]:
+            _head_rev = head_rev if _head == head else self.head_rev(doctype, _head)
+            return (_head_rev or "", _head)
+
+        if replaces is None or replaces == head:
+            replaced = set()
+        else:
+            replaced = {replaces}
+
+        # If head is on an older fork, the head of the newer one is kept.
+        doc_heads   = (self._doc_heads(doctype, doc_id) - replaced) | {head}
+        newest_head = max(doc_heads, key=_head_key)
+        return (doc_heads - {newest_head}) | replaced
+
+    def clear(self) -> None:
+        """Remove all items from all indexes (including their files)."""
+        self.close()
+        if self.index_dir is not None and self.index_dir.exists():
+            for path in self.index_dir.iterdir():
+                if path.name.endswith((TERMS_SUFFIX, JOURNAL_SUFFIX)):
+                    path.unlink()
+
+    def close(self) -> None:
+        with self._lock:
+            for index in self._indexes.values():
+                index.close()
+            self._indexes.clear()
+
+
+_DEFAULT_STORE = IndexStore()
 
 
 def query_index(
@@ -114,28 +630,14 @@ def query_index(
     search_term: str,
     fields     : list[str] | None = None,
 ) -> typ.Iterator[MatchItem]:
-    for index_decl in INDEX_DECLARATIONS:
-        if index_decl.doctype == doctype:
-            _fields = set(index_decl.fields)
-            if fields is not None:
-                _fields = set(fields) & _fields
-
-            for field in _fields:
-                index = _INDEXES[index_decl.doctype, field]
-                for idx_item in index.find(search_term):
-                    yield MatchItem(
-                        stem=idx_item.stem,
-                        head=idx_item.head,
-                        doctype=index_decl.doctype,
-                        field=field,
-                    )
-
-
-def update_indexes(head: schemas.ChangeId, doc: schemas.BaseDocument) -> None:
-    doctype = schemas.get_doctype(doc)
-    for index_decl in INDEX_DECLARATIONS:
-        if index_decl.doctype == doctype:
-            for field in index_decl.fields:
-                if field_val := _get_field_val(doc, field):
-                    index = _INDEXES[doctype, field]
-                    index.add(field_val, head)
+    return _DEFAULT_STORE.query(doctype, search_term, fields)
+
+
+def update_indexes(
+    head    : schemas.ChangeId,
+    doc     : schemas.BaseDocument,
+    replaces: schemas.ChangeId | None = None,
+    head_rev: schemas.Revision | None = None,
+    doc_id  : schemas.ChangeId | None = None,
+) -> None:
+    _DEFAULT_STORE.update(head, doc, replaces, head_rev, doc_id)
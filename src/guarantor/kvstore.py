@@ -19,62 +19,420 @@ Goals (in order of priority):
 - One writer, many readers.
 - Fast random access reads
 """
+import os
 import dbm
+import json
 import typing as typ
 import logging
 import pathlib as pl
+import threading
+import contextlib
 
+from guarantor import aof
+from guarantor import crypto
 from guarantor import docdiff
 from guarantor import schemas
 
 logger = logging.getLogger(__name__)
 
 
+DBMHandle = typ.Any
+
+DEFAULT_MAX_READERS = 4
+DEFAULT_NUM_SHARDS  = 1
+
+# Settings of a db_dir which must not change after it was created.
+META_NAME = "kvstore.json"
+
+Backend = typ.Literal['dbm', 'aof']
+
+BACKEND_DBM: Backend = "dbm"
+BACKEND_AOF: Backend = "aof"
+
+
+class Storage(typ.Protocol):
+    def get(self, key: str) -> bytes | None:
+        ...
+
+    def get_many(self, keys: typ.Iterable[str]) -> dict[str, bytes]:
+        ...
+
+    def put_many(self, items: dict[str, bytes]) -> None:
+        ...
+
+    def keys(self) -> list[str]:
+        ...
+
+    def close(self) -> None:
+        ...
+
+
+FileStamp = tuple[int, int]
+
+
+def _db_stamp(path: pl.Path) -> FileStamp | None:
+    # Depending on the dbm implementation, the file on disk is either
+    # path itself or has a suffix.
+    for suffix in ("", ".db", ".dir"):
+        try:
+            stat = os.stat(str(path) + suffix)
+            return (stat.st_mtime_ns, stat.st_size)
+        except FileNotFoundError:
+            pass
+    return None
+
+
+class DBMStorage:
+    """Reusable handles for a single dbm file.
+
+    Storage opened with flag='c' holds a single writer handle, which
+    is also used for reads, so that reads always see prior writes.
+    Storage opened with flag='r' keeps a pool of up to `max_readers`
+    reader handles, which are reopened if the file was modified since
+    they were opened.
+    """
+
+    def __init__(
+        self,
+        path       : pl.Path,
+        flag       : typ.Literal['r', 'c'] = 'r',
+        max_readers: int = DEFAULT_MAX_READERS,
+    ) -> None:
+        self.path        = path
+        self.flag        = flag
+        self.max_readers = max_readers
+
+        self._lock   = threading.Lock()
+        self._writer: DBMHandle = None
+        self._readers: list[tuple[FileStamp | None, DBMHandle]] = []
+
+    def close(self) -> None:
+        with self._lock:
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+
+            for _, db in self._readers:
+                db.close()
+            self._readers.clear()
+
+    def _get_writer(self) -> DBMHandle:
+        # NOTE: must be called with self._lock held
+        if self._writer is None:
+            if self.flag == 'r':
+                raise Exception(f"dbm open for {self.path} not possible with flag='r'")
+
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._writer = dbm.open(str(self.path), flag=self.flag)
+        return self._writer
+
+    @contextlib.contextmanager
+    def _reader(self) -> typ.Iterator[DBMHandle]:
+        stamp = _db_stamp(self.path)
+
+        db: DBMHandle = None
+        with self._lock:
+            while self._readers and db is None:
+                reader_stamp, reader_db = self._readers.pop()
+                if reader_stamp == stamp:
+                    db = reader_db
+                else:
+                    reader_db.close()
+
+        if db is None:
+            db = dbm.open(str(self.path), flag='r')
+
+        try:
+            yield db
+        finally:
+            with self._lock:
+                if len(self._readers) < self.max_readers:
+                    self._readers.append((stamp, db))
+                    db = None
+
+            if db is not None:
+                db.close()
+
+    def get(self, key: str) -> bytes | None:
+        if self.flag == 'r':
+            with self._reader() as db:
+                return typ.cast(bytes | None, db.get(key))
+        else:
+            with self._lock:
+                return typ.cast(bytes | None, self._get_writer().get(key))
+
+    def get_many(self, keys: typ.Iterable[str]) -> dict[str, bytes]:
+        """Values of all keys that are present, read with a single handle."""
+        if self.flag == 'r':
+            with self._reader() as db:
+                items = {key: db.get(key) for key in keys}
+        else:
+            with self._lock:
+                db    = self._get_writer()
+                items = {key: db.get(key) for key in keys}
+        return {key: value for key, value in items.items() if value is not None}
+
+    def keys(self) -> list[str]:
+        if self.flag == 'r':
+            with self._reader() as db:
+                return [key.decode("utf-8") for key in db.keys()]
+        else:
+            with self._lock:
+                return [key.decode("utf-8") for key in self._get_writer().keys()]
+
+    def put_many(self, items: dict[str, bytes]) -> None:
+        with self._lock:
+            db = self._get_writer()
+            for key, value in items.items():
+                db[key] = value
+
+
 class Client:
-    def __init__(self, db_dir: str | pl.Path, flag: typ.Literal['r', 'c'] = 'r'):
-        self.db_dir = pl.Path(db_dir)
-        self.flag   = flag
+    """Long lived client for the storage files of a kvstore.
+
+    Storage handles are opened lazily and reused across calls. With
+    backend='dbm' changes are stored in a dbm file, with backend='aof'
+    they are appended to the segments of an `aof.AppendOnlyLog`.
 
-    def dbm_path(self, change_id: schemas.ChangeId) -> pl.Path:
-        # pylint: disable=unused-argument; change_id is to allow for future sharding
+    With num_shards > 1, changes are distributed over multiple files
+    (each with their own handles and locks) based on the prefix of
+    their change_id. The number of shards is stored in db_dir when
+    the first change is written, a Client with a different number of
+    shards for the same db_dir raises a ValueError. A db_dir which was
+    written before the number of shards was stored has a single shard.
+
+    Changes are always verified before they are written, batches of
+    changes (see `post_many`) with a pool of `verify_workers`. With
+    trusted=True they are not verified again when they are read, which
+    is only appropriate if the files in db_dir are not written to by
+    anything other than a kvstore.Client.
+
+    Changes are written with the given codec (see schemas.dumps_change),
+    changes written with any codec can be read.
+
+    Use `close()` (or the client as a context manager) to release
+    the handles.
+    """
+
+    def __init__(
+        self,
+        db_dir        : str | pl.Path,
+        flag          : typ.Literal['r', 'c'] = 'r',
+        max_readers   : int     = DEFAULT_MAX_READERS,
+        backend       : Backend = BACKEND_DBM,
+        num_shards    : int     = DEFAULT_NUM_SHARDS,
+        trusted       : bool    = False,
+        verify_workers: int     = crypto.DEFAULT_VERIFY_WORKERS,
+        codec         : schemas.ChangeCodec = schemas.DEFAULT_CHANGE_CODEC,
+    ):
+        if backend not in (BACKEND_DBM, BACKEND_AOF):
+            raise ValueError(f"Invalid backend: {backend}")
+        if num_shards < 1:
+            raise ValueError(f"Invalid num_shards: {num_shards}")
+
+        self.db_dir         = pl.Path(db_dir)
+        self.flag           = flag
+        self.max_readers    = max_readers
+        self.backend        = backend
+        self.num_shards     = num_shards
+        self.trusted        = trusted
+        self.verify_workers = verify_workers
+        self.codec          = codec
+
+        self._lock    = threading.Lock()
+        self._storage: dict[pl.Path, Storage] = {}
+
+        self._has_meta = self._check_meta()
+
+    def _check_meta(self) -> bool:
+        meta_path = self.db_dir / META_NAME
+        try:
+            meta = json.loads(meta_path.read_bytes())
+        except FileNotFoundError:
+            # stores created before the meta file have a single shard
+            legacy_name = "db.aof" if self.backend == BACKEND_AOF else "db.dbm"
+            if self.num_shards != 1 and self._exists(self.db_dir / legacy_name):
+                errmsg = f"Invalid num_shards={self.num_shards} for {self.db_dir} (created with 1)"
+                raise ValueError(errmsg)
+            return False
+
+        if meta['num_shards'] != self.num_shards:
+            errmsg = f"Invalid num_shards={self.num_shards} for {self.db_dir} (created with {meta['num_shards']})"
+            raise ValueError(errmsg)
+        return True
+
+    def _write_meta(self) -> None:
+        if self._has_meta or self._check_meta():
+            self._has_meta = True
+            return
+
+        self.db_dir.mkdir(parents=True, exist_ok=True)
+        meta_path = self.db_dir / META_NAME
+        tmp_path  = meta_path.with_suffix(".tmp")
+        tmp_path.write_text(json.dumps({'num_shards': self.num_shards}))
+        os.replace(tmp_path, meta_path)
+        self._has_meta = True
+
+    def __enter__(self) -> 'Client':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def close(self) -> None:
+        with self._lock:
+            for storage in self._storage.values():
+                storage.close()
+            self._storage.clear()
+
+    def shard(self, change_id: schemas.ChangeId) -> int:
         # NOTE (mb 2022-07-24): To keep file sizes managable, and to reduce
-        #   multithreading contention, we might shard based on change_id.
-        return self.db_dir / "db.dbm"
+        #   multithreading contention, we shard based on change_id.
+        return int(change_id[:8], 16) % self.num_shards
+
+    def storage_path(self, change_id: schemas.ChangeId, prefix: str = "db") -> pl.Path:
+        shard = 0 if self.num_shards == 1 else self.shard(change_id)
+        return self.shard_path(shard, prefix)
+
+    def shard_path(self, shard: int, prefix: str = "db") -> pl.Path:
+        if self.num_shards == 1:
+            name = prefix
+        else:
+            name = f"{prefix}_{shard:03d}"
+
+        if self.backend == BACKEND_AOF:
+            return self.db_dir / (name + ".aof")
+        else:
+            return self.db_dir / (name + ".dbm")
+
+    def _get_storage(self, path: pl.Path) -> Storage:
+        storage = self._storage.get(path)
+        if storage is not None:
+            return storage
+
+        with self._lock:
+            storage = self._storage.get(path)
+            if storage is None:
+                if self.backend == BACKEND_AOF:
+                    storage = aof.AppendOnlyLog(path, flag=self.flag)
+                else:
+                    storage = DBMStorage(path, flag=self.flag, max_readers=self.max_readers)
+                self._storage[path] = storage
+            return storage
+
+    def _exists(self, path: pl.Path) -> bool:
+        """False if the storage at path doesn't exist (yet), i.e. it cannot be opened for reading."""
+        if self.backend == BACKEND_AOF:
+            return path.exists()
+        else:
+            return _db_stamp(path) is not None
+
+    def _read(self, change_id: schemas.ChangeId, prefix: str = "db") -> bytes | None:
+        path = self.storage_path(change_id, prefix)
+        if self.flag == 'r' and not self._exists(path):
+            return None
+        return self._get_storage(path).get(change_id)
+
+    def _read_many(self, change_ids: typ.Iterable[schemas.ChangeId], prefix: str = "db") -> dict[str, bytes]:
+        by_path: dict[pl.Path, list[schemas.ChangeId]] = {}
+        for change_id in change_ids:
+            by_path.setdefault(self.storage_path(change_id, prefix), []).append(change_id)
+
+        results: dict[str, bytes] = {}
+        for path, path_change_ids in by_path.items():
+            if self.flag == 'r' and not self._exists(path):
+                continue
+            results.update(self._get_storage(path).get_many(path_change_ids))
+        return results
+
+    def read_many(self, change_ids: typ.Iterable[schemas.ChangeId]) -> dict[schemas.ChangeId, bytes]:
+        """Raw (not yet decoded or verified) data of all changes which are present.
+
+        Reads are grouped by shard, with a single pass per storage file.
+        """
+        return self._read_many(change_ids)
+
+    def get_snapshots(
+        self, change_ids: typ.Iterable[schemas.ChangeId]
+    ) -> dict[schemas.ChangeId, schemas.Snapshot]:
+        """Snapshots at any of change_ids (if they were posted)."""
+        snapshots_data = self._read_many(change_ids, prefix="snapshots")
+        return {change_id: schemas.loads_snapshot(data) for change_id, data in snapshots_data.items()}
 
     def iter_changes(self, head: schemas.ChangeId, early_exit: bool = False) -> typ.Iterator[schemas.Change]:
-        path = self.dbm_path(head)
-        with dbm.open(str(path), flag='r') as db:
+        current_id: schemas.ChangeId | None = head
+
+        while change_data := (current_id and self._read(current_id)):
+            change = schemas.loads_change(change_data, verify=not self.trusted)
+            yield change
 
-            current_id: schemas.ChangeId | None = head
+            if early_exit and change.opcode == docdiff.OP_RESET:
+                return
 
-            while change_data := (current_id and db.get(current_id)):
-                change = schemas.loads_change(change_data)
-                yield change
+            current_id = change.parent_id
 
-                if early_exit and change.opcode == docdiff.OP_RESET:
-                    return
+    def iter_shard(self, shard: int) -> typ.Iterator[tuple[schemas.ChangeId, bytes]]:
+        """All (change_id, change_data) of a shard, in no particular order."""
+        path = self.shard_path(shard)
+        if not self._exists(path):
+            return
 
-                current_id = change.parent_id
+        storage = self._get_storage(path)
+        for change_id in storage.keys():
+            change_data = storage.get(change_id)
+            if change_data is not None:
+                yield change_id, change_data
 
     def get(self, change_id: schemas.ChangeId) -> schemas.Change | None:
         try:
             return next(iter(self.iter_changes(change_id)))
         except StopIteration:
             return None
-        except dbm.error as err:
-            if "doesn't exist" in str(err):
-                return None
-            else:
-                raise
 
     def post(self, change: schemas.Change) -> None:
-        if not schemas.verify_change(change):
+        self.post_many([change])
+
+    def post_many(self, changes: typ.Iterable[schemas.Change]) -> None:
+        """Verify and write a batch of changes.
+
+        All changes are verified before anything is written, so if any
+        change of the batch is invalid, none are written. The writes are
+        not atomic though: they are grouped by shard and each storage is
+        written in turn, so if a write fails (e.g. disk full), changes
+        written before the failure (to earlier shards) are kept. Changes
+        are keyed by their change_id, so the batch can simply be posted
+        again.
+        """
+        if self.flag == 'r':
+            raise Exception(f"kvstore {self.db_dir} not writable with flag='r'")
+
+        changes = list(changes)
+        results = schemas.verify_changes(changes, workers=self.verify_workers)
+        if not all(results):
             raise ValueError("Invalid change!")
 
-        path = self.dbm_path(change.change_id)
+        self._write_meta()
+
+        batch: dict[pl.Path, dict[schemas.ChangeId, bytes]] = {}
+        for change in changes:
+            path = self.storage_path(change.change_id)
+            batch.setdefault(path, {})[change.change_id] = schemas.dumps_change(change, codec=self.codec)
+
+        for path, items in batch.items():
+            self._get_storage(path).put_many(items)
+
+    def get_snapshot(self, change_id: schemas.ChangeId) -> schemas.Snapshot | None:
+        """Materialized document at change_id (if one was posted)."""
+        snapshot_data = self._read(change_id, prefix="snapshots")
+        if snapshot_data is None:
+            return None
+        else:
+            return schemas.loads_snapshot(snapshot_data)
+
+    def post_snapshot(self, snapshot: schemas.Snapshot) -> None:
         if self.flag == 'r':
-            raise Exception(f"dbm open for {path} not possible with flag='r'")
+            raise Exception(f"kvstore {self.db_dir} not writable with flag='r'")
 
-        change_data = schemas.dumps_change(change)
-        with dbm.open(str(path), flag=self.flag) as db:
-            db[change.change_id] = change_data
+        self._write_meta()
+        path = self.storage_path(snapshot.change_id, prefix="snapshots")
+        self._get_storage(path).put_many({snapshot.change_id: schemas.dumps_snapshot(snapshot)})
@@ -0,0 +1,49 @@
+"""Process pools which are shared for the lifetime of the process.
+
+Pools are created on demand, one per number of workers. A forked child
+doesn't inherit the pools of its parent (they would be unusable) and all
+pools are shut down when the interpreter exits.
+"""
+import os
+import atexit
+import concurrent.futures
+
+Executors = dict[int, concurrent.futures.ProcessPoolExecutor]
+
+_all_executors: list[Executors] = []
+
+
+def new_executors() -> Executors:
+    """Create an (empty) cache of pools, which is reset on fork and shut down at exit."""
+    executors: Executors = {}
+    _all_executors.append(executors)
+    return executors
+
+
+def get_executor(executors: Executors, workers: int) -> concurrent.futures.ProcessPoolExecutor:
+    if workers not in executors:
+        executors[workers] = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+    return executors[workers]
+
+
+def shutdown_executors(executors: Executors) -> None:
+    """Shut down the pools of a cache (new pools are created on demand)."""
+    while executors:
+        _, executor = executors.popitem()
+        executor.shutdown(cancel_futures=True)
+
+
+def _reset_after_fork() -> None:
+    # the worker processes belong to the parent, only forget about them
+    for executors in _all_executors:
+        executors.clear()
+
+
+@atexit.register
+def _shutdown_all() -> None:
+    for executors in _all_executors:
+        shutdown_executors(executors)
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
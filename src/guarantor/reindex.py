@@ -0,0 +1,264 @@
+# This file is part of the guarantor project
+# https://github.com/xkudev/guarantor
+#
+# Copyright (c) 2022 xkudev (xkudev@pm.me) - MIT License
+# SPDX-License-Identifier: MIT
+
+"""Rebuild the indexes of a db_dir from the changes in its kvstore.
+
+A rebuild has two phases:
+
+1. Scan: The shards of the kvstore are scanned (in parallel) to find
+   the heads of all documents, i.e. changes which are not the parent
+   of any other change.
+2. Index: The documents of the heads are materialized by a pool of
+   workers and added to the indexes.
+
+The heads are indexed in the order in which the shards are scanned.
+After every batch of heads, the position of the last indexed head
+(its shard and its position in the scan of the shard) is written to a
+checkpoint file, so that an interrupted rebuild can be resumed.
+
+Changes which cannot be decoded and documents which cannot be loaded
+are logged and skipped.
+"""
+import os
+import typing as typ
+import logging
+import pathlib as pl
+import concurrent.futures
+
+import orjson
+
+from guarantor import dal
+from guarantor import kvstore
+from guarantor import schemas
+from guarantor import indexing
+
+logger = logging.getLogger(__name__)
+
+
+CHECKPOINT_NAME = "reindex.checkpoint"
+
+DEFAULT_BATCH_SIZE = 1000
+DEFAULT_WORKERS    = os.cpu_count() or 1
+
+
+class Progress(typ.NamedTuple):
+    num_heads: int
+    num_done : int
+
+
+ProgressCallback = typ.Callable[[Progress], None]
+
+
+class StoreOptions(typ.NamedTuple):
+    db_dir    : pl.Path
+    backend   : kvstore.Backend
+    num_shards: int
+    trusted   : bool
+
+
+class HeadPosition(typ.NamedTuple):
+    shard   : int
+    position: int  # of the change in the scan of the shard
+    head    : schemas.ChangeId
+    doc_id  : schemas.ChangeId  # the first change of the document
+
+
+Checkpoint = tuple[int, int]  # (shard, position)
+
+
+class ScannedChange(typ.NamedTuple):
+    shard    : int
+    position : int
+    change_id: schemas.ChangeId
+    parent_id: schemas.ChangeId | None
+
+
+def _scan_shard(options: StoreOptions, shard: int) -> tuple[list[ScannedChange], set[schemas.ChangeId]]:
+    indexed_doctypes = {index_decl.doctype for index_decl in indexing.INDEX_DECLARATIONS}
+
+    candidates: list[ScannedChange]   = []
+    parent_ids: set[schemas.ChangeId] = set()
+
+    client = kvstore.Client(options.db_dir, flag='r', backend=options.backend, num_shards=options.num_shards)
+    with client:
+        for position, (change_id, change_data) in enumerate(client.iter_shard(shard)):
+            # Changes are only decoded here, they are verified when
+            # the documents of the heads are loaded.
+            try:
+                change = schemas.loads_change(change_data, verify=False)
+            except (KeyError, ValueError, TypeError) as err:
+                logger.warning(f"Skipping invalid change {change_id}: {err}")
+                continue
+
+            if change.parent_id is not None:
+                parent_ids.add(change.parent_id)
+            if change.doctype in indexed_doctypes:
+                candidates.append(ScannedChange(shard, position, change_id, change.parent_id))
+
+    return candidates, parent_ids
+
+
+def find_heads(options: StoreOptions, workers: int = DEFAULT_WORKERS) -> list[HeadPosition]:
+    """The heads of all documents with an index declaration (in the order they were scanned)."""
+    shards = range(options.num_shards)
+    if workers > 1 and options.num_shards > 1:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=min(workers, options.num_shards)) as executor:
+            results = list(executor.map(_scan_shard, [options] * len(shards), shards))
+    else:
+        results = [_scan_shard(options, shard) for shard in shards]
+
+    candidates: list[ScannedChange]   = []
+    parent_ids: set[schemas.ChangeId] = set()
+    for shard_candidates, shard_parent_ids in results:
+        candidates.extend(shard_candidates)
+        parent_ids.update(shard_parent_ids)
+
+    parents = {candidate.change_id: candidate.parent_id for candidate in candidates}
+    doc_ids: dict[schemas.ChangeId, schemas.ChangeId] = {}
+
+    def _doc_id(change_id: schemas.ChangeId) -> schemas.ChangeId:
+        chain: list[schemas.ChangeId] = []
+        while change_id not in doc_ids:
+            chain.append(change_id)
+            parent_id = parents.get(change_id)
+            if parent_id is None or parent_id not in parents:
+                doc_ids[change_id] = change_id
+            else:
+                change_id = parent_id
+
+        for chain_id in chain:
+            doc_ids[chain_id] = doc_ids[change_id]
+        return doc_ids[change_id]
+
+    return [
+        HeadPosition(candidate.shard, candidate.position, candidate.change_id, _doc_id(candidate.change_id))
+        for candidate in candidates
+        if candidate.change_id not in parent_ids
+    ]
+
+
+_worker_dal: dal.DataAccessLayer | None = None
+
+
+def _init_worker(options: StoreOptions) -> None:
+    global _worker_dal  # pylint: disable=global-statement
+
+    _worker_dal = dal.DataAccessLayer(
+        wif=None,
+        db_dir=options.db_dir,
+        backend=options.backend,
+        num_shards=options.num_shards,
+        trusted=options.trusted,
+        verify_mode=dal.VERIFY_OFF,
+        flag='r',
+    )
+
+
+LoadResult = tuple[schemas.ChangeId, schemas.Revision | None, schemas.BaseDocument | None]
+
+
+def _load_doc(head: schemas.ChangeId) -> LoadResult:
+    assert _worker_dal is not None
+    try:
+        doc_wrp = _worker_dal.get(head)
+        return head, doc_wrp.head_rev, doc_wrp.doc
+    except (schemas.VerificationError, AssertionError, KeyError, ValueError, TypeError) as err:
+        logger.warning(f"Skipping invalid document {head}: {err}")
+        return head, None, None
+
+
+def _read_checkpoint(checkpoint_path: pl.Path) -> Checkpoint | None:
+    try:
+        data = orjson.loads(checkpoint_path.read_bytes())
+        return (int(data['shard']), int(data['position']))
+    except FileNotFoundError:
+        return None
+    except (KeyError, ValueError, TypeError) as err:
+        logger.warning(f"Ignoring invalid checkpoint {checkpoint_path}: {err}")
+        return None
+
+
+def _write_checkpoint(checkpoint_path: pl.Path, last: HeadPosition) -> None:
+    tmp_path = checkpoint_path.with_name(checkpoint_path.name + ".tmp")
+    tmp_path.write_bytes(orjson.dumps({'shard': last.shard, 'position': last.position}))
+    os.replace(tmp_path, checkpoint_path)
+
+
+def rebuild_indexes(
+    db_dir    : str | pl.Path,
+    backend   : kvstore.Backend         = kvstore.BACKEND_DBM,
+    num_shards: int                     = kvstore.DEFAULT_NUM_SHARDS,
+    trusted   : bool                    = False,
+    workers   : int                     = DEFAULT_WORKERS,
+    batch_size: int                     = DEFAULT_BATCH_SIZE,
+    resume    : bool                    = True,
+    progress  : ProgressCallback | None = None,
+) -> Progress:
+    """Rebuild the indexes of db_dir (see module docstring).
+
+    With resume=True, a previous (interrupted) rebuild is continued
+    from its checkpoint. Otherwise, or if there is no checkpoint, the
+    existing indexes are cleared first.
+    """
+    options = StoreOptions(pl.Path(db_dir), backend, num_shards, trusted)
+
+    store           = indexing.IndexStore(options.db_dir / "indexes")
+    checkpoint_path = options.db_dir / "indexes" / CHECKPOINT_NAME
+
+    checkpoint = _read_checkpoint(checkpoint_path) if resume else None
+    if checkpoint is None:
+        store.clear()
+    checkpoint_path.parent.mkdir(parents=True, exist_ok=True)
+
+    heads     = find_heads(options, workers=workers)
+    remaining = [item for item in heads if checkpoint is None or (item.shard, item.position) > checkpoint]
+    num_done  = len(heads) - len(remaining)
+
+    if progress:
+        progress(Progress(len(heads), num_done))
+
+    executor: concurrent.futures.Executor | None = None
+    if workers > 1:
+        executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers, initializer=_init_worker, initargs=(options,)
+        )
+    else:
+        _init_worker(options)
+
+    try:
+        for offset in range(0, len(remaining), batch_size):
+            batch       = remaining[offset : offset + batch_size]
+            batch_heads = [item.head for item in batch]
+
+            results: typ.Iterator[LoadResult]
+            if executor is None:
+                results = map(_load_doc, batch_heads)
+            else:
+                chunksize = max(1, len(batch) // (workers * 4))
+                results   = executor.map(_load_doc, batch_heads, chunksize=chunksize)
+
+            for item, (head, head_rev, doc) in zip(batch, results):
+                if doc is None:
+                    continue
+                try:
+                    store.update(head, doc, head_rev=head_rev, doc_id=item.doc_id)
+                except (KeyError, ValueError, TypeError) as err:
+                    logger.warning(f"Skipping document {head} which could not be indexed: {err}")
+
+            _write_checkpoint(checkpoint_path, batch[-1])
+            num_done += len(batch)
+            if progress:
+                progress(Progress(len(heads), num_done))
+    finally:
+        if executor is None:
+            assert _worker_dal is not None
+            _worker_dal.close()
+        else:
+            executor.shutdown()
+        store.close()
+
+    checkpoint_path.unlink(missing_ok=True)
+    return Progress(len(heads), num_done)
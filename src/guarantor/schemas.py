@@ -3,15 +3,25 @@
 #
 # Copyright (c) 2022 xkudev (xkudev@pm.me) - MIT License
 # SPDX-License-Identifier: MIT
+import re
 import json
 import math
+import base64
+import struct
 import typing as typ
 import hashlib
 import datetime as dt
+import functools
 import importlib
+import itertools
+import threading
+import collections
+import concurrent.futures
 
+import orjson
 import pydantic
 
+from guarantor import pools
 from guarantor import crypto
 
 ChangeId = str
@@ -23,14 +33,19 @@ DocType  = typ.NewType('DocType', str)
 Revision = typ.NewType('Revision', str)
 
 
+def revision_number(rev: Revision) -> int:
+    _, _, rev_hex, _ = rev.split("_", 3)
+    return int(rev_hex, base=16)
+
+
 def increment_revision(doctype: DocType, change_id: ChangeId, rev: Revision | None) -> Revision:
     doctype_cleanded = doctype.replace(":", "_").replace(".", "_").lower()
     if rev is None:
         root_id = change_id[:8]
         rev_num = 0
     else:
-        _, root_id, old_rev, _ = rev.split("_", 3)
-        rev_num = (int(old_rev, base=16) + 1) % (16 ** 8)
+        _, root_id, _, _ = rev.split("_", 3)
+        rev_num = (revision_number(rev) + 1) % (16 ** 8)
 
     now     = dt.datetime.utcnow()
     ts_str  = now.strftime("%Y%m%d%H%M")
@@ -77,6 +92,22 @@ class Change(pydantic.BaseModel):
     #    the eviction policy of a node.
     proof_of_work: str
 
+    # The change_id derived from the fields above (see derive_change_id)
+    # is memoized per object. It is reset if one of the fields is
+    # assigned to, but not if a field (i.e. opdata) is modified in
+    # place, which changes should never be.
+    _derived_change_id: ChangeId | None = pydantic.PrivateAttr(default=None)
+
+    def __setattr__(self, name: str, value: typ.Any) -> None:
+        super().__setattr__(name, value)
+        if name in CHANGE_ID_FIELDS:
+            self._derived_change_id = None
+
+    def copy(self, **kwargs: typ.Any) -> 'Change':
+        change = super().copy(**kwargs)
+        change._derived_change_id = None
+        return change
+
     def __lt__(self, other: 'Change') -> bool:
         return self.rev < other.rev
 
@@ -94,26 +125,104 @@ CHANGE_ID_FIELDS = ['address', 'doctype', 'opcode', 'opdata', 'parent_id']
 
 
 def derive_change_id(change: Change) -> ChangeId:
-    change_fields = change.dict()
-    field_values  = [change_fields[field] for field in CHANGE_ID_FIELDS]
-    return crypto.deterministic_json_hash(field_values)
+    # pylint: disable=protected-access
+    if change._derived_change_id is None:
+        field_values = [getattr(change, field) for field in CHANGE_ID_FIELDS]
+        change._derived_change_id = crypto.deterministic_json_hash(field_values)
+    return change._derived_change_id
 
 
 DEFAULT_DIFFICULTY_BITS = 12
 
+# Nonces are searched in blocks, the nonce of a block is the block
+# number followed by a 4 digit suffix (so for a block, only the suffix
+# has to be hashed and no str/int conversion is needed per nonce).
+_POW_SUFFIXES = [b"%04d" % i for i in range(10_000)]
 
-def calculate_pow(change_id: ChangeId, difficulty: int = DEFAULT_DIFFICULTY_BITS) -> str:
-    assert difficulty < 40
+# Number of blocks in a task of the process pool
+POW_BLOCKS_PER_TASK = 8
+
+# Below this difficulty, a process pool is slower than a single core
+POW_PARALLEL_MIN_DIFFICULTY = 16
+
+DEFAULT_POW_WORKERS = 1
+
+_pow_executors = pools.new_executors()
+
+
+def _pow_executor(workers: int) -> concurrent.futures.ProcessPoolExecutor:
+    return pools.get_executor(_pow_executors, workers)
+
+
+def shutdown_pow_executors() -> None:
+    """Shut down the process pools of calculate_pow (new pools are created on demand)."""
+    pools.shutdown_executors(_pow_executors)
 
+
+def _pow_search(change_id: ChangeId, difficulty: int, first_block: int, last_block: int) -> str | None:
     target = 2 ** (60 - difficulty)
-    nonce  = 0
+    if target << 4 < 2 ** 64:
+        # int(digest_hex[:15], 16) < target  <=>  digest[:8] < target << 4 (big endian)
+        target_bytes = (target << 4).to_bytes(8, "big")
+    else:
+        # every digest (20 bytes) is below the target
+        target_bytes = b"\xff" * 21
+
+    change_id_sha1 = hashlib.sha1(change_id.encode("ascii"))
+    for block in range(first_block, last_block):
+        block_prefix = str(block).encode("ascii")
+        block_sha1   = change_id_sha1.copy()
+        block_sha1.update(block_prefix)
+        for suffix in _POW_SUFFIXES:
+            sha1 = block_sha1.copy()
+            sha1.update(suffix)
+            if sha1.digest() < target_bytes:
+                nonce = (block_prefix + suffix).decode("ascii")
+                return f"POWv0${nonce}${sha1.hexdigest()[:15]}"
+
+    return None
+
+
+def _calculate_pow_parallel(change_id: ChangeId, difficulty: int, workers: int) -> str:
+    executor = _pow_executor(workers)
+
+    next_block = 1
+    pending: set[concurrent.futures.Future] = set()
+    try:
+        while True:
+            while len(pending) < workers * 2:
+                last_block = next_block + POW_BLOCKS_PER_TASK
+                pending.add(executor.submit(_pow_search, change_id, difficulty, next_block, last_block))
+                next_block = last_block
+
+            done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                pow_str = future.result()
+                if pow_str:
+                    return typ.cast(str, pow_str)
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+def calculate_pow(
+    change_id : ChangeId,
+    difficulty: int = DEFAULT_DIFFICULTY_BITS,
+    workers   : int = DEFAULT_POW_WORKERS,
+) -> str:
+    assert difficulty < 40
+
+    if workers > 1 and difficulty >= POW_PARALLEL_MIN_DIFFICULTY:
+        return _calculate_pow_parallel(change_id, difficulty, workers)
+
+    first_block = 1
     while True:
-        data   = (change_id + str(nonce)).encode("ascii")
-        digest = hashlib.sha1(data).hexdigest()[:15]
-        if int(digest, 16) < target:
-            return f"POWv0${nonce}${digest}"
+        last_block = first_block + POW_BLOCKS_PER_TASK
+        pow_str    = _pow_search(change_id, difficulty, first_block, last_block)
+        if pow_str:
+            return pow_str
 
-        nonce += 1
+        first_block = last_block
 
 
 def get_pow_difficulty(change_id: str, pow_str: str) -> float:
@@ -125,26 +234,68 @@ def get_pow_difficulty(change_id: str, pow_str: str) -> float:
     return 60 - math.log2(int(digest, 16))
 
 
+# Number of signatures for which the result of the verification is kept.
+VERIFIED_CACHE_SIZE = 2 ** 16
+
+# Signature verification (ECDSA pubkey recovery) is by far the most
+# expensive part of loading a change. The result only depends on the
+# arguments, so changes which were verified once (e.g. on post) are not
+# verified again. Only valid signatures are kept, so that results from a
+# worker pool (see verify_changes) can be added to the cache. The least
+# recently used entries are evicted.
+_verified_signatures: collections.OrderedDict[tuple[str, str, str], None] = collections.OrderedDict()
+_verified_lock = threading.Lock()
+
+
+def _is_verified(key: tuple[str, str, str]) -> bool:
+    with _verified_lock:
+        if key in _verified_signatures:
+            _verified_signatures.move_to_end(key)
+            return True
+        else:
+            return False
+
+
+def _remember_verified(key: tuple[str, str, str]) -> None:
+    with _verified_lock:
+        _verified_signatures[key] = None
+        _verified_signatures.move_to_end(key)
+        while len(_verified_signatures) > VERIFIED_CACHE_SIZE:
+            _verified_signatures.popitem(last=False)
+
+
+def _verify_signature(address: str, signature: str, message: str) -> bool:
+    key = (address, signature, message)
+    if _is_verified(key):
+        return True
+    elif crypto.verify(address, signature, message):
+        _remember_verified(key)
+        return True
+    else:
+        return False
+
+
 def _is_valid_change(change: Change) -> bool:
     expected_change_id = derive_change_id(change)
     if change.change_id == expected_change_id:
-        return crypto.verify(change.address, change.signature, change.change_id + change.rev)
+        return _verify_signature(change.address, change.signature, change.change_id + change.rev)
     else:
         raise AssertionError(f"Invalid change_id {change.change_id} != {expected_change_id}")
 
 
 def make_change(
-    wif       : str,
-    doctype   : DocType,
-    opcode    : str,
-    opdata    : dict[str, typ.Any],
-    parent_id : ChangeId | None = None,
-    parent_rev: Revision | None = None,
-    difficulty: int = DEFAULT_DIFFICULTY_BITS,
+    wif        : str,
+    doctype    : DocType,
+    opcode     : str,
+    opdata     : dict[str, typ.Any],
+    parent_id  : ChangeId | None = None,
+    parent_rev : Revision | None = None,
+    difficulty : int = DEFAULT_DIFFICULTY_BITS,
+    pow_workers: int = DEFAULT_POW_WORKERS,
 ) -> Change:
-    address = crypto.get_wif_address(wif)
-    change  = Change(
-        address=address,
+    signer = crypto.Signer(wif)
+    change = Change(
+        address=signer.address,
         doctype=doctype,
         opcode=opcode,
         opdata=opdata,
@@ -156,11 +307,71 @@ def make_change(
     )
     change.change_id     = derive_change_id(change)
     change.rev           = increment_revision(doctype, change.change_id, parent_rev)
-    change.signature     = crypto.sign(message=change.change_id + change.rev, wif=wif)
-    change.proof_of_work = calculate_pow(change.change_id, difficulty)
+    change.signature     = signer.sign(change.change_id + change.rev)
+    change.proof_of_work = calculate_pow(change.change_id, difficulty, workers=pow_workers)
     return change
 
 
+class ChangeSpec(typ.NamedTuple):
+    doctype   : DocType
+    opcode    : str
+    opdata    : dict[str, typ.Any]
+    parent_id : ChangeId | None = None
+    parent_rev: Revision | None = None
+
+
+# Number of changes which are hashed and signed before their proof of
+# work is calculated in the process pool.
+MAKE_CHANGES_BATCH_SIZE = 256
+
+
+def make_changes(
+    wif        : str,
+    specs      : typ.Iterable[ChangeSpec],
+    difficulty : int = DEFAULT_DIFFICULTY_BITS,
+    pow_workers: int = DEFAULT_POW_WORKERS,
+) -> typ.Iterator[Change]:
+    """Bulk version of make_change.
+
+    The key is parsed only once. Changes are hashed and signed in
+    batches, the proof of work for a batch is calculated by a pool of
+    pow_workers processes. Changes are yielded in the order of specs.
+    """
+    signer = crypto.Signer(wif)
+
+    specs_iter = iter(specs)
+    while batch := list(itertools.islice(specs_iter, MAKE_CHANGES_BATCH_SIZE)):
+        changes = []
+        for spec in batch:
+            change = Change(
+                address=signer.address,
+                doctype=spec.doctype,
+                opcode=spec.opcode,
+                opdata=spec.opdata,
+                parent_id=spec.parent_id,
+                rev="invalid",
+                change_id="invalid",
+                signature="invalid",
+                proof_of_work="invalid",
+            )
+            change.change_id = derive_change_id(change)
+            change.rev       = increment_revision(spec.doctype, change.change_id, spec.parent_rev)
+            change.signature = signer.sign(change.change_id + change.rev)
+            changes.append(change)
+
+        change_ids = [change.change_id for change in changes]
+        calc_pow   = functools.partial(calculate_pow, difficulty=difficulty)
+        if pow_workers > 1:
+            chunksize = max(1, len(change_ids) // (pow_workers * 4))
+            pow_strs  = _pow_executor(pow_workers).map(calc_pow, change_ids, chunksize=chunksize)
+        else:
+            pow_strs = map(calc_pow, change_ids)
+
+        for change, pow_str in zip(changes, pow_strs):
+            change.proof_of_work = pow_str
+            yield change
+
+
 class VerificationError(Exception):
     pass
 
@@ -168,24 +379,282 @@ class VerificationError(Exception):
 def verify_change(change: Change) -> bool:
     change_id = derive_change_id(change)
     if change.change_id == change_id:
-        return crypto.verify(change.address, change.signature, message=change_id + change.rev)
+        return _verify_signature(change.address, change.signature, change_id + change.rev)
     else:
         errmsg = f"change_id {change.change_id} != {change_id}"
         raise VerificationError(errmsg)
 
 
-def loads_change(change_data: bytes) -> Change:
-    change_dict = json.loads(change_data.decode("utf-8"))
-    change      = Change(**change_dict)
+def verify_changes(
+    changes: typ.Sequence[Change],
+    workers: int = crypto.DEFAULT_VERIFY_WORKERS,
+) -> list[bool]:
+    """Verify a batch of changes, returns one result per change.
+
+    Unlike verify_change, a change with an invalid change_id is
+    reported as invalid rather than raising VerificationError.
+    Signatures are verified with crypto.verify_many, using a process
+    pool if workers > 1.
+    """
+    results = [False] * len(changes)
+
+    pending: dict[int, tuple[str, str, str]] = {}
+    for idx, change in enumerate(changes):
+        if change.change_id != derive_change_id(change):
+            continue
+
+        key = (change.address, change.signature, change.change_id + change.rev)
+        if _is_verified(key):
+            results[idx] = True
+        else:
+            pending[idx] = key
+
+    verified = crypto.verify_many(list(pending.values()), workers=workers)
+    for (idx, key), is_valid in zip(pending.items(), verified):
+        if is_valid:
+            _remember_verified(key)
+        results[idx] = is_valid
+
+    return results
+
+
+ChangeCodec = typ.Literal['json', 'orjson', 'binary']
+
+CODEC_JSON  : ChangeCodec = "json"
+CODEC_ORJSON: ChangeCodec = "orjson"
+CODEC_BINARY: ChangeCodec = "binary"
 
-    if _is_valid_change(change):
+DEFAULT_CHANGE_CODEC: ChangeCodec = CODEC_BINARY
+
+# Binary records start with a magic byte (which is never the first byte
+# of a JSON record), the version of the format and flags.
+BINARY_MAGIC   = b"\xc7"
+BINARY_VERSION = 1
+
+_BINARY_HEADER = struct.Struct("<cBB")
+_STR_LEN       = struct.Struct("<H")
+_DATA_LEN      = struct.Struct("<I")
+
+_FLAG_HAS_PARENT = 0x1
+_FLAG_RAW_IDS    = 0x2  # change_id/parent_id as 32 bytes instead of hex
+_FLAG_RAW_SIG    = 0x4  # signature as 65 bytes instead of base64
+
+_ID_SIZE  = 32
+_SIG_SIZE = 65
+
+
+# Integers with this many digits may not fit into 64 bits.
+_MAYBE_BIG_INT_RE = re.compile(rb"\d{19,}")
+
+
+def _dumps_json(obj: typ.Any) -> bytes:
+    try:
+        return orjson.dumps(obj)
+    except TypeError:
+        # orjson can't serialize ints > 64 bit
+        return json.dumps(obj).encode("utf-8")
+
+
+def _loads_json(data: bytes) -> typ.Any:
+    # orjson parses ints > 64 bit as floats, losing precision
+    if _MAYBE_BIG_INT_RE.search(data) is None:
+        return orjson.loads(data)
+    else:
+        return json.loads(data)
+
+
+def _loads_json_dict(data: bytes) -> dict[str, typ.Any]:
+    obj = _loads_json(data)
+    if isinstance(obj, dict):
+        return obj
+    else:
+        raise ValueError(f"Invalid data: expected a JSON object, got {type(obj).__name__}")
+
+
+def _is_raw_id(change_id: ChangeId | None) -> bool:
+    if change_id is None:
+        return True
+    try:
+        return len(change_id) == _ID_SIZE * 2 and bytes.fromhex(change_id).hex() == change_id
+    except ValueError:
+        return False
+
+
+def _raw_signature(signature: str) -> bytes | None:
+    try:
+        raw_sig = base64.b64decode(signature, validate=True)
+    except ValueError:
+        return None
+
+    if len(raw_sig) == _SIG_SIZE and base64.b64encode(raw_sig).decode("ascii") == signature:
+        return raw_sig
+    else:
+        return None
+
+
+def _pack_str(value: str) -> bytes:
+    data = value.encode("utf-8")
+    return _STR_LEN.pack(len(data)) + data
+
+
+def _unpack_str(data: bytes, offset: int) -> tuple[str, int]:
+    (size,) = _STR_LEN.unpack_from(data, offset)
+    start   = offset + _STR_LEN.size
+    if start + size > len(data):
+        raise ValueError("Invalid change data: truncated")
+    return data[start : start + size].decode("utf-8"), start + size
+
+
+def _dumps_change_binary(change: Change) -> bytes:
+    flags   = 0
+    raw_ids = _is_raw_id(change.change_id) and _is_raw_id(change.parent_id)
+    raw_sig = _raw_signature(change.signature)
+
+    if change.parent_id is not None:
+        flags |= _FLAG_HAS_PARENT
+    if raw_ids:
+        flags |= _FLAG_RAW_IDS
+    if raw_sig is not None:
+        flags |= _FLAG_RAW_SIG
+
+    parts = [_BINARY_HEADER.pack(BINARY_MAGIC, BINARY_VERSION, flags)]
+
+    for change_id in (change.change_id, change.parent_id):
+        if change_id is None:
+            continue
+        elif raw_ids:
+            parts.append(bytes.fromhex(change_id))
+        else:
+            parts.append(_pack_str(change_id))
+
+    if raw_sig is None:
+        parts.append(_pack_str(change.signature))
+    else:
+        parts.append(raw_sig)
+
+    for value in (change.address, change.doctype, change.opcode, change.rev, change.proof_of_work):
+        parts.append(_pack_str(value))
+
+    opdata = _dumps_json(change.opdata)
+    parts.append(_DATA_LEN.pack(len(opdata)))
+    parts.append(opdata)
+    return b"".join(parts)
+
+
+def _loads_change_binary(change_data: bytes) -> Change:
+    _, version, flags = _BINARY_HEADER.unpack_from(change_data)
+    if version != BINARY_VERSION:
+        raise ValueError(f"Invalid change data: unknown version {version}")
+
+    offset = _BINARY_HEADER.size
+
+    ids: list[str] = []
+    for _ in range(2 if flags & _FLAG_HAS_PARENT else 1):
+        if flags & _FLAG_RAW_IDS:
+            ids.append(change_data[offset : offset + _ID_SIZE].hex())
+            offset += _ID_SIZE
+        else:
+            change_id, offset = _unpack_str(change_data, offset)
+            ids.append(change_id)
+
+    if flags & _FLAG_RAW_SIG:
+        signature = base64.b64encode(change_data[offset : offset + _SIG_SIZE]).decode("ascii")
+        offset += _SIG_SIZE
+    else:
+        signature, offset = _unpack_str(change_data, offset)
+
+    address      , offset = _unpack_str(change_data, offset)
+    doctype      , offset = _unpack_str(change_data, offset)
+    opcode       , offset = _unpack_str(change_data, offset)
+    rev          , offset = _unpack_str(change_data, offset)
+    proof_of_work, offset = _unpack_str(change_data, offset)
+
+    (opdata_len,) = _DATA_LEN.unpack_from(change_data, offset)
+    offset += _DATA_LEN.size
+    if offset + opdata_len != len(change_data):
+        raise ValueError("Invalid change data: invalid length")
+
+    opdata = _loads_json_dict(change_data[offset:])
+
+    # The binary format determines the types of all fields, so
+    # validation by pydantic can be skipped.
+    return Change.construct(
+        address=address,
+        doctype=DocType(doctype),
+        opcode=opcode,
+        opdata=opdata,
+        parent_id=ids[1] if len(ids) == 2 else None,
+        change_id=ids[0],
+        rev=Revision(rev),
+        signature=signature,
+        proof_of_work=proof_of_work,
+    )
+
+
+def _decode_change(change_data: bytes) -> Change:
+    if change_data[:1] == BINARY_MAGIC:
+        try:
+            return _loads_change_binary(change_data)
+        except (struct.error, UnicodeDecodeError, json.JSONDecodeError) as err:
+            raise ValueError(f"Invalid change data: {err}") from err
+    else:
+        # Both the json and the orjson codec (and records written before
+        # there were codecs) are JSON.
+        return Change(**_loads_json_dict(change_data))
+
+
+def loads_change(change_data: bytes, verify: bool = True) -> Change:
+    """Deserialize a change (written with any of the codecs).
+
+    Only use verify=False for trusted data, e.g. changes which were
+    verified before they were written to local storage.
+    """
+    change = _decode_change(change_data)
+
+    if not verify or _is_valid_change(change):
         return change
     else:
         raise VerificationError(change_data)
 
 
-def dumps_change(change: Change) -> bytes:
-    return json.dumps(change.dict()).encode("utf-8")
+def dumps_change(change: Change, codec: ChangeCodec = DEFAULT_CHANGE_CODEC) -> bytes:
+    if codec == CODEC_BINARY:
+        return _dumps_change_binary(change)
+    elif codec == CODEC_ORJSON:
+        return _dumps_json(change.dict())
+    elif codec == CODEC_JSON:
+        return json.dumps(change.dict()).encode("utf-8")
+    else:
+        raise ValueError(f"Invalid codec: {codec}")
+
+
+class Snapshot(pydantic.BaseModel):
+    """Materialized document after applying all changes up to change_id.
+
+    Snapshots are a local cache, they are neither signed nor replicated.
+    """
+
+    change_id: ChangeId
+    rev      : Revision
+    doctype  : DocType
+    doc      : dict[str, typ.Any]
+    doc_hash : str = ""  # see snapshot_doc_hash
+
+
+def snapshot_doc_hash(doc: dict[str, typ.Any]) -> str:
+    return hashlib.sha256(_dumps_json(doc)).hexdigest()
+
+
+def make_snapshot(change_id: ChangeId, rev: Revision, doctype: DocType, doc: dict[str, typ.Any]) -> Snapshot:
+    return Snapshot(change_id=change_id, rev=rev, doctype=doctype, doc=doc, doc_hash=snapshot_doc_hash(doc))
+
+
+def loads_snapshot(snapshot_data: bytes) -> Snapshot:
+    return Snapshot(**_loads_json_dict(snapshot_data))
+
+
+def dumps_snapshot(snapshot: Snapshot) -> bytes:
+    return _dumps_json(snapshot.dict())
 
 
 # class DocumentReference(typ.NamedTuple):
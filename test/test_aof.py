@@ -0,0 +1,131 @@
+# pylint: disable=redefined-outer-name
+# pylint: disable=unused-argument
+import pathlib as pl
+
+import pytest
+
+from guarantor import aof
+
+
+def _items(start: int, stop: int) -> dict[str, bytes]:
+    return {f"key{i:04d}": f"value{i}".encode("ascii") * (i % 7 + 1) for i in range(start, stop)}
+
+
+def test_put_get(tmpdir):
+    log_dir = pl.Path(tmpdir) / "log"
+    items   = _items(0, 100)
+
+    with aof.AppendOnlyLog(log_dir, flag='c', max_segment_size=1024) as log:
+        log.put_many(_items(0, 50))
+        log.put_many(_items(50, 100))
+        for key, value in items.items():
+            assert log.get(key) == value
+        assert log.get("missing") is None
+        assert log.get_many(["key0042", "missing", "key0001"]) == {
+            'key0042': items["key0042"],
+            'key0001': items["key0001"],
+        }
+
+        assert len(log.segment_paths()) > 1
+
+    with aof.AppendOnlyLog(log_dir, flag='r') as log:
+        assert sorted(log.keys()) == sorted(items)
+        for key, value in items.items():
+            assert log.get(key) == value
+
+
+def test_reader_catch_up(tmpdir):
+    log_dir = pl.Path(tmpdir) / "log"
+    with aof.AppendOnlyLog(log_dir, flag='c') as writer:
+        writer.put_many(_items(0, 10))
+
+        reader = aof.AppendOnlyLog(log_dir, flag='r')
+        assert reader.get("key0011") is None
+
+        writer.put_many(_items(10, 20))
+        assert reader.get("key0011") == _items(11, 12)["key0011"]
+        reader.close()
+
+        with pytest.raises(Exception):
+            reader.put_many(_items(0, 1))
+
+
+def test_snapshot_and_replay(tmpdir):
+    log_dir = pl.Path(tmpdir) / "log"
+    with aof.AppendOnlyLog(log_dir, flag='c', snapshot_interval=10) as log:
+        log.put_many(_items(0, 15))
+        assert (log_dir / aof.SNAPSHOT_NAME).exists()
+        log.put_many(_items(15, 18))
+
+    # records after the snapshot watermark are replayed
+    (log_dir / aof.SNAPSHOT_NAME).unlink()
+    with aof.AppendOnlyLog(log_dir, flag='c', snapshot_interval=10) as log:
+        log.put_many(_items(18, 20))
+
+    with aof.AppendOnlyLog(log_dir, flag='r') as log:
+        assert len(log.keys()) == 20
+        assert log.get("key0019") == _items(19, 20)["key0019"]
+
+
+def test_torn_tail_recovery(tmpdir):
+    log_dir = pl.Path(tmpdir) / "log"
+    with aof.AppendOnlyLog(log_dir, flag='c', snapshot_interval=1000) as log:
+        log.put_many(_items(0, 10))
+
+    (log_dir / aof.SNAPSHOT_NAME).unlink()
+    segment_path = log_dir / "00000001.aof"
+    valid_size   = segment_path.stat().st_size
+    with segment_path.open(mode="ab") as fobj:
+        record = aof.encode_record(b"key9999", b"incomplete")
+        fobj.write(record[:-3])
+
+    with aof.AppendOnlyLog(log_dir, flag='c') as log:
+        assert segment_path.stat().st_size == valid_size
+        assert log.get("key9999") is None
+        assert len(log.keys()) == 10
+
+        log.put_many(_items(10, 12))
+        assert log.get("key0011") == _items(11, 12)["key0011"]
+
+
+def test_compact(tmpdir):
+    log_dir = pl.Path(tmpdir) / "log"
+    with aof.AppendOnlyLog(log_dir, flag='c', max_segment_size=512) as log:
+        log.put_many(_items(0, 20))
+        # supersede some of the records
+        log.put_many({key: b"new" + value for key, value in _items(0, 10).items()})
+
+        size_before = sum(path.stat().st_size for path in log.segment_paths())
+        log.compact()
+        size_after = sum(path.stat().st_size for path in log.segment_paths())
+        assert size_after < size_before
+
+        for key, value in _items(0, 10).items():
+            assert log.get(key) == b"new" + value
+        for key, value in _items(10, 20).items():
+            assert log.get(key) == value
+
+    with aof.AppendOnlyLog(log_dir, flag='r') as log:
+        for key, value in _items(0, 10).items():
+            assert log.get(key) == b"new" + value
+
+
+def test_reader_after_compact(tmpdir):
+    log_dir = pl.Path(tmpdir) / "log"
+    with aof.AppendOnlyLog(log_dir, flag='c', max_segment_size=512) as writer:
+        writer.put_many(_items(0, 20))
+        writer.put_many({key: b"new" + value for key, value in _items(0, 10).items()})
+
+        reader = aof.AppendOnlyLog(log_dir, flag='r')
+        assert reader.get("key0015") == _items(15, 16)["key0015"]
+
+        # the reader's index points to records which compact moves
+        writer.compact()
+        writer.put_many(_items(20, 25))
+
+        for key, value in _items(10, 25).items():
+            assert reader.get(key) == value
+        for key, value in _items(0, 10).items():
+            assert reader.get(key) == b"new" + value
+        assert sorted(reader.keys()) == sorted(_items(0, 25))
+        reader.close()
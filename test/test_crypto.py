@@ -1,5 +1,7 @@
+import base64
 from collections import OrderedDict
 
+import jcs
 import pytest
 from pycoin.symbols.btc import network as BTC
 
@@ -108,6 +110,67 @@ def test_compatibility():
             assert crypto.verify(wif_addr, sig, msg)
 
 
+def test_signer():
+    for wif, expected_addr in fixtures.KEYS_FIXTURES:
+        signer = crypto.Signer(wif)
+        assert signer.address == expected_addr
+
+        msg = "test message"
+        sig = signer.sign(msg)
+        assert sig == crypto.sign(msg, wif)
+        assert crypto.verify(signer.address, sig, msg)
+
+    with pytest.raises(ValueError, match=r"Invalid WIF: foo"):
+        crypto.Signer("foo")
+
+
+def test_verify_cached_pubkey():
+    wif, address = fixtures.KEYS_FIXTURES[0]
+    _, other_address = fixtures.KEYS_FIXTURES[1]
+    sig = crypto.sign("test message", wif)
+
+    crypto._pubkeys.clear()
+    assert not crypto.verify(other_address, sig, "test message")
+    assert other_address not in crypto._pubkeys
+
+    assert crypto.verify(address, sig, "test message")
+    assert address in crypto._pubkeys
+
+    # with the cached public key, the signature is verified directly
+    assert crypto.verify(address, sig, "test message")
+    assert crypto.verify(address, crypto.sign("other message", wif), "other message")
+    assert not crypto.verify(address, sig, "other message")
+    assert not crypto.verify(address, "not a signature", "test message")
+
+    # a signature with a different recovery id is invalid, with or without the cached key
+    sig_data = base64.b64decode(sig)
+    for recid_flip in (1, 2, 3):
+        tampered = base64.b64encode(bytes([sig_data[0] ^ recid_flip]) + sig_data[1:]).decode("ascii")
+        assert crypto.verify(address, sig, "test message")
+        assert not crypto.verify(address, tampered, "test message")
+
+        crypto._pubkeys.clear()
+        assert not crypto.verify(address, tampered, "test message")
+        assert address not in crypto._pubkeys
+
+
+def test_verify_many():
+    items = []
+    for wif, address in fixtures.KEYS_FIXTURES:
+        for i in range(5):
+            msg = f"test message {i}"
+            items.append((address, crypto.sign(msg, wif), msg))
+            items.append((address, crypto.sign(msg, wif), "other message"))
+
+    expected = [True, False] * (len(items) // 2)
+    assert crypto.verify_many(items) == expected
+    assert crypto.verify_many(items, workers=2) == expected
+
+    crypto.shutdown_verify_executors()
+    assert not crypto._verify_executors
+    assert crypto.verify_many(items, workers=2) == expected
+
+
 def test_validate_address():
     crypto.validate_address("1LsPb3D1o1Z7CzEt1kv5QVxErfqzXxaZXv")
 
@@ -147,3 +210,17 @@ def test_deterministic_hash():
         crypto.deterministic_json_hash(OrderedDict([('b', 'bar'), ('a', 'foo')]))
         == "d695d9c070d88814ac7364ba48d2aa387abe1238c760c06e8cd359758cc0d16a"
     )
+
+
+def test_canonical_json():
+    samples = [
+        None,
+        "foo",
+        {'b': [1, -2, True, False, None], 'a': {'z': "\x1f\u2028é\n", 'y': []}},
+        [2 ** 53, -(2 ** 53), 2 ** 53 + 1, 2 ** 70],
+        {'float': 0.1, 'exp': 1e21, 'neg_zero': -0.0},
+        {'é': 1, '\ue000': 2, '\U0001f600': 3},
+        ("tuple", 1),
+    ]
+    for obj in samples:
+        assert crypto.canonical_json(obj) == jcs.canonicalize(obj)
@@ -1,5 +1,12 @@
 # pylint: disable=redefined-outer-name
 # pylint: disable=unused-argument
+import asyncio
+import threading
+
+import pytest
+
+from guarantor import dal as dal_module
+from guarantor import docdiff
 from guarantor import schemas
 from guarantor.dal import DataAccessLayer
 
@@ -34,3 +41,465 @@ def test_search(tmpdir):
 
     assert doc_wrp_a == dal.find_one("guarantor.schemas:GenericDocument", title="hello")
     assert doc_wrp_a == dal.find_one("guarantor.schemas:GenericDocument", title="World")
+
+
+def test_search_after_restart(tmpdir):
+    with DataAccessLayer(wif=fixtures.KEYS_FIXTURES[0].wif, db_dir=tmpdir) as dal:
+        doc_wrp = dal.new(schemas.GenericDocument, title="Hello, World!", props={}).save()
+
+    with DataAccessLayer(wif=fixtures.KEYS_FIXTURES[0].wif, db_dir=tmpdir) as dal:
+        assert doc_wrp == dal.find_one("guarantor.schemas:GenericDocument", title="World")
+
+
+def test_search_live_heads(tmpdir):
+    dal = DataAccessLayer(wif=fixtures.KEYS_FIXTURES[0].wif, db_dir=tmpdir)
+
+    doc_wrp = dal.new(schemas.GenericDocument, title="Hello v0", props={}).save()
+    for i in range(1, 4):
+        doc_wrp = doc_wrp.update(title=f"Hello v{i}").save()
+
+    found = list(dal.find("guarantor.schemas:GenericDocument", title="Hello"))
+    assert {doc_wrp.head} == {found_wrp.head for found_wrp in found}
+    assert list(dal.find("guarantor.schemas:GenericDocument", title="v0")) == []
+
+
+def test_search_forked_doc(tmpdir):
+    dal = DataAccessLayer(wif=fixtures.KEYS_FIXTURES[0].wif, db_dir=tmpdir)
+
+    doc_wrp  = dal.new(schemas.GenericDocument, title="Hello v0", props={}).save()
+    fork_a   = doc_wrp.update(title="Hello a").save()
+    fork_b   = doc_wrp.update(title="Hello b").save()
+    expected = max([fork_a, fork_b], key=lambda wrp: (wrp.head_rev, wrp.head))
+
+    found = list(dal.find("guarantor.schemas:GenericDocument", title="Hello"))
+    assert [found_wrp.head for found_wrp in found] == [expected.head]
+
+
+def test_search_resaved_forked_doc(tmpdir):
+    dal     = DataAccessLayer(wif=fixtures.KEYS_FIXTURES[0].wif, db_dir=tmpdir)
+    doctype = "guarantor.schemas:GenericDocument"
+
+    doc_wrp = dal.new(schemas.GenericDocument, title="Hello v0", props={}).save()
+    doc_id  = dal.indexes.doc_id(doctype, doc_wrp.head)
+    assert doc_id == doc_wrp.changes[0].change_id
+
+    # saving without changes doesn't touch the index
+    doc_wrp = doc_wrp.save()
+    assert dal.indexes.doc_id(doctype, doc_wrp.head) == doc_id
+
+    fork_a = doc_wrp.update(title="Hello a").save()
+    fork_b = doc_wrp.update(title="Hello b").save()
+    assert dal.indexes.doc_id(doctype, fork_a.head) == doc_id
+    assert dal.indexes.doc_id(doctype, fork_b.head) == doc_id
+    assert len(list(dal.find(doctype, title="Hello"))) == 1
+
+    # the doc_id of a head doesn't change when it's indexed again
+    dal.indexes.update(fork_a.head, fork_a.doc, head_rev=fork_a.head_rev)
+    assert dal.indexes.doc_id(doctype, fork_a.head) == doc_id
+
+
+def test_search_multiple_fields(tmpdir):
+    dal = DataAccessLayer(wif=fixtures.KEYS_FIXTURES[0].wif, db_dir=tmpdir)
+
+    heads = set()
+    for name, email in [("Alice", "alice@a.com"), ("Alice", "alice@b.com"), ("Bob", "bob@a.com")]:
+        doc_wrp = dal.new(schemas.Identity, address=f"addr_{email}", props={'name': name, 'email': email}).save()
+        heads.add(doc_wrp.head)
+
+    doctype = "guarantor.schemas:Identity"
+    found   = list(dal.find(doctype, **{'props.name': "Alice", 'props.email': "a.com"}))
+    assert [doc_wrp.doc.props['email'] for doc_wrp in found] == ["alice@a.com"]
+
+    page_1 = list(dal.find(doctype, limit=2, address="addr"))
+    page_2 = list(dal.find(doctype, limit=2, offset=2, address="addr"))
+    assert len(page_1) == 2
+    assert len(page_2) == 1
+    assert {doc_wrp.head for doc_wrp in page_1 + page_2} == heads
+
+    # fields with reserved names (limit, offset, ...) can be searched using query
+    found = list(dal.find(doctype, {'props.name': "Alice"}, limit=1, address="addr"))
+    assert len(found) == 1
+    assert found[0].doc.props['name'] == "Alice"
+    assert dal.find_one(doctype, {'props.name': "Bob"}).doc.props['name'] == "Bob"
+    with pytest.raises(TypeError):
+        dal.find(doctype, {}, limit=1)
+
+
+def test_find_result_set(tmpdir):
+    dal = DataAccessLayer(wif=fixtures.KEYS_FIXTURES[0].wif, db_dir=tmpdir, prefetch=2)
+
+    doc_wrps = []
+    for i in range(5):
+        doc_wrps.append(dal.new(schemas.GenericDocument, title=f"Hello {i}", props={}).save())
+    doc_wrps[1] = doc_wrps[1].update(title="Hello 1 v1").save()
+
+    doctype    = "guarantor.schemas:GenericDocument"
+    result_set = dal.find(doctype, title="Hello")
+    assert len(result_set) == 5
+    assert [doc_wrp.head for doc_wrp in result_set] == [item.head for item in result_set.matches()]
+
+    # matches are ordered by revision, without loading any documents
+    newest = dal.find(doctype, newest_first=True, title="Hello")
+    revs   = [item.head_rev for item in newest.matches()]
+    assert revs == sorted(revs, reverse=True)
+    assert revs[0] == max(doc_wrp.head_rev for doc_wrp in doc_wrps)
+    assert newest.first().head_rev == revs[0]
+    assert dal.find_one(doctype, title="Hello") == newest.first()
+
+    page = dal.find(doctype, limit=2, offset=1, newest_first=True, title="Hello")
+    assert [doc_wrp.head for doc_wrp in page] == [item.head for item in newest.matches()][1:3]
+
+    dal.prefetch = 0
+    assert {doc_wrp.head for doc_wrp in result_set} == {doc_wrp.head for doc_wrp in doc_wrps}
+    assert dal.find(doctype, title="nothing").first() is None
+    dal.close()
+
+
+def test_document_cache(tmpdir):
+    dal = DataAccessLayer(wif=fixtures.KEYS_FIXTURES[0].wif, db_dir=tmpdir, cache_size=2)
+
+    doc_wrps = [dal.new(schemas.GenericDocument, title=f"doc{i}", props={}).save() for i in range(3)]
+
+    loaded = dal.get(doc_wrps[0].head)
+    assert dal.cache.stats().misses == 1
+
+    cached = dal.get(doc_wrps[0].head)
+    assert dal.cache.stats().hits == 1
+    assert cached == loaded
+    assert cached.doc == loaded.doc
+    assert cached.changes is loaded.changes
+
+    # modifications of a wrapper's document don't leak into the cache
+    cached.doc.title = "modified"
+    assert dal.get(doc_wrps[0].head).doc.title == "doc0"
+    assert cached._verified is not None
+    assert cached._verified.doc.title == "doc0"
+
+    # nor into the verified state of new or updated wrappers
+    updated = cached.update(title="doc0 v1")
+    updated.doc.props['key'] = "modified"
+    assert updated._verified is not None
+    assert updated._verified.doc.props == {}
+
+    dal.get(doc_wrps[1].head)
+    dal.get(doc_wrps[2].head)
+    stats = dal.cache.stats()
+    assert stats.num_entries == 2
+    assert stats.evictions   == 1
+
+    dal.get(doc_wrps[0].head)
+    assert dal.cache.stats().misses == 4
+
+    # size based eviction
+    dal.cache.max_bytes = dal.cache.stats().num_bytes // 2
+    dal.get(doc_wrps[1].head)
+    assert len(dal.cache) == 1
+
+    uncached_dal = DataAccessLayer(wif=fixtures.KEYS_FIXTURES[0].wif, db_dir=tmpdir, cache_size=0)
+    assert uncached_dal.get(doc_wrps[0].head) == doc_wrps[0]
+    assert len(uncached_dal.cache) == 0
+
+
+def test_async_dal(tmpdir, monkeypatch):
+    dal = DataAccessLayer(wif=fixtures.KEYS_FIXTURES[0].wif, db_dir=tmpdir)
+
+    doc_wrps = [dal.new(schemas.GenericDocument, title=f"Hello {i}", props={}).save() for i in range(3)]
+    heads    = [doc_wrp.head for doc_wrp in doc_wrps]
+
+    # a separate dal, so that the documents are not cached yet
+    load_dal   = DataAccessLayer(wif=fixtures.KEYS_FIXTURES[0].wif, db_dir=tmpdir)
+    async_dal  = dal_module.AsyncDataAccessLayer(load_dal)
+    load_batch = async_dal._load_batch
+    batches    = []
+
+    def _recording_load_batch(batch_heads):
+        batches.append(batch_heads)
+        return load_batch(batch_heads)
+
+    monkeypatch.setattr(async_dal, '_load_batch', _recording_load_batch)
+
+    async def _main():
+        async with async_dal:
+            # concurrent requests are coalesced into a single batch
+            results = await asyncio.gather(
+                async_dal.get(heads[0]),
+                async_dal.get(heads[0]),
+                async_dal.get_many(heads),
+            )
+            assert batches == [heads]
+            assert results[0] == results[1] == doc_wrps[0]
+            assert results[0] is not results[1]
+            assert results[2] == doc_wrps
+
+            found = await async_dal.find("guarantor.schemas:GenericDocument", title="Hello")
+            assert sorted(doc_wrp.head for doc_wrp in found) == sorted(heads)
+
+            saved = await async_dal.save(found[0].update(title="Hello again"))
+            assert (await async_dal.get(saved.head)).doc.title == "Hello again"
+
+            with pytest.raises(Exception):
+                await async_dal.get("0" * 64)
+
+        # the executor is shut down without blocking the event loop
+        assert shutdown_threads and shutdown_threads[0] is not threading.current_thread()
+
+    shutdown_threads = []
+    shutdown         = async_dal._executor.shutdown
+
+    def _recording_shutdown(*args, **kwargs):
+        shutdown_threads.append(threading.current_thread())
+        return shutdown(*args, **kwargs)
+
+    monkeypatch.setattr(async_dal._executor, 'shutdown', _recording_shutdown)
+    asyncio.run(_main())
+
+
+def test_get_many(tmpdir, monkeypatch):
+    dal = DataAccessLayer(wif=fixtures.KEYS_FIXTURES[0].wif, db_dir=tmpdir, snapshot_interval=0)
+
+    props   = {f"key{i}": f"value{i}" for i in range(20)}
+    doc_wrp = dal.new(schemas.GenericDocument, title="v0", props=props).save()
+    for i in range(1, 4):
+        doc_wrp = doc_wrp.update(title=f"v{i}").save()
+    branch_a = doc_wrp.update(title="a").save()
+    branch_b = doc_wrp.update(title="b").save()
+    other    = dal.new(schemas.GenericDocument, title="other", props={}).save()
+
+    # a separate dal, so that the documents are not cached yet
+    load_dal  = DataAccessLayer(wif=fixtures.KEYS_FIXTURES[0].wif, db_dir=tmpdir)
+    read_ids  = []
+    read_many = load_dal.kvstore.read_many
+
+    def _recording_read_many(change_ids):
+        read_ids.extend(change_ids)
+        return read_many(change_ids)
+
+    monkeypatch.setattr(load_dal.kvstore, 'read_many', _recording_read_many)
+
+    missing_head = "0" * 64
+    heads   = [branch_b.head, other.head, missing_head, branch_a.head, other.head]
+    results = load_dal.get_many(heads)
+
+    assert results[0] == branch_b
+    assert results[1] == other
+    assert isinstance(results[2], dal_module.LoadError)
+    assert results[3] == branch_a
+    assert results[4] == other
+    titles = [result.doc.title for result in results if not isinstance(result, Exception)]
+    assert titles == ["b", "other", "a", "other"]
+
+    # the shared ancestors of branch_a and branch_b are only read once
+    history = dal.get_history(branch_a.head)
+    assert len(history) == 5
+    assert len(read_ids) == len(set(read_ids))
+    expected_ids = {change.change_id for change in history} | {branch_b.head, other.head, missing_head}
+    assert set(read_ids) == expected_ids
+
+    assert load_dal.get_many([branch_a.head])[0].doc == load_dal.get(branch_a.head).doc
+
+    # invalid changes are reported per head
+    storage = dal.kvstore._get_storage(dal.kvstore.storage_path(other.head))
+    storage.put_many({other.head: dal.kvstore.read_many([branch_a.head])[branch_a.head]})
+    results = DataAccessLayer(wif=None, db_dir=tmpdir).get_many([other.head, branch_a.head])
+    assert isinstance(results[0], dal_module.LoadError)
+    assert results[1] == branch_a
+
+
+def test_get_many_aof(tmpdir):
+    # nothing was written yet
+    reader  = DataAccessLayer(wif=None, db_dir=tmpdir, backend="aof", flag='r')
+    results = reader.get_many(["0" * 64])
+    assert isinstance(results[0], dal_module.LoadError)
+    assert reader.kvstore.get("0" * 64) is None
+    assert reader.kvstore.get_snapshot("0" * 64) is None
+
+    # no snapshots were written
+    writer  = DataAccessLayer(wif=fixtures.KEYS_FIXTURES[0].wif, db_dir=tmpdir, backend="aof", snapshot_interval=0)
+    doc_wrp = writer.new(schemas.GenericDocument, title="v0", props={}).save()
+    doc_wrp = doc_wrp.update(title="v1").save()
+
+    reader  = DataAccessLayer(wif=None, db_dir=tmpdir, backend="aof", flag='r')
+    results = reader.get_many([doc_wrp.head, "0" * 64])
+    assert results[0] == doc_wrp
+    assert results[0].doc.title == "v1"
+    assert isinstance(results[1], dal_module.LoadError)
+
+    async def _get_many():
+        async with dal_module.AsyncDataAccessLayer(reader) as async_dal:
+            return await async_dal.get_many([doc_wrp.head])
+
+    assert [loaded.head for loaded in asyncio.run(_get_many())] == [doc_wrp.head]
+
+
+def test_snapshots(tmpdir):
+    dal = DataAccessLayer(wif=fixtures.KEYS_FIXTURES[0].wif, db_dir=tmpdir, snapshot_interval=1)
+
+    doc_wrp = dal.new(schemas.GenericDocument, title="v0", props={}).save()
+    for i in range(1, 5):
+        doc_wrp = doc_wrp.update(title=f"v{i}").save()
+
+    loaded = dal.get(head=doc_wrp.head)
+    assert loaded.doc == doc_wrp.doc
+    assert loaded.changes == []
+    assert loaded.base is not None
+    assert loaded.base.change_id == doc_wrp.head
+
+    updated = loaded.update(title="v5")
+    assert updated.tmp_changes[0].parent_id == doc_wrp.head
+    updated = updated.save()
+    assert dal.get(head=updated.head).doc.title == "v5"
+
+    # a modified snapshot is not used, the changes are replayed instead
+    snapshot = dal.kvstore.get_snapshot(updated.head)
+    snapshot.doc['title'] = "tampered"
+    dal.kvstore.post_snapshot(snapshot)
+    dal.cache.clear()
+    loaded = dal.get(head=updated.head)
+    assert loaded.doc.title == "v5"
+    assert loaded.base is None or loaded.base.change_id != updated.head
+
+    # without snapshots the chain is replayed (back to the most recent reset)
+    dal_no_snapshots = DataAccessLayer(wif=fixtures.KEYS_FIXTURES[0].wif, db_dir=tmpdir / "other", snapshot_interval=0)
+    other_doc_wrp = dal_no_snapshots.new(schemas.GenericDocument, title="w0", props={}).save()
+    other_doc_wrp = other_doc_wrp.update(title="w1").save()
+    loaded        = dal_no_snapshots.get(head=other_doc_wrp.head)
+    assert loaded.base is None
+    assert len(loaded.changes) == 1
+    assert loaded.doc.title == "w1"
+
+
+def test_snapshot_interval(tmpdir, monkeypatch):
+    dal = DataAccessLayer(wif=fixtures.KEYS_FIXTURES[0].wif, db_dir=tmpdir, snapshot_interval=3)
+
+    props   = {f"key{i}": f"value{i}" for i in range(20)}
+    doc_wrp = dal.new(schemas.GenericDocument, title="v0", props=props).save()
+    for i in range(1, 6):
+        doc_wrp = doc_wrp.update(title=f"v{i}").save()
+
+    snapshot_reads = []
+    get_snapshot   = dal.kvstore.get_snapshot
+
+    def _recording_get_snapshot(change_id):
+        snapshot_reads.append(change_id)
+        return get_snapshot(change_id)
+
+    monkeypatch.setattr(dal.kvstore, 'get_snapshot', _recording_get_snapshot)
+
+    # only the change with a revision divisible by the interval is looked up
+    loaded = dal.get(head=doc_wrp.head)
+    assert loaded.doc == doc_wrp.doc
+    assert loaded.base is not None
+    assert schemas.revision_number(loaded.base.rev) == 3
+    assert len(loaded.changes) == 2
+    assert snapshot_reads == [loaded.base.change_id]
+
+
+def test_default_snapshot_interval(tmpdir):
+    dal = DataAccessLayer(wif=fixtures.KEYS_FIXTURES[0].wif, db_dir=tmpdir)
+
+    doc_wrp   = dal.new(schemas.GenericDocument, title="v0", props={}).save()
+    snapshots = []
+    for i in range(1, 2 * dal.reset_interval + 1):
+        doc_wrp = doc_wrp.update(title=f"v{i}").save()
+        if dal.kvstore.get_snapshot(doc_wrp.head) is not None:
+            snapshots.append(schemas.revision_number(doc_wrp.head_rev))
+
+    # one snapshot between two resets
+    assert snapshots == [dal.reset_interval // 2, dal.reset_interval * 3 // 2]
+
+
+def test_snapshot_of_modified_doc(tmpdir):
+    dal = DataAccessLayer(wif=fixtures.KEYS_FIXTURES[0].wif, db_dir=tmpdir, snapshot_interval=1)
+
+    doc_wrp = dal.new(schemas.GenericDocument, title="v0", props={}).save()
+    doc_wrp = doc_wrp.update(title="v1")
+    # modified outside of update, the change (and its signature) says v1
+    doc_wrp.doc.title = "modified"
+    with pytest.raises(AssertionError):
+        doc_wrp.save()
+
+    dal.verify_mode = dal_module.VERIFY_OFF
+    doc_wrp = doc_wrp.save()
+
+    loaded = DataAccessLayer(wif=None, db_dir=tmpdir, snapshot_interval=1).get(head=doc_wrp.head)
+    assert loaded.base is not None
+    assert loaded.doc.title == "v1"
+
+
+def test_early_exit(tmpdir):
+    dal = DataAccessLayer(
+        wif=fixtures.KEYS_FIXTURES[0].wif,
+        db_dir=tmpdir,
+        snapshot_interval=0,
+        reset_interval=4,
+    )
+
+    props   = {f"key{i}": f"value{i}" for i in range(20)}
+    doc_wrp = dal.new(schemas.GenericDocument, title="v0", props=props).save()
+    for i in range(1, 6):
+        doc_wrp = doc_wrp.update(title=f"v{i}").save()
+
+    history = dal.get_history(head=doc_wrp.head)
+    assert len(history) == 6
+    assert history[-1].change_id == doc_wrp.head
+    assert [change.opcode for change in history] == [
+        docdiff.OP_RESET,
+        docdiff.OP_SET,
+        docdiff.OP_SET,
+        docdiff.OP_SET,
+        docdiff.OP_RESET,
+        docdiff.OP_SET,
+    ]
+
+    # changes before the most recent reset are not loaded
+    loaded = dal.get(head=doc_wrp.head)
+    assert loaded.doc == doc_wrp.doc
+    assert loaded.changes == history[-2:]
+
+
+def test_verify_modes(tmpdir, monkeypatch):
+    dal = DataAccessLayer(wif=fixtures.KEYS_FIXTURES[0].wif, db_dir=tmpdir, reset_interval=0)
+
+    num_applied_ops = 0
+    apply_diffs     = docdiff.apply_diffs
+
+    def _counting_apply_diffs(old_doc_kw, diff):
+        nonlocal num_applied_ops
+        num_applied_ops += len(diff)
+        return apply_diffs(old_doc_kw, diff)
+
+    monkeypatch.setattr(docdiff, 'apply_diffs', _counting_apply_diffs)
+
+    props   = {f"key{i}": f"value{i}" for i in range(20)}
+    doc_wrp = dal.new(schemas.GenericDocument, title="v0", props=props)
+    for i in range(1, 21):
+        doc_wrp = doc_wrp.update(title=f"v{i}")
+    doc_wrp = doc_wrp.save()
+
+    # verification is incremental, not a full replay for every update
+    assert num_applied_ops < 4 * 21
+
+    for verify_mode in [dal_module.VERIFY_ON_SAVE, dal_module.VERIFY_SAMPLED]:
+        dal.verify_mode        = verify_mode
+        dal.verify_sample_rate = 1.0
+
+        doc_wrp = doc_wrp.update(title="tampered")
+        doc_wrp.doc.title = "not tampered"
+        with pytest.raises(AssertionError):
+            doc_wrp.save()
+
+    dal.verify_mode = dal_module.VERIFY_OFF
+    doc_wrp = doc_wrp.update(title="tampered")
+    doc_wrp.doc.title = "not tampered"
+    doc_wrp.save()
+
+
+def test_new_many(tmpdir):
+    dal = DataAccessLayer(wif=fixtures.KEYS_FIXTURES[0].wif, db_dir=tmpdir)
+
+    doc_wrps = dal.new_many(schemas.GenericDocument, [{'title': f"doc{i}", 'props': {}} for i in range(5)])
+    assert [doc_wrp.doc.title for doc_wrp in doc_wrps] == [f"doc{i}" for i in range(5)]
+
+    for doc_wrp in doc_wrps:
+        doc_wrp = doc_wrp.save()
+        assert dal.get(doc_wrp.head).doc == doc_wrp.doc
@@ -1,4 +1,5 @@
 import random
+import asyncio
 import hashlib
 import binascii
 
@@ -88,3 +89,64 @@ def test_storage_cull_difficulty():
             assert saved_change_data is not None
         else:
             assert saved_change_data is None
+
+
+def test_storage_set_many():
+    storage = dht.ChangeStorage(node_id=dht.generate_node_id(), verify_workers=2)
+
+    changes = [
+        schemas.make_change(wif=WIF, doctype=f"{i}", opcode='bar', opdata={}, difficulty=1) for i in range(20)
+    ]
+    items = [(digest(change.change_id), schemas.dumps_change(change)) for change in changes]
+
+    invalid      = changes[0].copy(update={'signature': changes[1].signature})
+    invalid_item = (digest(invalid.change_id), schemas.dumps_change(invalid))
+    wrong_key    = (digest(changes[1].change_id), schemas.dumps_change(changes[2]))
+    malformed    = [(digest("garbage"), b"garbage"), (digest("list"), b"[1, 2]"), (digest("binary"), b"\xc7\x01")]
+
+    assert storage.set_many([invalid_item, wrong_key] + malformed + items) == 20
+    assert len(storage.data) == 20
+    for key, value in items:
+        assert storage.get(key) == value
+
+
+def test_storage_ingest_batches(monkeypatch):
+    storage = dht.ChangeStorage(node_id=dht.generate_node_id())
+    storage.ingest_delay      = 0.01
+    storage.ingest_batch_size = 8
+
+    batch_sizes     = []
+    verify_changes_ = schemas.verify_changes
+
+    def _recording_verify_changes(changes, *args, **kwargs):
+        batch_sizes.append(len(changes))
+        return verify_changes_(changes, *args, **kwargs)
+
+    monkeypatch.setattr(schemas, 'verify_changes', _recording_verify_changes)
+
+    changes = [
+        schemas.make_change(wif=WIF, doctype=f"{i}", opcode='bar', opdata={}, difficulty=1) for i in range(12)
+    ]
+    items = [(digest(change.change_id), schemas.dumps_change(change)) for change in changes]
+
+    async def _ingest():
+        for key, value in items[:10]:
+            storage[key] = value
+        # the first batch is full, the rest is stored after the delay
+        assert batch_sizes == [8]
+        assert len(storage.data) == 8
+        await asyncio.sleep(0.05)
+        assert batch_sizes == [8, 2]
+
+        # pending changes are stored before they are read
+        for key, value in items[10:]:
+            storage[key] = value
+        assert storage.get(items[-1][0]) == items[-1][1]
+        assert batch_sizes == [8, 2, 2]
+
+    asyncio.run(_ingest())
+    assert len(storage.data) == 12
+
+    # without an event loop, changes are stored right away
+    storage[items[0][0]] = items[0][1]
+    assert batch_sizes == [8, 2, 2, 1]
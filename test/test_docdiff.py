@@ -1,3 +1,5 @@
+import copy
+
 from guarantor import docdiff
 
 
@@ -6,3 +8,77 @@ def test_doc_diff():
     doc_v2_kw = {'title': "Hallo, Welt!"}
     diff_op   = docdiff.make_diff(doc_v1_kw, doc_v2_kw)
     assert docdiff.apply_diffs(doc_v1_kw, [diff_op]) == doc_v2_kw
+
+
+def test_compact_ops():
+    props     = {f"key{i}": f"value{i}" for i in range(20)}
+    doc_v1_kw = {'title': "Hello, World!", 'props': props}
+
+    doc_v2_kw = {'title': "Hello, World!", 'props': {**props, 'key3': "new"}}
+    diff_op   = docdiff.make_diff(doc_v1_kw, doc_v2_kw)
+    assert diff_op == docdiff.Operation(docdiff.OP_SET, {'path': ["props", "key3"], 'value': "new"})
+    assert docdiff.apply_diffs(doc_v1_kw, [diff_op]) == doc_v2_kw
+
+    doc_v3_kw = {'title': "Hello, World!", 'props': {k: v for k, v in props.items() if k != "key3"}}
+    diff_op   = docdiff.make_diff(doc_v1_kw, doc_v3_kw)
+    assert diff_op == docdiff.Operation(docdiff.OP_DEL, {'path': ["props", "key3"]})
+    assert docdiff.apply_diffs(doc_v1_kw, [diff_op]) == doc_v3_kw
+
+    doc_v4_kw = {'title': "Hallo, Welt!", 'props': {**props, 'key3': ["a", "b"], 'key.x': {'y': 1}}}
+    diff_op   = docdiff.make_diff(doc_v1_kw, doc_v4_kw)
+    assert diff_op.opcode == docdiff.OP_DICT_DIFF
+    assert docdiff.apply_diffs(doc_v1_kw, [diff_op]) == doc_v4_kw
+
+    # the old values of the document are not part of the diff
+    assert "value3" not in str(diff_op.opdata)
+
+    diff_op = docdiff.make_diff(doc_v1_kw, doc_v4_kw, force_reset=True)
+    assert diff_op == docdiff.Operation(docdiff.OP_RESET, doc_v4_kw)
+
+
+def test_chunking():
+    doc_v1_kw = {'title': "x", 'props': {}}
+    doc_v2_kw = {'title': "x", 'props': {f"key{i}": "x" * 100 for i in range(100)}}
+
+    ops = docdiff.make_diffs(doc_v1_kw, doc_v2_kw, max_op_size=1000)
+    assert len(ops) > 10
+    assert all(docdiff._op_size(op) <= 1000 for op in ops)
+    assert docdiff.apply_diffs(doc_v1_kw, ops) == doc_v2_kw
+
+    doc_v3_kw = {'title': "y", 'props': {**doc_v2_kw['props'], 'key0': "y", 'key1': "y" * 2000}}
+    ops       = docdiff.make_diffs(doc_v2_kw, doc_v3_kw, max_op_size=1000)
+    assert [op.opcode for op in ops] == [docdiff.OP_DICT_DIFF, docdiff.OP_DICT_DIFF]
+    assert docdiff.apply_diffs(doc_v2_kw, ops) == doc_v3_kw
+
+    ops = docdiff.make_diffs({}, doc_v2_kw, force_reset=True, max_op_size=1000)
+    assert ops[0].opcode == docdiff.OP_RESET
+    assert docdiff.apply_diffs({}, ops) == doc_v2_kw
+
+    ops = docdiff.make_diffs(doc_v1_kw, doc_v2_kw)
+    assert len(ops) == 1
+
+
+def test_apply_diffs_copy_free():
+    doc_v1_kw = {'title': "x", 'props': {'a': {'b': 1}, 'c': {'d': [1, 2]}}}
+    ops       = [
+        docdiff.Operation(docdiff.OP_SET, {'path': ["props", "a", "b"], 'value': 2}),
+        docdiff.Operation(docdiff.OP_SET, {'path': ["props", "e"], 'value': {'f': 1}}),
+        docdiff.Operation(docdiff.OP_SET, {'path': ["props", "e", "f"], 'value': 2}),
+        docdiff.Operation(docdiff.OP_DICT_DIFF, {'diff': [['add', ["props", "c", "d"], [[2, 3]]]]}),
+        docdiff.Operation(docdiff.OP_DEL, {'path': ["title"]}),
+    ]
+    orig_doc_kw = copy.deepcopy(doc_v1_kw)
+    orig_ops    = copy.deepcopy(ops)
+
+    doc_v2_kw = docdiff.apply_diffs(doc_v1_kw, ops)
+    assert doc_v2_kw == {'props': {'a': {'b': 2}, 'c': {'d': [1, 2, 3]}, 'e': {'f': 2}}}
+
+    # inputs are not mutated
+    assert doc_v1_kw == orig_doc_kw
+    assert ops       == orig_ops
+
+    ops = [docdiff.Operation(docdiff.OP_SET, {'path': ["props", "a", "b"], 'value': 2})]
+    doc_v3_kw = docdiff.apply_diffs(doc_v1_kw, ops)
+    # unmodified containers are shared
+    assert doc_v3_kw['props']['c'] is doc_v1_kw['props']['c']
+    assert doc_v3_kw['props']['a'] is not doc_v1_kw['props']['a']
@@ -1,5 +1,7 @@
 # pylint: disable=redefined-outer-name
 # pylint: disable=unused-argument
+import random
+import pathlib as pl
 
 from guarantor import crypto
 from guarantor import schemas
@@ -32,3 +34,211 @@ def test_index_update():
     assert {res0.head , res1.head } == {bob_id}
     assert {res0.field, res1.field} == {"props.name", "props.email"}
     assert {res0.stem , res1.stem } == {"bob"       , "bob@mail.com"}
+
+
+def _identity(name: str) -> schemas.Identity:
+    return schemas.Identity(address=f"addr_{name}", props={'name': name, 'email': f"{name}@mail.com"})
+
+
+def _query_heads(store: indexing.IndexStore, search_term: str) -> set[str]:
+    return {match.head for match in store.query("guarantor.schemas:Identity", search_term)}
+
+
+def test_index_store_persistence(tmpdir):
+    index_dir = tmpdir / "indexes"
+
+    with indexing.IndexStore(index_dir) as store:
+        store.update("head_alice", _identity("Alice"))
+        store.update("head_bob"  , _identity("Bob"))
+
+    # closed store: journal was merged into the term files
+    assert not any(path.read_binary() for path in index_dir.listdir("*.journal"))
+
+    store = indexing.IndexStore(index_dir)
+    assert _query_heads(store, "bob") == {"head_bob"}
+
+    # not closed: items are loaded from the journal
+    store.update("head_carol", _identity("Carol"))
+    assert _query_heads(indexing.IndexStore(index_dir), "carol") == {"head_carol"}
+
+    # torn write at the end of a journal is ignored
+    journal_path = index_dir / "guarantor.schemas_Identity.props.name.journal"
+    with journal_path.open(mode="ab") as fobj:
+        fobj.write(b'["+","dave"')
+
+    store = indexing.IndexStore(index_dir)
+    assert _query_heads(store, "carol") == {"head_carol"}
+    assert _query_heads(store, "alice") == {"head_alice"}
+    store.close()
+
+
+def test_index_store_head_rev(tmpdir):
+    index_dir = tmpdir / "indexes"
+    doctype   = "guarantor.schemas:Identity"
+
+    with indexing.IndexStore(index_dir) as store:
+        store.update("head_v0", _identity("Alice"), head_rev="rev_0")
+        store.update("head_v1", _identity("Alice"), replaces="head_v0", head_rev="rev_1")
+        store.update("head_bob", _identity("Bob"))
+
+    store = indexing.IndexStore(index_dir)
+    assert store.head_rev(doctype, "head_v1") == "rev_1"
+    assert store.head_rev(doctype, "head_v0") is None
+    assert store.head_rev(doctype, "head_bob") is None
+    assert store.query_heads(doctype, {'props.name': "alice"}) == [indexing.HeadItem("head_v1", "rev_1")]
+    store.close()
+
+
+def test_index_compaction(tmpdir):
+    index_dir = tmpdir / "indexes"
+
+    store = indexing.IndexStore(index_dir, compact_threshold=5)
+    for i in range(10):
+        store.update(f"head_{i}", _identity(f"name{i}"))
+
+    terms_path = index_dir / "guarantor.schemas_Identity.props.name.terms"
+    assert terms_path.exists()
+
+    other = indexing.IndexStore(index_dir)
+    assert _query_heads(other, "name") == {f"head_{i}" for i in range(10)}
+
+
+def test_index_replace_head(tmpdir):
+    index_dir = tmpdir / "indexes"
+
+    store = indexing.IndexStore(index_dir)
+    store.update("head_v1", _identity("Alice"))
+    store.update("head_v2", _identity("Alicia"), replaces="head_v1")
+    assert _query_heads(store, "ali") == {"head_v2"}
+    assert _query_heads(store, "alice") == set()
+
+    # removals are persisted in the journal ...
+    assert _query_heads(indexing.IndexStore(index_dir), "ali") == {"head_v2"}
+
+    store.update("head_v3", _identity("Bob"), replaces="head_v2")
+    store.close()
+
+    # ... and in the term file
+    store = indexing.IndexStore(index_dir)
+    assert _query_heads(store, "ali") == set()
+    assert _query_heads(store, "bob") == {"head_v3"}
+
+    store.update("head_v4", _identity("Bobby"), replaces="head_v3")
+    assert _query_heads(store, "bob") == {"head_v4"}
+
+
+def test_index_forked_doc():
+    doctype = "guarantor.schemas:Identity"
+    store   = indexing.IndexStore()
+    store.update("head_v0", _identity("Alice"), head_rev="rev_0")
+    store.update("head_v2", _identity("Alicia"), replaces="head_v0", head_rev="rev_2")
+    assert store.doc_id(doctype, "head_v2") == "head_v0"
+
+    # an update of the older fork doesn't replace the newer head
+    store.update("head_v1", _identity("Alina"), replaces="head_v0", head_rev="rev_1")
+    assert _query_heads(store, "ali") == {"head_v2"}
+
+    store.update("head_v3", _identity("Alison"), replaces="head_v1", head_rev="rev_3")
+    assert _query_heads(store, "ali") == {"head_v3"}
+    assert store.head_rev(doctype, "head_v2") is None
+
+    # heads indexed with an explicit doc_id (e.g. by a rebuild)
+    store.update("head_x", _identity("Bob"), head_rev="rev_5", doc_id="head_v0")
+    assert _query_heads(store, "") == {"head_x"}
+
+
+def test_index_runs(tmpdir):
+    rand  = random.Random(0)
+    words = ["alpha", "beta", "gamma", "delta", "alphabet", "betamax"]
+
+    path     = pl.Path(tmpdir) / "index"
+    index    = indexing.Index(path, compact_threshold=50, memtable_size=4)
+    expected: dict[str, set[str]] = {}
+
+    for i in range(300):
+        head = f"head_{rand.randrange(40):02d}"
+        if rand.random() < 0.3:
+            index.remove(head)
+            expected.pop(head, None)
+        else:
+            word = rand.choice(words)
+            index.add(word, head)
+            expected.setdefault(head, set()).add(word)
+
+        if i % 50 == 0:
+            index = indexing.Index(path, compact_threshold=50, memtable_size=4)
+
+        for prefix in ("", "alpha", "beta", "g"):
+            found = list(index.find(prefix))
+            assert found == sorted(found)
+            assert set(found) == {
+                indexing.IndexItem(word, head)
+                for head, head_words in expected.items()
+                for word in head_words
+                if word.startswith(prefix)
+            }
+
+
+def test_index_shared_files(tmpdir):
+    path   = pl.Path(tmpdir) / "index"
+    writer = indexing.Index(path)
+    writer.add("alpha", "head_1")
+    writer.close()
+
+    reader = indexing.Index(path)
+    other  = indexing.Index(path)
+    writer = indexing.Index(path)
+    writer.add("beta", "head_2")
+
+    # an index which didn't write anything leaves the files as they are
+    reader.close()
+    assert _find_heads(indexing.Index(path), "beta") == {"head_2"}
+
+    # compaction keeps the entries of other indexes
+    other.add("gamma", "head_3")
+    other.close()
+    index = indexing.Index(path)
+    assert _find_heads(index, "") == {"head_1", "head_2", "head_3"}
+    assert path.with_name("index.journal").stat().st_size == 0
+
+    writer.add("delta", "head_4")
+    writer.close()
+    assert _find_heads(indexing.Index(path), "") == {"head_1", "head_2", "head_3", "head_4"}
+
+
+def _find_heads(index: indexing.Index, search_term: str) -> set[str]:
+    return {item.head for item in index.find(search_term)}
+
+
+def _heads(items: list[indexing.HeadItem]) -> list[str]:
+    return [item.head for item in items]
+
+
+def test_query_heads():
+    store = indexing.IndexStore()
+    store.update("head_a", schemas.Identity(address="addr_a", props={'name': "Alice", 'email': "alice@a.com"}))
+    store.update("head_b", schemas.Identity(address="addr_b", props={'name': "Alice", 'email': "alice@b.com"}))
+    store.update("head_c", schemas.Identity(address="addr_c", props={'name': "Bob"  , 'email': "bob@a.com"}))
+
+    doctype = "guarantor.schemas:Identity"
+    assert _heads(store.query_heads(doctype, {'props.name': "alice"})) == ["head_a", "head_b"]
+    assert _heads(store.query_heads(doctype, {'props.email': "a.com"})) == ["head_a", "head_c"]
+    assert _heads(store.query_heads(doctype, {'props.name': "alice", 'props.email': "a.com"})) == ["head_a"]
+    assert _heads(store.query_heads(doctype, {'props.name': "carol", 'props.email': "a.com"})) == []
+    assert _heads(store.query_heads(doctype, {'props.name': "alice", 'unknown': "a"})) == []
+
+    # matches of multiple terms of a head (Alice, alice, alice@a.com) are deduplicated
+    assert _heads(store.query_heads(doctype, {'props.name': "a"})) == ["head_a", "head_b"]
+
+    assert _heads(store.query_heads(doctype, {'address': "addr"}, limit=2)) == ["head_a", "head_b"]
+    assert _heads(store.query_heads(doctype, {'address': "addr"}, limit=2, offset=2)) == ["head_c"]
+    assert _heads(store.query_heads(doctype, {'address': "addr"}, offset=1)) == ["head_b", "head_c"]
+    assert _heads(store.query_heads(doctype, {'address': "addr", 'props.email': "a.com"}, limit=1)) == ["head_a"]
+
+    store.update("head_d", schemas.Identity(address="addr_d", props={'name': "Dan"}), head_rev="rev_2")
+    store.update("head_e", schemas.Identity(address="addr_e", props={'name': "Eve"}), head_rev="rev_1")
+    newest = store.query_heads(doctype, {'address': "addr"}, newest_first=True)
+    assert _heads(newest) == ["head_d", "head_e", "head_a", "head_b", "head_c"]
+    for offset in range(5):
+        page = store.query_heads(doctype, {'address': "addr"}, limit=2, offset=offset, newest_first=True)
+        assert page == newest[offset : offset + 2]
@@ -14,9 +14,10 @@ from . import fixtures
 KEYPAIR = fixtures.KEYS_FIXTURES[0]
 
 
-@pytest.fixture()
-def db_client(tmpdir) -> typ.Iterator[kvstore.Client]:
-    yield kvstore.Client(pl.Path(tmpdir), flag="c")
+@pytest.fixture(params=[kvstore.BACKEND_DBM, kvstore.BACKEND_AOF])
+def db_client(tmpdir, request) -> typ.Iterator[kvstore.Client]:
+    with kvstore.Client(pl.Path(tmpdir), flag="c", backend=request.param) as client:
+        yield client
 
 
 def test_post(db_client: kvstore.Client):
@@ -46,3 +47,124 @@ def test_post(db_client: kvstore.Client):
 
     changes = list(db_client.iter_changes(head=change_v2.change_id))
     assert changes == [change_v2, change_v1]
+
+
+@pytest.mark.parametrize("backend", [kvstore.BACKEND_DBM, kvstore.BACKEND_AOF])
+def test_reader_client(tmpdir, backend):
+    fields = {
+        'wif'    : KEYPAIR.wif,
+        'doctype': schemas.get_doctype(schemas.GenericDocument),
+        'opcode' : docdiff.OP_RESET,
+        'opdata' : {'title': "test123"},
+    }
+    change_v1 = schemas.make_change(**fields)
+    change_v2 = schemas.make_change(**{**fields, 'opdata': {'title': "test12345"}})
+
+    with kvstore.Client(pl.Path(tmpdir), flag="c", backend=backend) as writer:
+        writer.post(change_v1)
+
+    with kvstore.Client(pl.Path(tmpdir), flag="r", backend=backend) as reader:
+        assert reader.get(change_v1.change_id) == change_v1
+        assert reader.get(change_v2.change_id) is None
+
+        with kvstore.Client(pl.Path(tmpdir), flag="c", backend=backend) as writer:
+            writer.post(change_v2)
+
+        # pooled reader handles are reopened after the file was modified
+        assert reader.get(change_v1.change_id) == change_v1
+        assert reader.get(change_v2.change_id) == change_v2
+
+        with pytest.raises(Exception):
+            reader.post(change_v2)
+
+
+def test_post_many(db_client: kvstore.Client):
+    doctype = schemas.get_doctype(schemas.GenericDocument)
+    changes = []
+    parent  = None
+    for i in range(5):
+        change = schemas.make_change(
+            wif=KEYPAIR.wif,
+            doctype=doctype,
+            opcode=docdiff.OP_RESET,
+            opdata={'title': f"test{i}"},
+            parent_id=parent and parent.change_id,
+            parent_rev=parent and parent.rev,
+        )
+        changes.append(change)
+        parent = change
+
+    invalid = changes[-1].copy(update={'signature': changes[0].signature})
+    with pytest.raises(Exception):
+        db_client.post_many(changes[:-1] + [invalid])
+
+    assert db_client.get(changes[0].change_id) is None
+
+    db_client.post_many(changes)
+    assert list(db_client.iter_changes(head=changes[-1].change_id)) == changes[::-1]
+
+
+@pytest.mark.parametrize("backend", [kvstore.BACKEND_DBM, kvstore.BACKEND_AOF])
+def test_sharding(tmpdir, backend):
+    doctype = schemas.get_doctype(schemas.GenericDocument)
+    changes = [
+        schemas.make_change(wif=KEYPAIR.wif, doctype=doctype, opcode=docdiff.OP_RESET, opdata={'title': f"t{i}"})
+        for i in range(8)
+    ]
+
+    with kvstore.Client(pl.Path(tmpdir), flag="c", backend=backend, num_shards=4) as client:
+        client.post_many(changes)
+
+        shards = {client.shard(change.change_id) for change in changes}
+        assert len(shards) > 1
+        paths = {client.storage_path(change.change_id) for change in changes}
+        assert len(paths) == len(shards)
+
+    with kvstore.Client(pl.Path(tmpdir), flag="r", backend=backend, num_shards=4) as client:
+        for change in changes:
+            assert client.get(change.change_id) == change
+
+        changes_data = client.read_many([change.change_id for change in changes] + ["0" * 64])
+        assert [schemas.loads_change(changes_data[change.change_id]) for change in changes] == changes
+        assert len(changes_data) == len(changes)
+
+    with pytest.raises(ValueError, match=r"Invalid num_shards=2"):
+        kvstore.Client(pl.Path(tmpdir), flag="r", backend=backend, num_shards=2)
+
+
+@pytest.mark.parametrize("backend", [kvstore.BACKEND_DBM, kvstore.BACKEND_AOF])
+def test_legacy_num_shards(tmpdir, backend):
+    change = schemas.make_change(
+        wif=KEYPAIR.wif, doctype=schemas.get_doctype(schemas.GenericDocument), opcode=docdiff.OP_RESET, opdata={}
+    )
+    with kvstore.Client(pl.Path(tmpdir), flag="c", backend=backend) as client:
+        client.post(change)
+
+    # a store created before the meta file was written
+    (pl.Path(tmpdir) / kvstore.META_NAME).unlink()
+
+    with pytest.raises(ValueError, match=r"Invalid num_shards=4 .* \(created with 1\)"):
+        kvstore.Client(pl.Path(tmpdir), flag="c", backend=backend, num_shards=4)
+    assert not (pl.Path(tmpdir) / kvstore.META_NAME).exists()
+
+    with kvstore.Client(pl.Path(tmpdir), flag="c", backend=backend, num_shards=1) as client:
+        assert client.get(change.change_id) == change
+
+
+def test_codecs(db_client: kvstore.Client):
+    changes = [
+        schemas.make_change(
+            wif=KEYPAIR.wif,
+            doctype=schemas.get_doctype(schemas.GenericDocument),
+            opcode=docdiff.OP_RESET,
+            opdata={'title': f"test{codec}"},
+        )
+        for codec in (schemas.CODEC_JSON, schemas.CODEC_ORJSON, schemas.CODEC_BINARY)
+    ]
+
+    for change, codec in zip(changes, (schemas.CODEC_JSON, schemas.CODEC_ORJSON, schemas.CODEC_BINARY)):
+        db_client.codec = codec
+        db_client.post(change)
+
+    for change in changes:
+        assert db_client.get(change.change_id) == change
@@ -0,0 +1,32 @@
+import os
+
+import pytest
+
+from guarantor import pools
+
+
+def test_executors():
+    executors = pools.new_executors()
+    executor  = pools.get_executor(executors, 2)
+    assert pools.get_executor(executors, 2) is executor
+    assert list(executor.map(abs, [-1, -2])) == [1, 2]
+
+    pools.shutdown_executors(executors)
+    assert not executors
+    assert pools.get_executor(executors, 2) is not executor
+    pools.shutdown_executors(executors)
+
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason="requires os.fork")
+def test_executors_reset_after_fork():
+    executors = pools.new_executors()
+    pools.get_executor(executors, 1)
+
+    pid = os.fork()
+    if pid == 0:
+        os._exit(0 if not executors else 1)
+
+    _, status = os.waitpid(pid, 0)
+    assert os.WEXITSTATUS(status) == 0
+    assert executors
+    pools.shutdown_executors(executors)
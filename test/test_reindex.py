@@ -0,0 +1,109 @@
+# pylint: disable=redefined-outer-name
+# pylint: disable=unused-argument
+import shutil
+import pathlib as pl
+
+import pytest
+import click.testing
+
+from guarantor import cli
+from guarantor import kvstore
+from guarantor import schemas
+from guarantor import reindex
+from guarantor.dal import DataAccessLayer
+
+from . import fixtures
+
+DOCTYPE = "guarantor.schemas:GenericDocument"
+
+
+@pytest.fixture
+def db_dir(tmpdir):
+    with DataAccessLayer(wif=fixtures.KEYS_FIXTURES[0].wif, db_dir=tmpdir, num_shards=2) as dal:
+        for i in range(6):
+            doc_wrp = dal.new(schemas.GenericDocument, title=f"doc{i} v0", props={}).save()
+            if i % 2 == 0:
+                doc_wrp.update(title=f"doc{i} v1").save()
+
+    shutil.rmtree(tmpdir / "indexes")
+    return pl.Path(tmpdir)
+
+
+def _find_titles(db_dir, search_term: str) -> set[str]:
+    with DataAccessLayer(wif=None, db_dir=db_dir, num_shards=2) as dal:
+        return {doc_wrp.doc.title for doc_wrp in dal.find(DOCTYPE, title=search_term)}
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_rebuild_indexes(db_dir, workers):
+    assert _find_titles(db_dir, "doc") == set()
+
+    progress: list[reindex.Progress] = []
+    result = reindex.rebuild_indexes(db_dir, num_shards=2, workers=workers, batch_size=4, progress=progress.append)
+    assert result == reindex.Progress(num_heads=6, num_done=6)
+    assert progress == [reindex.Progress(6, 0), reindex.Progress(6, 4), reindex.Progress(6, 6)]
+
+    assert _find_titles(db_dir, "doc") == {"doc0 v1", "doc1 v0", "doc2 v1", "doc3 v0", "doc4 v1", "doc5 v0"}
+    assert _find_titles(db_dir, "v1") == {"doc0 v1", "doc2 v1", "doc4 v1"}
+    assert not (db_dir / "indexes" / reindex.CHECKPOINT_NAME).exists()
+
+
+def test_rebuild_indexes_resume(db_dir):
+    options = reindex.StoreOptions(db_dir, "dbm", num_shards=2, trusted=False)
+    heads   = reindex.find_heads(options, workers=1)
+    assert len(heads) == 6
+
+    (db_dir / "indexes").mkdir()
+    reindex._write_checkpoint(db_dir / "indexes" / reindex.CHECKPOINT_NAME, heads[2])
+    assert heads == sorted(heads, key=lambda item: (item.shard, item.position))
+
+    result = reindex.rebuild_indexes(db_dir, num_shards=2, workers=1)
+    assert result == reindex.Progress(num_heads=6, num_done=6)
+    assert len(_find_titles(db_dir, "doc")) == 3
+
+
+def test_rebuild_indexes_invalid_change(db_dir, caplog):
+    with kvstore.Client(db_dir, flag='c', num_shards=2) as client:
+        storage = client._get_storage(client.shard_path(0))
+        storage.put_many({"invalid_change": b"not a change"})
+
+    result = reindex.rebuild_indexes(db_dir, num_shards=2, workers=1)
+    assert result == reindex.Progress(num_heads=6, num_done=6)
+    assert len(_find_titles(db_dir, "doc")) == 6
+    assert "Skipping invalid change invalid_change" in caplog.text
+
+
+def test_rebuild_indexes_forked_doc(db_dir):
+    with DataAccessLayer(wif=fixtures.KEYS_FIXTURES[0].wif, db_dir=db_dir, num_shards=2) as dal:
+        doc_wrp = dal.new(schemas.GenericDocument, title="forked v0", props={}).save()
+        doc_wrp.update(title="forked a").save()
+        doc_wrp.update(title="forked b").save()
+    shutil.rmtree(db_dir / "indexes")
+
+    result = reindex.rebuild_indexes(db_dir, num_shards=2, workers=1)
+    assert result == reindex.Progress(num_heads=8, num_done=8)
+    assert len(_find_titles(db_dir, "forked")) == 1
+
+
+def test_rebuild_indexes_doc_ids(db_dir):
+    props = {f"key{i}": "x" * 100 for i in range(20)}
+    with DataAccessLayer(wif=fixtures.KEYS_FIXTURES[0].wif, db_dir=db_dir, num_shards=2, max_op_size=500) as dal:
+        doc_wrp = dal.new(schemas.GenericDocument, title="chunked", props=props).save()
+        assert len(doc_wrp.changes) > 1
+        doc_id = dal.indexes.doc_id(DOCTYPE, doc_wrp.head)
+        assert doc_id == doc_wrp.changes[0].change_id
+
+    # a rebuild derives the same doc_id
+    reindex.rebuild_indexes(db_dir, num_shards=2, workers=1, resume=False)
+    with DataAccessLayer(wif=None, db_dir=db_dir, num_shards=2) as dal:
+        assert dal.indexes.doc_id(DOCTYPE, doc_wrp.head) == doc_id
+
+
+def test_reindex_cli(db_dir):
+    runner = click.testing.CliRunner()
+    result = runner.invoke(
+        cli.cli, ["reindex", "--db-dir", str(db_dir), "--num-shards", "2", "--workers", "1"]
+    )
+    assert result.exit_code == 0, result.output
+    assert "Indexed         6 / 6 documents" in result.output
+    assert len(_find_titles(db_dir, "doc")) == 6
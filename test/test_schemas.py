@@ -1,7 +1,12 @@
 import random
 
+import pytest
+
+from guarantor import docdiff
 from guarantor import schemas
 
+from . import fixtures
+
 
 def test_get_doctype():
     model = schemas.Identity(address="moep", props={'foo': "bar"})
@@ -23,7 +28,7 @@ def test_revision():
 
 def test_calculate_pow():
     rand = random.Random(0)
-    for difficulty in range(2, 10):
+    for difficulty in range(0, 10):
         for _ in range(10):
             change_id = hex(int(rand.random() * 1000_000_000))[2:].zfill(8)
             pow_str   = schemas.calculate_pow(change_id, difficulty)
@@ -129,3 +134,158 @@ def test_calculate_pow():
 #         identity_envelope.document = schemas.Identity(address=addr, props={'foo': "bar", 'bam': "baz"})
 
 #         assert not schemas.verify_identity_envelope(identity_envelope)
+
+
+def _make_test_change(wif: str) -> schemas.Change:
+    return schemas.make_change(
+        wif=wif,
+        doctype=schemas.get_doctype(schemas.GenericDocument),
+        opcode=docdiff.OP_RESET,
+        opdata={'title': "test"},
+    )
+
+
+def test_derive_change_id_memoized():
+    change    = _make_test_change(fixtures.KEYS_FIXTURES[0].wif)
+    change_id = change.change_id
+    assert schemas.derive_change_id(change) == change_id
+    assert change._derived_change_id == change_id
+
+    updated = change.copy(update={'opdata': {'title': "other"}})
+    assert schemas.derive_change_id(updated) != change_id
+
+    change.opcode = "other"
+    assert change._derived_change_id is None
+    assert schemas.derive_change_id(change) != change_id
+
+    loaded = schemas.loads_change(schemas.dumps_change(updated), verify=False)
+    assert schemas.derive_change_id(loaded) == schemas.derive_change_id(updated)
+
+
+def test_loads_change_verification():
+    change      = _make_test_change(fixtures.KEYS_FIXTURES[0].wif)
+    other       = _make_test_change(fixtures.KEYS_FIXTURES[1].wif)
+    change_data = schemas.dumps_change(change)
+
+    schemas._verified_signatures.clear()
+    assert schemas.loads_change(change_data) == change
+    assert len(schemas._verified_signatures) == 1
+    assert schemas.loads_change(change_data) == change
+    assert len(schemas._verified_signatures) == 1
+
+    invalid      = change.copy(update={'signature': other.signature})
+    invalid_data = schemas.dumps_change(invalid)
+    with pytest.raises(schemas.VerificationError):
+        schemas.loads_change(invalid_data)
+
+    assert schemas.loads_change(invalid_data, verify=False) == invalid
+
+
+def test_verified_signatures_lru(monkeypatch):
+    monkeypatch.setattr(schemas, 'VERIFIED_CACHE_SIZE', 2)
+    schemas._verified_signatures.clear()
+
+    keys = [("addr", f"sig{i}", "msg") for i in range(3)]
+    schemas._remember_verified(keys[0])
+    schemas._remember_verified(keys[1])
+    # a hit makes keys[0] the most recently used, so keys[1] is evicted
+    assert schemas._is_verified(keys[0])
+    schemas._remember_verified(keys[2])
+    assert list(schemas._verified_signatures) == [keys[0], keys[2]]
+    assert not schemas._is_verified(keys[1])
+    schemas._verified_signatures.clear()
+
+
+def test_verify_changes():
+    changes = [_make_test_change(keypair.wif) for keypair in fixtures.KEYS_FIXTURES]
+    invalid_sig = changes[0].copy(update={'signature': changes[1].signature})
+    invalid_id  = changes[0].copy(update={'change_id': changes[1].change_id})
+    batch       = changes + [invalid_sig, invalid_id]
+
+    for workers in (1, 2):
+        schemas._verified_signatures.clear()
+        assert schemas.verify_changes(batch * 4, workers=workers) == [True, True, False, False] * 4
+        assert len(schemas._verified_signatures) == 2
+
+
+def test_change_codecs():
+    wif    = fixtures.KEYS_FIXTURES[0].wif
+    parent = _make_test_change(wif)
+    nums   = [1, 2.5, None, 2 ** 70, 2 ** 64 + 1, -(2 ** 63) - 1]
+    change = schemas.make_change(
+        wif=wif,
+        doctype=parent.doctype,
+        opcode=docdiff.OP_SET,
+        opdata={'path': ["title"], 'value': "tëst", 'nums': nums},
+        parent_id=parent.change_id,
+        parent_rev=parent.rev,
+    )
+
+    json_data   = schemas.dumps_change(change, codec=schemas.CODEC_JSON)
+    orjson_data = schemas.dumps_change(change, codec=schemas.CODEC_ORJSON)
+    binary_data = schemas.dumps_change(change, codec=schemas.CODEC_BINARY)
+
+    assert json_data.startswith(b"{")
+    assert binary_data.startswith(schemas.BINARY_MAGIC)
+    assert len(binary_data) < len(orjson_data)
+
+    for change_data in (json_data, orjson_data, binary_data):
+        loaded = schemas.loads_change(change_data)
+        assert loaded == change
+        assert schemas.derive_change_id(loaded) == change.change_id
+        # not only equal as floats
+        assert [type(num) for num in loaded.opdata['nums']] == [int, float, type(None), int, int, int]
+        assert loaded.opdata['nums'][4] == 2 ** 64 + 1
+
+    for change in (parent, parent.copy(update={'change_id': "not_hex", 'signature': "not b64"})):
+        assert schemas.loads_change(schemas.dumps_change(change), verify=False) == change
+
+    invalid_version = binary_data[:1] + b"\x02" + binary_data[2:]
+    for invalid_data in (binary_data[:-1], binary_data[:20], invalid_version, b"[1, 2]"):
+        with pytest.raises(ValueError):
+            schemas.loads_change(invalid_data)
+
+    with pytest.raises(ValueError, match=r"Invalid codec"):
+        schemas.dumps_change(change, codec="xml")
+
+
+def test_snapshot_big_ints():
+    snapshot = schemas.Snapshot(
+        change_id="a" * 64,
+        rev="rev",
+        doctype="guarantor.schemas:GenericDocument",
+        doc={'title': "t", 'props': {'n': 2 ** 64 + 1, 'digits': "1234567890123456789012"}},
+    )
+    loaded = schemas.loads_snapshot(schemas.dumps_snapshot(snapshot))
+    assert loaded == snapshot
+    assert loaded.doc['props']['n'] == 2 ** 64 + 1
+    assert isinstance(loaded.doc['props']['n'], int)
+
+
+def test_calculate_pow_parallel():
+    rand = random.Random(0)
+    for _ in range(3):
+        change_id = hex(int(rand.random() * 1000_000_000))[2:].zfill(8)
+        pow_str   = schemas.calculate_pow(change_id, difficulty=16, workers=2)
+        bits      = schemas.get_pow_difficulty(change_id, pow_str)
+        assert bits >= 16, (bits, change_id, pow_str)
+
+    schemas.shutdown_pow_executors()
+    assert not schemas._pow_executors
+
+    # a new pool is created on demand
+    pow_str = schemas.calculate_pow("deadbeef", difficulty=16, workers=2)
+    assert schemas.get_pow_difficulty("deadbeef", pow_str) >= 16
+
+
+def test_make_changes():
+    doctype = schemas.get_doctype(schemas.GenericDocument)
+    specs   = [schemas.ChangeSpec(doctype, docdiff.OP_RESET, {'title': f"doc{i}"}) for i in range(10)]
+
+    for pow_workers in [1, 2]:
+        changes = list(schemas.make_changes(fixtures.KEYS_FIXTURES[0].wif, specs, difficulty=4, pow_workers=pow_workers))
+        assert [change.opdata for change in changes] == [spec.opdata for spec in specs]
+        for change in changes:
+            assert change.address == fixtures.KEYS_FIXTURES[0].addr
+            assert schemas.verify_change(change)
+            assert schemas.get_pow_difficulty(change.change_id, change.proof_of_work) >= 4